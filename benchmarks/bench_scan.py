@@ -0,0 +1,221 @@
+"""
+Benchmarks for scanning, grouping, sorting and volume assembly.
+
+A synthetic DICOM tree is generated for every case (see synthetic.py)
+and each run is done in a fresh process, so peak RSS is per case.
+
+    python benchmarks/bench_scan.py -o before.json
+    python benchmarks/bench_scan.py --case ct --case rle --repeat 5 -o after.json
+    python benchmarks/bench_scan.py --compare before.json after.json
+"""
+import argparse, datetime, json, multiprocessing, os, platform, resource
+import shutil, statistics, subprocess, sys, tempfile, time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import synthetic
+
+STAGES = ("walk", "scan", "grouping", "sorting", "assembly")
+
+CASES = {
+    "ct": dict(patients=1, series=2, slices=300),
+    "many-patients": dict(patients=40, series=3, slices=10),
+    "multiframe": dict(series=2, slices=300, frames=100),
+    "duplicates": dict(series=2, slices=200, duplicates=50),
+    "private-tags": dict(series=2, slices=200, private_tags=200),
+    "rle": dict(series=1, slices=200, transfer_syntax=synthetic.RLE_LOSSLESS),
+    "jpeg-ls": dict(series=1, slices=200, transfer_syntax=synthetic.JPEG_LS_LOSSLESS),
+    "jpeg2000": dict(series=1, slices=200, transfer_syntax=synthetic.JPEG2000_LOSSLESS),
+}
+
+
+def PeakRSS():
+    """
+    Peak resident set size of this process, in KiB.
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        usage //= 1024
+    return usage
+
+
+def RunStages(directory):
+    """
+    Run every stage once over directory, return timings (s) and the peak
+    RSS (KiB) measured after each stage.
+    """
+    import dicom_grouper
+    import dicom_reader
+    import dicom_volume
+
+    timings = {}
+    rss = {}
+
+    t0 = time.perf_counter()
+    filenames = dicom_reader.GetFileList(directory)
+    timings["walk"] = time.perf_counter() - t0
+    rss["walk"] = PeakRSS()
+
+    t0 = time.perf_counter()
+    dicoms = [dicom_reader.ReadDicomFile(filename) for filename in filenames]
+    timings["scan"] = time.perf_counter() - t0
+    rss["scan"] = PeakRSS()
+
+    t0 = time.perf_counter()
+    grouper = dicom_grouper.DicomPatientGrouper()
+    for dcm in dicoms:
+        if dcm is not None:
+            grouper.AddFile(dcm)
+    groups = [group for patient in grouper.GetPatientsGroups() for group in patient.GetGroups()]
+    timings["grouping"] = time.perf_counter() - t0
+    rss["grouping"] = PeakRSS()
+
+    t0 = time.perf_counter()
+    sorted_files = [group.GetFilenameList() for group in groups]
+    timings["sorting"] = time.perf_counter() - t0
+    rss["sorting"] = PeakRSS()
+
+    t0 = time.perf_counter()
+    nvoxels = 0
+    for group in groups:
+        volume, positions = dicom_volume.AssembleVolume(group)
+        nvoxels += volume.size
+        del volume
+    timings["assembly"] = time.perf_counter() - t0
+    rss["assembly"] = PeakRSS()
+
+    return {
+        "nfiles": len(filenames),
+        "nseries": len(groups),
+        "nvoxels": nvoxels,
+        "timings": timings,
+        "peak_rss_kb": rss,
+    }
+
+
+def _RunStagesChild(directory, queue):
+    try:
+        queue.put(RunStages(directory))
+    except BaseException as err:
+        queue.put({"error": repr(err)})
+
+
+def RunIsolated(directory):
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=_RunStagesChild, args=(directory, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    if "error" in result:
+        raise RuntimeError(result["error"])
+    return result
+
+
+def RunCase(name, params, repeat, workdir, rows, columns):
+    directory = os.path.join(workdir, name)
+    t0 = time.perf_counter()
+    synthetic.GenerateTree(directory, rows=rows, columns=columns, **params)
+    generation = time.perf_counter() - t0
+
+    runs = [RunIsolated(directory) for i in range(repeat)]
+    stages = {}
+    for stage in STAGES:
+        values = [run["timings"][stage] for run in runs]
+        stages[stage] = {"min": min(values), "median": statistics.median(values)}
+
+    best_scan = min(run["timings"]["walk"] + run["timings"]["scan"] for run in runs)
+    nfiles = runs[0]["nfiles"]
+    return {
+        "params": dict(params, rows=rows, columns=columns),
+        "nfiles": nfiles,
+        "nseries": runs[0]["nseries"],
+        "nvoxels": runs[0]["nvoxels"],
+        "repeat": repeat,
+        "generation_seconds": generation,
+        "files_per_second": nfiles / best_scan if best_scan else None,
+        "stages": stages,
+        "peak_rss_kb": max(run["peak_rss_kb"]["assembly"] for run in runs),
+        "peak_rss_kb_by_stage": runs[-1]["peak_rss_kb"],
+    }
+
+
+def GetMetadata():
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        revision = ""
+    try:
+        import gdcm
+
+        gdcm_version = gdcm.Version.GetVersion()
+    except ImportError:
+        gdcm_version = ""
+    return {
+        "revision": revision,
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "gdcm": gdcm_version,
+        "cpus": os.cpu_count(),
+    }
+
+
+def Compare(old_filename, new_filename):
+    with open(old_filename) as f:
+        old = json.load(f)
+    with open(new_filename) as f:
+        new = json.load(f)
+
+    print("%-16s %-10s %12s %12s %8s" % ("case", "stage", "old (s)", "new (s)", "ratio"))
+    for name, case in new["cases"].items():
+        if name not in old["cases"]:
+            continue
+        old_case = old["cases"][name]
+        for stage in STAGES:
+            a = old_case["stages"][stage]["min"]
+            b = case["stages"][stage]["min"]
+            ratio = b / a if a else float("nan")
+            print("%-16s %-10s %12.4f %12.4f %8.2f" % (name, stage, a, b, ratio))
+        print("%-16s %-10s %12.0f %12.0f" % (name, "files/s", old_case["files_per_second"], case["files_per_second"]))
+        print("%-16s %-10s %12d %12d" % (name, "rss (KiB)", old_case["peak_rss_kb"], case["peak_rss_kb"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--case", action="append", choices=sorted(CASES), help="case to run (default: all)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--rows", type=int, default=256)
+    parser.add_argument("--columns", type=int, default=256)
+    parser.add_argument("--workdir", help="where synthetic trees are written (default: a temporary directory)")
+    parser.add_argument("-o", "--output", help="JSON file for the results (default: stdout)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files")
+    args = parser.parse_args()
+
+    if args.compare:
+        Compare(*args.compare)
+        return
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="load_dicom_bench_")
+    try:
+        results = {"meta": GetMetadata(), "cases": {}}
+        for name in args.case or CASES:
+            print("Running %s..." % name, file=sys.stderr)
+            results["cases"][name] = RunCase(name, CASES[name], args.repeat, workdir, args.rows, args.columns)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
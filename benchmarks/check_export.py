@@ -0,0 +1,63 @@
+"""
+Check that exports can be repeated: the same synthetic tree (see
+synthetic.py) scanned and exported twice in one process, and once from
+a scan snapshot, gives the same file names. Exits with status 1 if
+they differ.
+
+    python benchmarks/check_export.py
+"""
+import argparse, os, sys, tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import synthetic
+
+import dicom_export as dicom_export
+import dicom_reader as dicom_reader
+import scan_snapshot as scan_snapshot
+
+
+def Export(groups, directory, fmt):
+    """
+    Export groups into directory, return the sorted relative paths of
+    the exported files.
+    """
+    results = dicom_export.ExportGroups(groups, directory, fmt)
+    for group, filename, error in results:
+        if error is not None:
+            print("%s: %r" % (group.title, error))
+    return sorted(os.path.relpath(filename, directory) for group, filename, error in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--format", default=dicom_export.FORMAT_NPZ, choices=dicom_export.FORMATS)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        directory = os.path.join(workdir, "tree")
+        synthetic.GenerateTree(directory, patients=2, series=3, slices=8, rows=32, columns=32, duplicates=2)
+
+        exports = []
+        for run in range(2):
+            grouper = dicom_reader.GetDicomGrouper(directory)
+            exports.append(Export(grouper.GetPatientsGroups(), os.path.join(workdir, "export%d" % run), args.format))
+        filename = os.path.join(workdir, "tree.snap")
+        scan_snapshot.WriteSnapshot(grouper, filename)
+        snapshot_groups = scan_snapshot.Snapshot(filename).GetGroups()
+        exports.append(Export(snapshot_groups, os.path.join(workdir, "snapshot"), args.format))
+
+    failed = False
+    for name, export in zip(("second scan", "snapshot"), exports[1:]):
+        if export != exports[0]:
+            print("%s: file names differ from the first export" % name)
+            for path in sorted(set(export) ^ set(exports[0])):
+                print("    %s" % path)
+            failed = True
+    print("%d series exported 3 times" % len(exports[0]))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Check that a scan snapshot stands in for the scan it was written from:
+every series has the same frames, volume and thumbnail, loaded from
+the snapshot alone, as from the DicomPatientGrouper. Runs over a small
+synthetic tree (see synthetic.py) and exits with status 1 on mismatch.
+
+    python benchmarks/check_snapshot.py
+    python benchmarks/check_snapshot.py --fast
+"""
+import argparse, os, sys, tempfile
+
+import numpy as np
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import synthetic
+
+import dicom_reader as dicom_reader
+import dicom_volume as dicom_volume
+import scan_snapshot as scan_snapshot
+import thumbnail as thumbnail
+
+
+def CheckGroup(group, snapshot_group):
+    """
+    Return the list of differences between a DicomGroup and the
+    SnapshotGroup written for it.
+    """
+    errors = []
+    if snapshot_group.key != group.key:
+        errors.append("key %r != %r" % (snapshot_group.key, group.key))
+    frames, positions = group.GetSortedFrames()
+    snapshot_frames, snapshot_positions = snapshot_group.GetSortedFrames()
+    if [(d.image.file, f) for d, f in snapshot_frames] != [(d.image.file, f) for d, f in frames]:
+        errors.append("sorted frames differ")
+    elif not np.allclose(snapshot_positions, positions):
+        errors.append("positions differ")
+    elif not np.array_equal(dicom_volume.AssembleFrames(snapshot_frames), dicom_volume.AssembleFrames(frames)):
+        errors.append("volumes differ")
+
+    # Separate services: their memory caches are keyed by file.
+    try:
+        png = thumbnail.ThumbnailService().GetThumbnail(snapshot_group)
+    except Exception as err:
+        errors.append("thumbnail: %r" % err)
+    else:
+        if png != thumbnail.ThumbnailService().GetThumbnail(group):
+            errors.append("thumbnails differ")
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fast", action="store_true", help="scan with dicom_header (records pixel offsets)")
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, params in (("slices", dict(series=2, slices=12)), ("multiframe", dict(series=1, slices=12, frames=4))):
+            directory = os.path.join(workdir, name)
+            synthetic.GenerateTree(directory, rows=64, columns=64, **params)
+            grouper = dicom_reader.GetDicomGrouper(directory, fast=args.fast)
+            filename = os.path.join(workdir, name + ".snap")
+            scan_snapshot.WriteSnapshot(grouper, filename)
+
+            groups = [group for patient in grouper.GetPatientsGroups() for group in patient.GetGroups()]
+            snapshot_groups = scan_snapshot.Snapshot(filename).GetGroups()
+            if len(snapshot_groups) != len(groups):
+                print("%s: %d series in the snapshot, %d scanned" % (name, len(snapshot_groups), len(groups)))
+                failed = True
+                continue
+            for group, snapshot_group in zip(groups, snapshot_groups):
+                errors = CheckGroup(group, snapshot_group)
+                for error in errors:
+                    print("%s, %s: %s" % (name, group.title, error))
+                failed = failed or bool(errors)
+            print("%s: %d series checked" % (name, len(groups)))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""
+Synthetic DICOM tree generator used by the benchmarks.
+
+Files are written directly as DICOM Part 10, Explicit VR Little Endian,
+so no sample data is needed. Compressed transfer syntaxes are produced
+by transcoding those files with GDCM.
+"""
+import os, struct, zlib
+
+import numpy as np
+
+EXPLICIT_VR_LE = "1.2.840.10008.1.2.1"
+RLE_LOSSLESS = "1.2.840.10008.1.2.5"
+JPEG_LS_LOSSLESS = "1.2.840.10008.1.2.4.80"
+JPEG2000_LOSSLESS = "1.2.840.10008.1.2.4.90"
+
+CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2"
+ENHANCED_CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2.1"
+
+UID_ROOT = "1.2.826.0.1.3680043.10.1042"
+
+# VRs using the 4 bytes length form in explicit VR.
+LONG_VRS = ("OB", "OD", "OF", "OL", "OW", "SQ", "UC", "UN", "UR", "UT")
+
+UNDEFINED_LENGTH = 0xFFFFFFFF
+
+
+def Element(group, element, vr, value):
+    if isinstance(value, str):
+        value = value.encode("ascii")
+    if len(value) % 2:
+        value += b"\0" if vr in ("UI", "OB") else b" "
+    if vr in LONG_VRS:
+        return struct.pack("<HH2sHI", group, element, vr.encode(), 0, len(value)) + value
+    return struct.pack("<HH2sH", group, element, vr.encode(), len(value)) + value
+
+
+def US(group, element, value):
+    return Element(group, element, "US", struct.pack("<H", value))
+
+
+def Sequence(group, element, items):
+    """
+    Sequence of undefined length made of undefined length items, the
+    way most enhanced multi-frame objects are written.
+    """
+    data = struct.pack("<HH2sHI", group, element, b"SQ", 0, UNDEFINED_LENGTH)
+    for item in items:
+        data += struct.pack("<HHI", 0xFFFE, 0xE000, UNDEFINED_LENGTH) + item
+        data += struct.pack("<HHI", 0xFFFE, 0xE00D, 0)
+    data += struct.pack("<HHI", 0xFFFE, 0xE0DD, 0)
+    return data
+
+
+def DS(values):
+    return "\\".join("%.6g" % v for v in values)
+
+
+def WriteFile(filename, patient, study, series, instance, position, pixels,
+              frame_positions=None, private_tags=0, series_number=1, orientation=(1, 0, 0, 0, 1, 0)):
+    """
+    Write a single CT image (or an enhanced multi-frame CT object if
+    frame_positions is given) holding the int16 pixels array.
+    """
+    multiframe = frame_positions is not None
+    sop_class = ENHANCED_CT_IMAGE_STORAGE if multiframe else CT_IMAGE_STORAGE
+    rows, columns = pixels.shape[-2:]
+
+    meta = b"".join([
+        Element(0x0002, 0x0001, "OB", b"\0\1"),
+        Element(0x0002, 0x0002, "UI", sop_class),
+        Element(0x0002, 0x0003, "UI", instance),
+        Element(0x0002, 0x0010, "UI", EXPLICIT_VR_LE),
+        Element(0x0002, 0x0012, "UI", UID_ROOT),
+    ])
+    meta = Element(0x0002, 0x0000, "UL", struct.pack("<I", len(meta))) + meta
+
+    elements = [
+        Element(0x0008, 0x0005, "CS", "ISO_IR 100"),
+        Element(0x0008, 0x0008, "CS", "ORIGINAL\\PRIMARY\\AXIAL"),
+        Element(0x0008, 0x0016, "UI", sop_class),
+        Element(0x0008, 0x0018, "UI", instance),
+        Element(0x0008, 0x0020, "DA", "20240101"),
+        Element(0x0008, 0x0030, "TM", "120000"),
+        Element(0x0008, 0x0050, "SH", "ACC%s" % study.rsplit(".", 1)[-1]),
+        Element(0x0008, 0x0060, "CS", "CT"),
+        Element(0x0008, 0x0070, "LO", "SYNTHETIC"),
+        Element(0x0008, 0x103E, "LO", "SERIES %d" % series_number),
+        Element(0x0010, 0x0010, "PN", "PATIENT^%s" % patient),
+        Element(0x0010, 0x0020, "LO", "ID%s" % patient),
+        Element(0x0018, 0x0050, "DS", "1"),
+        Element(0x0020, 0x000D, "UI", study),
+        Element(0x0020, 0x000E, "UI", series),
+        Element(0x0020, 0x0010, "SH", study.rsplit(".", 1)[-1]),
+        Element(0x0020, 0x0011, "IS", str(series_number)),
+        Element(0x0020, 0x0013, "IS", instance.rsplit(".", 1)[-1]),
+        Element(0x0020, 0x0032, "DS", DS(position)),
+        Element(0x0020, 0x0037, "DS", DS(orientation)),
+        Element(0x0020, 0x0052, "UI", study + ".0"),
+    ]
+
+    # Private block (0x0009,0x0010) "SYNTHETIC" with a few opaque values.
+    if private_tags:
+        elements.append(Element(0x0009, 0x0010, "LO", "SYNTHETIC"))
+        for i in range(min(private_tags, 0xFF)):
+            elements.append(Element(0x0009, 0x1000 + i, "UN", os.urandom(64)))
+
+    elements += [
+        US(0x0028, 0x0002, 1),
+        Element(0x0028, 0x0004, "CS", "MONOCHROME2"),
+    ]
+    if multiframe:
+        elements.append(Element(0x0028, 0x0008, "IS", str(len(frame_positions))))
+    elements += [
+        US(0x0028, 0x0010, rows),
+        US(0x0028, 0x0011, columns),
+        Element(0x0028, 0x0030, "DS", "0.5\\0.5"),
+        US(0x0028, 0x0100, 16),
+        US(0x0028, 0x0101, 16),
+        US(0x0028, 0x0102, 15),
+        US(0x0028, 0x0103, 1),
+        Element(0x0028, 0x1050, "DS", "40"),
+        Element(0x0028, 0x1051, "DS", "400"),
+        Element(0x0028, 0x1052, "DS", "-1024"),
+        Element(0x0028, 0x1053, "DS", "1"),
+    ]
+    if multiframe:
+        shared = Sequence(0x0020, 0x9116, [Element(0x0020, 0x0037, "DS", DS(orientation))])
+        shared += Sequence(0x0028, 0x9110, [
+            Element(0x0018, 0x0050, "DS", "1"),
+            Element(0x0028, 0x0030, "DS", "0.5\\0.5"),
+        ])
+        elements.append(Sequence(0x5200, 0x9229, [shared]))
+        per_frame = [
+            Sequence(0x0020, 0x9113, [Element(0x0020, 0x0032, "DS", DS(p))])
+            for p in frame_positions
+        ]
+        elements.append(Sequence(0x5200, 0x9230, per_frame))
+    elements.append(Element(0x7FE0, 0x0010, "OW", pixels.astype("<i2").tobytes()))
+
+    with open(filename, "wb") as f:
+        f.write(b"\0" * 128 + b"DICM" + meta + b"".join(elements))
+
+
+def Transcode(filename, transfer_syntax):
+    """
+    Rewrite filename in place using transfer_syntax (needs GDCM).
+    """
+    import gdcm
+
+    ts = {
+        RLE_LOSSLESS: gdcm.TransferSyntax.RLELossless,
+        JPEG_LS_LOSSLESS: gdcm.TransferSyntax.JPEGLSLossless,
+        JPEG2000_LOSSLESS: gdcm.TransferSyntax.JPEG2000Lossless,
+    }[transfer_syntax]
+
+    reader = gdcm.ImageReader()
+    reader.SetFileName(filename)
+    if not reader.Read():
+        raise IOError("Could not read %s" % filename)
+    change = gdcm.ImageChangeTransferSyntax()
+    change.SetTransferSyntax(gdcm.TransferSyntax(ts))
+    change.SetInput(reader.GetImage())
+    if not change.Change():
+        raise IOError("Could not transcode %s" % filename)
+
+    writer = gdcm.ImageWriter()
+    writer.SetFileName(filename)
+    writer.SetFile(reader.GetFile())
+    writer.SetImage(change.GetOutput())
+    if not writer.Write():
+        raise IOError("Could not write %s" % filename)
+
+
+def GenerateTree(directory, patients=1, studies=1, series=2, slices=64, rows=128, columns=128,
+                 frames=1, duplicates=0, private_tags=0, transfer_syntax=EXPLICIT_VR_LE,
+                 spacing=1.25, seed=0):
+    """
+    Write a patient/study/series tree of synthetic CT files into
+    directory and return the list of written file names.
+
+    With frames > 1 every series is stored as enhanced multi-frame
+    objects of `frames` frames each (slices is then the total number of
+    frames per series). duplicates is the number of extra files per
+    series that repeat an existing slice position. Files are written in
+    shuffled order, as they usually come out of a PACS export.
+
+    UIDs and patient IDs include a number derived from the path of
+    directory, so that trees generated in different directories don't
+    merge into the same patients and series when scanned together.
+    """
+    rng = np.random.default_rng(seed)
+    tree = zlib.crc32(os.path.abspath(directory).encode("utf-8"))
+    y, x = np.mgrid[0:rows, 0:columns]
+    base = ((x - columns / 2) ** 2 + (y - rows / 2) ** 2 < (min(rows, columns) / 3) ** 2)
+    base = base.astype(np.int16) * 1000
+
+    filenames = []
+    for p in range(patients):
+        patient = "%d-%d" % (tree, p + 1)
+        for st in range(studies):
+            study = "%s.%d.%d.%d" % (UID_ROOT, tree, p + 1, st + 1)
+            for se in range(series):
+                series_uid = "%s.%d" % (study, se + 1)
+                folder = os.path.join(directory, "patient%d" % p, "study%d" % st, "series%d" % se)
+                os.makedirs(folder, exist_ok=True)
+
+                positions = [(0.0, 0.0, z * spacing) for z in range(slices)]
+                positions += [positions[i] for i in rng.integers(0, slices, duplicates)]
+                if frames > 1:
+                    chunks = [positions[i : i + frames] for i in range(0, len(positions), frames)]
+                else:
+                    chunks = [[pos] for pos in positions]
+
+                for n in rng.permutation(len(chunks)):
+                    chunk = chunks[n]
+                    pixels = np.stack([base + int(pos[2]) for pos in chunk])
+                    if frames == 1:
+                        pixels = pixels[0]
+                    instance = "%s.%d" % (series_uid, n + 1)
+                    filename = os.path.join(folder, "IM%06d" % (n + 1))
+                    WriteFile(
+                        filename, patient, study, series_uid, instance, chunk[0], pixels,
+                        frame_positions=chunk if frames > 1 else None,
+                        private_tags=private_tags, series_number=se + 1,
+                    )
+                    if transfer_syntax != EXPLICIT_VR_LE:
+                        Transcode(filename, transfer_syntax)
+                    filenames.append(filename)
+    return filenames
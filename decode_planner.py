@@ -0,0 +1,297 @@
+"""
+Decode planning of scanned series: the transfer syntax of every slice
+is known from the scan, so the cost of loading each series can be
+estimated before any pixel is decoded, the fastest available decoder
+chosen per file and the expensive series given more workers.
+
+    planner = decode_planner.DecodePlanner()
+    planner.Calibrate(dicoms)  # optional, measures the costs here
+    plans = planner.Plan(groups, workers=8)
+    for plan, volume, positions in planner.Execute(plans):
+        ...
+"""
+import collections, concurrent.futures, os, time
+
+import numpy as np
+
+import dicom_volume as dicom_volume
+
+# Decoders, from the cheapest.
+DECODER_DIRECT = "direct"  # read at the pixel offset recorded by the scan
+DECODER_MAPPED = "mapped"  # memory mapped, pixel data searched for
+DECODER_CACHE = "cache"  # already decoded in a transcode_cache.TranscodeCache
+DECODER_GDCM = "gdcm"  # decoded by GDCM
+
+IMPLICIT_VR_LE = "1.2.840.10008.1.2"
+EXPLICIT_VR_LE = "1.2.840.10008.1.2.1"
+EXPLICIT_VR_BE = "1.2.840.10008.1.2.2"
+RLE_LOSSLESS = "1.2.840.10008.1.2.5"
+JPEG_BASELINE = "1.2.840.10008.1.2.4.50"
+JPEG_EXTENDED = "1.2.840.10008.1.2.4.51"
+JPEG_LOSSLESS = "1.2.840.10008.1.2.4.57"
+JPEG_LOSSLESS_SV1 = "1.2.840.10008.1.2.4.70"
+JPEG_LS_LOSSLESS = "1.2.840.10008.1.2.4.80"
+JPEG_LS_NEAR_LOSSLESS = "1.2.840.10008.1.2.4.81"
+JPEG2000_LOSSLESS = "1.2.840.10008.1.2.4.90"
+JPEG2000 = "1.2.840.10008.1.2.4.91"
+
+# Estimated decoding time in seconds per megapixel (10^6 pixels): of
+# the direct and mapped reads, whatever the syntax, and of GDCM per
+# transfer syntax. Measured on 512x512 CT slices, can be replaced by
+# DecodePlanner.Calibrate.
+DEFAULT_COSTS = {
+    DECODER_DIRECT: 0.0002,
+    DECODER_MAPPED: 0.0005,
+    DECODER_CACHE: 0.001,
+    (DECODER_GDCM, IMPLICIT_VR_LE): 0.007,
+    (DECODER_GDCM, EXPLICIT_VR_LE): 0.007,
+    (DECODER_GDCM, EXPLICIT_VR_BE): 0.01,
+    (DECODER_GDCM, RLE_LOSSLESS): 0.05,
+    (DECODER_GDCM, JPEG_BASELINE): 0.01,
+    (DECODER_GDCM, JPEG_EXTENDED): 0.01,
+    (DECODER_GDCM, JPEG_LOSSLESS): 0.03,
+    (DECODER_GDCM, JPEG_LOSSLESS_SV1): 0.03,
+    (DECODER_GDCM, JPEG_LS_LOSSLESS): 0.03,
+    (DECODER_GDCM, JPEG_LS_NEAR_LOSSLESS): 0.03,
+    (DECODER_GDCM, JPEG2000_LOSSLESS): 0.08,
+    (DECODER_GDCM, JPEG2000): 0.08,
+}
+# Cost of a transfer syntax missing above.
+UNKNOWN_COST = 0.05
+# Time spent per file whatever its size (opening, parsing), seconds.
+FILE_COST = 0.0005
+
+# Plan of a DicomGroup: decoders is {(decoder, transfer syntax): number
+# of files}, files {file: decoder}, cost the estimated decoding time (s)
+# with one worker and workers the number of slabs decoded at once.
+SeriesPlan = collections.namedtuple(
+    "SeriesPlan", ["group", "decoders", "files", "nfiles", "nframes", "megapixels", "cost", "workers"]
+)
+
+
+def GetTransferSyntaxes(group):
+    """
+    Return {transfer syntax: number of files} of a DicomGroup.
+    """
+    frames, positions = group.GetSortedFrames()
+    files = {dicom.image.file: dicom.image.transfer_syntax for dicom, frame in frames}
+    return dict(collections.Counter(files.values()))
+
+
+class DecodePlanner:
+    """
+    Estimate and schedule the decoding of series, see the module
+    documentation. costs updates DEFAULT_COSTS. Compressed files found
+    in cache (a transcode_cache.TranscodeCache) are read from it.
+    """
+    def __init__(self, costs=None, cache=None):
+        self.costs = dict(DEFAULT_COSTS)
+        if costs:
+            self.costs.update(costs)
+        self.cache = cache
+
+    def GetDecoder(self, dicom):
+        """
+        Return the fastest decoder available for the file of dicom.
+        """
+        if dicom_volume.GetDirectOffset(dicom) is not None:
+            return DECODER_DIRECT
+        if (dicom.image.transfer_syntax in dicom_volume.UNCOMPRESSED_TRANSFER_SYNTAXES
+                and dicom.image.samples_per_pixel == 1):
+            return DECODER_MAPPED
+        if self.cache is not None and self.cache.Contains(dicom.image.sop_instance_uid, dicom.image.file):
+            return DECODER_CACHE
+        return DECODER_GDCM
+
+    def _GetRate(self, decoder, transfer_syntax):
+        if decoder == DECODER_GDCM:
+            return self.costs.get((decoder, transfer_syntax), UNKNOWN_COST)
+        return self.costs[decoder]
+
+    def GetCost(self, dicom, decoder=None):
+        """
+        Return the estimated time (s) to decode the file of dicom.
+        """
+        decoder = decoder or self.GetDecoder(dicom)
+        columns, rows = dicom.image.size
+        pixels = columns * rows * max(1, dicom.image.number_of_frames) * max(1, dicom.image.samples_per_pixel or 1)
+        return FILE_COST + pixels / 1e6 * self._GetRate(decoder, dicom.image.transfer_syntax)
+
+    def Calibrate(self, dicoms, samples=4):
+        """
+        Decode up to samples files of dicoms per (decoder, transfer
+        syntax) and use the measured times as costs. Return the
+        measured costs.
+        """
+        by_kind = collections.defaultdict(list)
+        for dicom in dicoms:
+            decoder = self.GetDecoder(dicom)
+            key = (decoder, dicom.image.transfer_syntax)
+            if len(by_kind[key]) < samples:
+                by_kind[key].append(dicom)
+
+        measured = {}
+        for (decoder, transfer_syntax), sample in by_kind.items():
+            seconds = 0.0
+            megapixels = 0.0
+            for dicom in sample:
+                t0 = time.perf_counter()
+                data = self.Decode(dicom, decoder)
+                seconds += time.perf_counter() - t0
+                megapixels += data.size / 1e6
+            if megapixels:
+                # FILE_COST may exceed the time of cheap reads of small
+                # files, keep a tenth of it for the pixels.
+                rate = max(seconds - FILE_COST * len(sample), seconds / 10) / megapixels
+                measured[(decoder, transfer_syntax) if decoder == DECODER_GDCM else decoder] = rate
+        self.costs.update(measured)
+        return measured
+
+    def Read(self, dicom, decoder=None):
+        """
+        Return every frame of the file of dicom, read with decoder:
+        mapped and cached files may be returned as read only memory
+        maps. Falls back to GDCM if they can't be read that way.
+        """
+        decoder = decoder or self.GetDecoder(dicom)
+        if decoder == DECODER_DIRECT:
+            shape = (max(1, dicom.image.number_of_frames),) + dicom_volume.GetFrameShape(dicom)
+            data = np.empty(shape, dicom_volume.GetDtype(dicom))
+            dicom_volume.ReadInto(dicom.image.file, dicom_volume.GetDirectOffset(dicom), data)
+            return data
+        if decoder == DECODER_MAPPED:
+            data = dicom_volume.MapFrames(dicom)
+            if data is not None:
+                return data
+        if decoder == DECODER_CACHE:
+            data = self.cache.GetFrames(dicom)
+            if data is not None:
+                return data
+        return dicom_volume.ReadFrames(dicom.image.file)
+
+    def Decode(self, dicom, decoder=None):
+        """
+        Return every frame of the file of dicom, decoded with decoder.
+        """
+        data = self.Read(dicom, decoder)
+        return np.array(data) if isinstance(data, np.memmap) else data
+
+    def AssembleFrames(self, plan, frames, out):
+        """
+        Assemble frames, (dicom, frame number) of the group of plan, into
+        out like dicom_volume.AssembleFrames, reading every file with
+        the decoder plan.files chose for it.
+        """
+        for filename, (dicom, dest, src) in dicom_volume.GroupFrames(frames).items():
+            decoder = plan.files[filename]
+            if decoder == DECODER_DIRECT and dicom_volume.CanReadInto(dicom, dest, out):
+                dicom_volume.ReadInto(filename, dicom_volume.GetDirectOffset(dicom), out[dest[0]])
+                continue
+            data = self.Read(dicom, decoder)
+            out[dest] = data[src]
+            del data
+        return out
+
+    def PlanGroup(self, group):
+        """
+        Return the SeriesPlan of a DicomGroup, with a single worker.
+        """
+        frames, positions = group.GetSortedFrames()
+        dicoms = {}
+        for dicom, frame in frames:
+            dicoms.setdefault(dicom.image.file, dicom)
+        files = {}
+        decoders = collections.Counter()
+        cost = 0.0
+        megapixels = 0.0
+        for filename, dicom in dicoms.items():
+            decoder = files[filename] = self.GetDecoder(dicom)
+            decoders[(decoder, dicom.image.transfer_syntax)] += 1
+            cost += self.GetCost(dicom, decoder)
+            columns, rows = dicom.image.size
+            megapixels += columns * rows * max(1, dicom.image.number_of_frames) / 1e6
+        return SeriesPlan(group, dict(decoders), files, len(files), len(frames), megapixels, cost, 1)
+
+    def Plan(self, groups, workers=None):
+        """
+        Return the SeriesPlan of every DicomGroup of groups, the most
+        expensive first. workers (the cpu count by default) are shared
+        in proportion to the costs, with largest remainder rounding, so
+        that the shares sum to workers. Every series gets at least one,
+        so with more series than workers the sum is the number of
+        series; series of multi-frame files get one, since a file can't
+        be split between workers, and no series more than its files.
+        """
+        workers = workers or os.cpu_count() or 1
+        plans = [self.PlanGroup(group) for group in groups]
+        total = sum(plan.cost for plan in plans) or 1.0
+        quotas = [workers * plan.cost / total for plan in plans]
+        limits = [1 if plan.nframes != plan.nfiles else max(1, min(plan.nfiles, workers)) for plan in plans]
+        shares = [max(1, min(int(quota), limit)) for quota, limit in zip(quotas, limits)]
+        # Workers left go to the series furthest below their quota, the
+        # ones in excess (given for the minimum of one) are taken back
+        # from the series furthest above.
+        while sum(shares) < workers:
+            candidates = [n for n in range(len(plans)) if shares[n] < limits[n]]
+            if not candidates:
+                break
+            shares[max(candidates, key=lambda n: quotas[n] - shares[n])] += 1
+        while sum(shares) > workers:
+            candidates = [n for n in range(len(plans)) if shares[n] > 1]
+            if not candidates:
+                break
+            shares[max(candidates, key=lambda n: shares[n] - quotas[n])] -= 1
+        plans = [plan._replace(workers=share) for plan, share in zip(plans, shares)]
+        plans.sort(key=lambda plan: plan.cost, reverse=True)
+        return plans
+
+    def _IterSlabs(self, plans, series):
+        """
+        Yield (index, plan, frames, out) of the slabs of plans, in
+        order. The volume of a series is allocated, and its entry
+        [plan, volume, positions, slabs left] set in series, when its
+        first slab is taken.
+        """
+        for index, plan in enumerate(plans):
+            frames, positions = plan.group.GetSortedFrames()
+            volume = np.empty((len(frames),) + dicom_volume.GetFrameShape(frames[0][0]),
+                              dicom_volume.GetDtype(frames[0][0]))
+            bounds = np.linspace(0, len(frames), plan.workers + 1).astype(int)
+            slabs = [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+            series[index] = [plan, volume, positions, len(slabs)]
+            for start, stop in slabs:
+                yield index, plan, frames[start:stop], volume[start:stop]
+
+    def Execute(self, plans, workers=None):
+        """
+        Assemble the series of plans, with the decoders they chose, in a
+        pool of workers threads, each one split in plan.workers slabs,
+        expensive series first. Yield (plan, volume, positions) as
+        series are done. workers defaults to the sum of the
+        plan.workers, the workers given to Plan.
+
+        Slabs are submitted in plan order, at most workers at a time,
+        and the volume of a series is only allocated when its first
+        slab is submitted: the series held at once are the ones being
+        decoded, not all of plans.
+        """
+        workers = workers or sum(plan.workers for plan in plans) or 1
+        series = {}  # plan index: [plan, volume, positions, slabs left]
+        slabs = self._IterSlabs(plans, series)
+        with concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="decode") as executor:
+            pending = {}  # future: plan index
+            while True:
+                for index, plan, frames, out in slabs:
+                    pending[executor.submit(self.AssembleFrames, plan, frames, out)] = index
+                    if len(pending) >= workers:
+                        break
+                if not pending:
+                    break
+                done, not_done = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    index = pending.pop(future)
+                    future.result()
+                    series[index][3] -= 1
+                    if not series[index][3]:
+                        plan, volume, positions, count = series.pop(index)
+                        yield plan, volume, positions
@@ -1,4 +1,4 @@
-import time, gdcm
+import array, collections, sys, threading, time, gdcm
 
 import utils as utils
 import constants as const
@@ -20,6 +20,9 @@ class Acquisition(object):
         self.institution = parser.GetInstitutionName()
         self.date = parser.GetAcquisitionDate()
         self.accession_number = parser.GetAccessionNumber()
+        self.study_date = parser.GetStudyDate()
+        self.study_instance_uid = parser.GetStudyInstanceUID()
+        self.series_instance_uid = parser.GetSeriesInstanceUID()
         self.series_description = parser.GetSeriesDescription()
         self.time = parser.GetAcquisitionTime()
         self.protocol_name = parser.GetProtocolName()
@@ -45,8 +48,16 @@ class Image(object):
     def SetParser(self, parser):
         self.level = parser.GetImageWindowLevel()
         self.window = parser.GetImageWindowWidth()
+        self.voi_lut_function = parser.GetVOILUTFunction()
 
         self.position = parser.GetImagePosition()
+
+        # Enhanced multi-frame images: geometry of every frame
+        self.frame_positions = parser.GetFramePositions()
+        self.frame_orientations = parser.GetFrameOrientations()
+        if not (self.position) and self.frame_positions is not None:
+            self.position = [float(value) for value in self.frame_positions[0]]
+
         if not (self.position):
             self.position = [1, 1, 1]
 
@@ -59,9 +70,20 @@ class Image(object):
         self.size = (parser.GetDimensionX(), parser.GetDimensionY())
         # self.imagedata = parser.GetImageData()
         self.bits_allocad = parser._GetBitsAllocated()
+        self.bits_stored = parser.GetBitsStored()
+        self.pixel_representation = parser._GetPixelRepresentation()
+        self.transfer_syntax = parser.GetTransferSyntaxUID()
+        self.sop_instance_uid = parser.GetSOPInstanceUID()
+        # Where the Pixel Data value is in the file. Only recorded by
+        # scans with fast=True (dicom_header), None for headers read by
+        # GDCM: dicom_volume then searches the file for it.
+        self.pixel_data_offset = parser.GetImageOffset()
+        self.pixel_data_length = parser.GetPixelDataLength()
 
         self.number_of_frames = parser.GetNumberOfFrames()
         self.samples_per_pixel = parser.GetImageSamplesPerPixel()
+        self.rescale_slope = parser.GetRescaleSlope()
+        self.rescale_intercept = parser.GetRescaleIntercept()
 
         if parser.GetImageThickness():
             self.spacing.append(parser.GetImageThickness())
@@ -92,6 +114,291 @@ class Dicom(object):
         self.acquisition = Acquisition()
         self.acquisition.SetParser(self.parser)
 
+# Attributes a DicomProxy keeps, enough to group, sort and assemble
+# slices without reading the header again.
+PROXY_IMAGE_ATTRIBUTES = (
+    "file", "position", "frame_positions", "frame_orientations", "orientation_label", "number",
+    "number_of_frames", "type", "size", "spacing", "bits_allocad", "bits_stored",
+    "pixel_representation", "samples_per_pixel", "transfer_syntax", "rescale_slope", "rescale_intercept",
+    "pixel_data_offset", "pixel_data_length", "sop_instance_uid", "voi_lut_function",
+)
+PROXY_PATIENT_ATTRIBUTES = ("name", "id")
+PROXY_ACQUISITION_ATTRIBUTES = (
+    "id_study", "serie_number", "series_description", "patient_orientation", "tilt", "modality",
+    "accession_number", "study_date", "study_instance_uid", "series_instance_uid", "frame_of_reference_uid",
+)
+# Image attributes that change from slice to slice, kept in the arrays
+# of a ProxyTable. The others are shared by the slices with the same
+# values.
+PROXY_STRING_COLUMNS = ("file", "sop_instance_uid")
+PROXY_INT_COLUMNS = ("number", "pixel_data_offset")
+PROXY_POSITION_COLUMN = "position"
+
+# Unset kept attribute, read from the header when asked for.
+_MISSING = object()
+# None in the int columns (eg. Pixel Data offsets of GDCM scans).
+_INT_NONE = -2**63
+
+def _Intern(value):
+    if isinstance(value, str):
+        return sys.intern(value)
+    if isinstance(value, list):
+        return tuple(_Intern(item) for item in value)
+    return value
+
+class HeaderCache(object):
+    """
+    Least recently used cache of the dicom.Dicom of size files, read
+    with load(filepath) when missing. Thread safe.
+    """
+    def __init__(self, load, size=64):
+        self.load = load
+        self.size = size
+        self.dicoms = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def Get(self, filepath):
+        with self.lock:
+            if filepath in self.dicoms:
+                self.hits += 1
+                self.dicoms.move_to_end(filepath)
+                return self.dicoms[filepath]
+            self.misses += 1
+        dcm = self.load(filepath)
+        if dcm is None:
+            raise IOError("Could not read the header of %s" % filepath)
+        with self.lock:
+            self.dicoms[filepath] = dcm
+            while len(self.dicoms) > self.size:
+                self.dicoms.popitem(last=False)
+        return dcm
+
+    def Clear(self):
+        with self.lock:
+            self.dicoms.clear()
+
+class ProxyTable(object):
+    """
+    Kept attributes (see PROXY_*_ATTRIBUTES) of the DicomProxy objects
+    of a scan, by columns: the ones changing from slice to slice in
+    arrays (strings as UTF-8 bytes), the others as a row (tuple) shared
+    by all the slices with the same values, usually a whole series.
+    Values not fitting their array (eg. "" for an unset number) are kept
+    aside. Headers are read again through cache, a HeaderCache.
+    """
+    def __init__(self, cache):
+        self.cache = cache
+        self.lock = threading.Lock()
+        # name: (bytes, offsets), the string of slice n being
+        # bytes[offsets[n]:offsets[n + 1]]
+        self.strings = {name: (bytearray(), array.array("q", [0])) for name in PROXY_STRING_COLUMNS}
+        self.ints = {name: array.array("q") for name in PROXY_INT_COLUMNS}
+        self.positions = array.array("d")
+        self.others = {}  # (name, slice): value
+        self.rows = array.array("l")  # slice: row
+        self.row_values = []
+        self.row_indexes = {}  # row values: row
+        # (part, name): position in the rows
+        self.row_columns = {}
+        for part, names in (
+            ("image", PROXY_IMAGE_ATTRIBUTES),
+            ("patient", PROXY_PATIENT_ATTRIBUTES),
+            ("acquisition", PROXY_ACQUISITION_ATTRIBUTES),
+        ):
+            for name in names:
+                if part != "image" or name not in PROXY_STRING_COLUMNS + PROXY_INT_COLUMNS + (PROXY_POSITION_COLUMN,):
+                    self.row_columns[(part, name)] = len(self.row_columns)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _GetRow(self, values):
+        try:
+            return self.row_indexes.setdefault(values, len(self.row_values))
+        except TypeError:
+            # Unhashable, not shared.
+            return len(self.row_values)
+
+    def Add(self, dcm):
+        """
+        Keep the attributes of dcm, a dicom.Dicom, and return its
+        DicomProxy.
+        """
+        values = [_MISSING] * len(self.row_columns)
+        for (part, name), n in self.row_columns.items():
+            values[n] = _Intern(getattr(getattr(dcm, part), name, _MISSING))
+        if values[self.row_columns[("acquisition", "frame_of_reference_uid")]] is _MISSING:
+            # As the groupers read it, so it's never read again.
+            values[self.row_columns[("acquisition", "frame_of_reference_uid")]] = sys.intern(
+                dcm.parser.GetFrameReferenceUID().strip(" \0")
+            )
+        values = tuple(values)
+
+        with self.lock:
+            index = len(self.rows)
+            row = self._GetRow(values)
+            if row == len(self.row_values):
+                self.row_values.append(values)
+            self.rows.append(row)
+            for name in PROXY_STRING_COLUMNS:
+                self._SetString(index, name, getattr(dcm.image, name, _MISSING), append=True)
+            for name in PROXY_INT_COLUMNS:
+                self.ints[name].append(0)
+                self._SetInt(index, name, getattr(dcm.image, name, _MISSING))
+            self.positions.extend((0.0, 0.0, 0.0))
+            self._SetPosition(index, getattr(dcm.image, PROXY_POSITION_COLUMN, _MISSING))
+        return DicomProxy(self, index)
+
+    def _SetString(self, index, name, value, append=False):
+        if append:
+            data, offsets = self.strings[name]
+            if isinstance(value, str):
+                data.extend(value.encode("utf-8", "surrogateescape"))
+            offsets.append(len(data))
+        if not append or not isinstance(value, str):
+            # Strings can't be replaced in the bytes.
+            self.others[(name, index)] = value
+
+    def _SetInt(self, index, name, value):
+        self.others.pop((name, index), None)
+        if value is None:
+            self.ints[name][index] = _INT_NONE
+        elif type(value) is int and _INT_NONE < value < 2**63:
+            self.ints[name][index] = value
+        else:
+            self.others[(name, index)] = value
+
+    def _SetPosition(self, index, value):
+        self.others.pop((PROXY_POSITION_COLUMN, index), None)
+        try:
+            if len(value) == 3 and not any(isinstance(item, bool) for item in value):
+                self.positions[3 * index:3 * index + 3] = array.array("d", [float(item) for item in value])
+                return
+        except (TypeError, ValueError):
+            pass
+        self.others[(PROXY_POSITION_COLUMN, index)] = value
+
+    def Get(self, index, part, name):
+        """
+        Return the kept attribute name of part ("image", "patient" or
+        "acquisition") of slice index. Raise KeyError if it's not kept.
+        """
+        if (part, name) in self.row_columns:
+            value = self.row_values[self.rows[index]][self.row_columns[(part, name)]]
+        elif part != "image":
+            raise KeyError(name)
+        elif (name, index) in self.others:
+            value = self.others[(name, index)]
+        elif name in self.strings:
+            data, offsets = self.strings[name]
+            value = data[offsets[index]:offsets[index + 1]].decode("utf-8", "surrogateescape")
+        elif name in self.ints:
+            value = self.ints[name][index]
+            if value == _INT_NONE:
+                value = None
+        elif name == PROXY_POSITION_COLUMN:
+            value = tuple(self.positions[3 * index:3 * index + 3])
+        else:
+            raise KeyError(name)
+        if value is _MISSING:
+            raise KeyError(name)
+        return value
+
+    def Set(self, index, part, name, value):
+        """
+        Change a kept attribute of slice index, see Get. Raise
+        AttributeError if it's not kept.
+        """
+        value = _Intern(value)
+        with self.lock:
+            if (part, name) in self.row_columns:
+                n = self.row_columns[(part, name)]
+                values = self.row_values[self.rows[index]]
+                if type(values[n]) is type(value) and values[n] == value:
+                    return
+                values = values[:n] + (value,) + values[n + 1:]
+                row = self._GetRow(values)
+                if row == len(self.row_values):
+                    self.row_values.append(values)
+                self.rows[index] = row
+            elif part == "image" and name in self.strings:
+                self._SetString(index, name, value)
+            elif part == "image" and name in self.ints:
+                self._SetInt(index, name, value)
+            elif part == "image" and name == PROXY_POSITION_COLUMN:
+                self._SetPosition(index, value)
+            else:
+                raise AttributeError("%s.%s isn't kept by proxies" % (part, name))
+
+class _ProxyPart(object):
+    """
+    View of the image, patient or acquisition of a DicomProxy: kept
+    attributes come from its ProxyTable, any other one from the full
+    header.
+    """
+    __slots__ = ("_proxy", "_part")
+
+    def __init__(self, proxy, part):
+        object.__setattr__(self, "_proxy", proxy)
+        object.__setattr__(self, "_part", part)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        proxy = self._proxy
+        try:
+            return proxy._table.Get(proxy._index, self._part, name)
+        except KeyError:
+            return getattr(getattr(proxy.GetDicom(), self._part), name)
+
+    def __setattr__(self, name, value):
+        proxy = self._proxy
+        proxy._table.Set(proxy._index, self._part, name, value)
+
+class DicomProxy(object):
+    """
+    Lightweight stand-in of a dicom.Dicom, used in place of it by the
+    groupers, made by ProxyTable.Add. It's only a slice index in the
+    table, which keeps the attributes needed to group, sort and
+    assemble the slices (see PROXY_*_ATTRIBUTES) and drops the parsed
+    tags. Any other attribute, or the parser, is taken from the header
+    read again through the table cache (a HeaderCache), so only the
+    most recently used headers are resident.
+    """
+    __slots__ = ("_table", "_index")
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+
+    @property
+    def image(self):
+        return _ProxyPart(self, "image")
+
+    @property
+    def patient(self):
+        return _ProxyPart(self, "patient")
+
+    @property
+    def acquisition(self):
+        return _ProxyPart(self, "acquisition")
+
+    @property
+    def cache(self):
+        return self._table.cache
+
+    def GetDicom(self):
+        """
+        Return the full dicom.Dicom, reading its header if it's not in
+        the cache.
+        """
+        return self._table.cache.Get(self.image.file)
+
+    @property
+    def parser(self):
+        return self.GetDicom().parser
+
 class Parser:
     """
     Medical image parser. Used to parse medical image tags
@@ -397,19 +704,29 @@ class Parser:
 
     def GetImageOffset(self):
         """
-        Return image pixel offset (memory position).
-        Return "" if field is not defined.
+        Return the offset (bytes from the start of the file) of the
+        value of the Pixel Data element, as found when the header was
+        parsed by dicom_header (scans with fast=True). Return None if
+        not known, as for headers read by GDCM.
 
         DICOM standard tag (0x7fe0, 0x0010) was used.
         """
         try:
-            data = self.data_image[str(0x7FE0)][str(0x0010)]
+            return self.data_image["invesalius"]["pixel_data_offset"]
         except KeyError:
-            return ""
+            return None
 
-        if data:
-            return int(data.split(":")[1])
-        return ""
+    def GetPixelDataLength(self):
+        """
+        Return the length in bytes of the Pixel Data value, -1 if it's
+        encapsulated (undefined length). Return None if not known.
+
+        DICOM standard tag (0x7fe0, 0x0010) was used.
+        """
+        try:
+            return self.data_image["invesalius"]["pixel_data_length"]
+        except KeyError:
+            return None
 
     def GetImageSeriesNumber(self):
         """
@@ -813,18 +1130,36 @@ class Parser:
     
     def GetAccessionNumber(self):
         """
-        Return integer related to acession number
+        Return string containing the accession number (it's not always
+        a number).
+        Return "" if field is not defined.
 
         DICOM standard tag (0x0008, 0x0050) was used.
         """
-        # data = self.data_image[0x008][0x050]
+        try:
+            data = self.data_image[str(0x0008)][str(0x0050)]
+        except KeyError:
+            return ""
+
+        if data:
+            return data.strip(" \0")
         return ""
+
+    def GetStudyDate(self):
+        """
+        Return string containing the study date as stored, using the
+        format "yyyymmdd" (so dates sort as strings).
+        Return "" if field is not defined.
+
+        DICOM standard tag (0x0008, 0x0020) was used.
+        """
+        try:
+            data = self.data_image[str(0x0008)][str(0x0020)]
+        except KeyError:
+            return ""
+
         if data:
-            try:
-                value = int(str(data))
-            except ValueError:  # Problem in the other\iCatDanielaProjeto
-                value = 0
-            return value
+            return data.strip(" \0")
         return ""
 
     def GetImagePatientOrientation(self):
@@ -939,12 +1274,69 @@ class Parser:
 
         Critical DICOM tag (0x0028,0x0101). Cannot be edited.
         """
-        tag = gdcm.Tag(0x0028, 0x0101)
-        sf = gdcm.StringFilter()
-        sf.SetFile(self.gdcm_reader.GetFile())
-        res = sf.ToStringPair(tag)
-        if res[1]:
-            return int(res[1])
+        try:
+            data = self.data_image[str(0x0028)][str(0x0101)]
+        except KeyError:
+            return ""
+
+        if data:
+            return int(data)
+        return ""
+
+    def GetRescaleSlope(self):
+        """
+        Return the rescale slope (float) of the modality LUT, used to
+        convert stored pixel values to output units (eg. Hounsfield).
+        Return 1.0 if not defined.
+
+        DICOM standard tag (0x0028,0x1053) was used.
+        """
+        try:
+            data = self.data_image[str(0x0028)][str(0x1053)]
+        except KeyError:
+            return 1.0
+
+        if data:
+            try:
+                return float(data.replace(",", "."))
+            except ValueError:
+                return 1.0
+        return 1.0
+
+    def GetRescaleIntercept(self):
+        """
+        Return the rescale intercept (float) of the modality LUT.
+        Return 0.0 if not defined.
+
+        DICOM standard tag (0x0028,0x1052) was used.
+        """
+        try:
+            data = self.data_image[str(0x0028)][str(0x1052)]
+        except KeyError:
+            return 0.0
+
+        if data:
+            try:
+                return float(data.replace(",", "."))
+            except ValueError:
+                return 0.0
+        return 0.0
+
+    def GetVOILUTFunction(self):
+        """
+        Return the VOI LUT function (string) to be used with the window
+        center and width: "LINEAR", "LINEAR_EXACT" or "SIGMOID".
+        Return "" if not defined (LINEAR must be assumed).
+
+        DICOM standard tag (0x0028,0x1056) was used.
+        """
+        try:
+            data = self.data_image[str(0x0028)][str(0x1056)]
+        except KeyError:
+            return ""
+
+        if data:
+            return data.strip()
         return ""
 
     def GetHighBit(self):
@@ -1055,6 +1447,23 @@ class Parser:
             return data
         return ""
 
+    def GetSeriesInstanceUID(self):
+        """
+        Return Series Instance UID (string), related to series being
+        analized.
+        Return "" if field is not defined.
+
+        Critical DICOM tag (0x0020, 0x000E). Cannot be edited.
+        """
+        try:
+            data = self.data_image[str(0x0020)][str(0x000E)]
+        except KeyError:
+            return ""
+
+        if data:
+            return data
+        return ""
+
     def GetPatientOccupation(self):
         """
         Return occupation of the patient (string).
@@ -1080,12 +1489,13 @@ class Parser:
 
         DICOM standard tag (0x0028, 0x0103) was used.
         """
-        tag = gdcm.Tag(0x0028, 0x0103)
-        sf = gdcm.StringFilter()
-        sf.SetFile(self.gdcm_reader.GetFile())
-        res = sf.ToStringPair(tag)
-        if res[1]:
-            return int(res[1])
+        try:
+            data = self.data_image[str(0x0028)][str(0x0103)]
+        except KeyError:
+            return ""
+
+        if data:
+            return int(data)
         return ""
 
     def _GetBitsAllocated(self):
@@ -1121,6 +1531,52 @@ class Parser:
             return 1
         return int(data)
 
+    def GetFramePositions(self):
+        """
+        Return a (number of frames, 3) array with the position of each
+        frame of an enhanced multi-frame image.
+        Return None if not defined (e.g. single frame images).
+
+        DICOM standard tags (0x5200, 0x9230), (0x0020, 0x9113) and
+        (0x0020, 0x0032) were used.
+        """
+        try:
+            return self.data_image["invesalius"]["frame_positions"]
+        except KeyError:
+            return None
+
+    def GetFrameOrientations(self):
+        """
+        Return a (number of frames, 6) array with the orientation of each
+        frame of an enhanced multi-frame image, or a (1, 6) array if all
+        frames share the same orientation.
+        Return None if not defined.
+
+        DICOM standard tags (0x5200, 0x9229), (0x5200, 0x9230),
+        (0x0020, 0x9116) and (0x0020, 0x0037) were used.
+        """
+        try:
+            return self.data_image["invesalius"]["frame_orientations"]
+        except KeyError:
+            return None
+
+    def GetTransferSyntaxUID(self):
+        """
+        Return the transfer syntax UID (string) the file is encoded with.
+        Eg. "1.2.840.10008.1.2.1" (Explicit VR Little Endian).
+        Return "" if not defined.
+
+        DICOM standard tag (0x0002, 0x0010) was used.
+        """
+        try:
+            data = self.data_image[str(0x0002)][str(0x0010)]
+        except KeyError:
+            return ""
+
+        if data:
+            return data.strip(" \0")
+        return ""
+
     def GetPatientBirthDate(self):
         """
         Return string containing the patient's birth date using the
@@ -0,0 +1,312 @@
+import concurrent.futures, gzip, hashlib, math, os, re, struct, zipfile
+
+import numpy as np
+
+import dicom_grouper as dicom_grouper
+import dicom_volume as dicom_volume
+import display_pipeline as display_pipeline
+
+FORMAT_NIFTI = "nii"
+FORMAT_NIFTI_GZ = "nii.gz"
+FORMAT_NRRD = "nrrd"
+FORMAT_NPZ = "npz"
+FORMATS = (FORMAT_NIFTI_GZ, FORMAT_NIFTI, FORMAT_NRRD, FORMAT_NPZ)
+
+# numpy dtype: NIfTI-1 datatype code
+NIFTI_DATATYPES = {
+    np.dtype(np.uint8): 2,
+    np.dtype(np.int16): 4,
+    np.dtype(np.int32): 8,
+    np.dtype(np.float32): 16,
+    np.dtype(np.float64): 64,
+    np.dtype(np.int8): 256,
+    np.dtype(np.uint16): 512,
+    np.dtype(np.uint32): 768,
+}
+
+NRRD_TYPES = {
+    np.dtype(np.int8): "int8",
+    np.dtype(np.uint8): "uint8",
+    np.dtype(np.int16): "int16",
+    np.dtype(np.uint16): "uint16",
+    np.dtype(np.int32): "int32",
+    np.dtype(np.uint32): "uint32",
+    np.dtype(np.float32): "float",
+    np.dtype(np.float64): "double",
+}
+
+NIFTI_HEADER = struct.Struct("<i10s18sihsB8h3f4h8f3fhBB2f2f2i80s24s2h6f12f16s4s")
+
+
+def GetFormat(filename):
+    for fmt in FORMATS:
+        if filename.endswith("." + fmt):
+            return fmt
+    raise ValueError("Unknown export format of %s" % filename)
+
+
+def GetAffine(dicom, position, spacing):
+    """
+    Return the 4x4 matrix mapping (column, row, slice) voxel indexes to
+    DICOM patient coordinates (LPS, mm).
+    """
+    orientation = dicom_volume.GetOrientation(dicom)
+    normal = np.cross(orientation[:3], orientation[3:6])
+    affine = np.eye(4)
+    affine[:3, 0] = orientation[:3] * spacing[0]
+    affine[:3, 1] = orientation[3:6] * spacing[1]
+    affine[:3, 2] = normal * spacing[2]
+    affine[:3, 3] = position
+    return affine
+
+
+def _GetQuaternion(affine):
+    """
+    Return (quatern b, c, d, qfac) of the rotation of a RAS affine, as
+    defined by the NIfTI-1 qform.
+    """
+    rotation = affine[:3, :3] / np.linalg.norm(affine[:3, :3], axis=0)
+    qfac = 1.0
+    if np.linalg.det(rotation) < 0:
+        rotation[:, 2] *= -1
+        qfac = -1.0
+    r = rotation
+    a = 1.0 + r[0, 0] + r[1, 1] + r[2, 2]
+    if a > 0.5:
+        a = 0.5 * math.sqrt(a)
+        b = 0.25 * (r[2, 1] - r[1, 2]) / a
+        c = 0.25 * (r[0, 2] - r[2, 0]) / a
+        d = 0.25 * (r[1, 0] - r[0, 1]) / a
+    else:
+        xd = 1.0 + r[0, 0] - (r[1, 1] + r[2, 2])
+        yd = 1.0 + r[1, 1] - (r[0, 0] + r[2, 2])
+        zd = 1.0 + r[2, 2] - (r[0, 0] + r[1, 1])
+        if xd > 1.0:
+            b = 0.5 * math.sqrt(xd)
+            c = 0.25 * (r[0, 1] + r[1, 0]) / b
+            d = 0.25 * (r[0, 2] + r[2, 0]) / b
+            a = 0.25 * (r[2, 1] - r[1, 2]) / b
+        elif yd > 1.0:
+            c = 0.5 * math.sqrt(yd)
+            b = 0.25 * (r[0, 1] + r[1, 0]) / c
+            d = 0.25 * (r[1, 2] + r[2, 1]) / c
+            a = 0.25 * (r[0, 2] - r[2, 0]) / c
+        else:
+            d = 0.5 * math.sqrt(zd)
+            b = 0.25 * (r[0, 2] + r[2, 0]) / d
+            c = 0.25 * (r[1, 2] + r[2, 1]) / d
+            a = 0.25 * (r[1, 0] - r[0, 1]) / d
+        if a < 0:
+            b, c, d = -b, -c, -d
+    return b, c, d, qfac
+
+
+def GetNIfTIHeader(shape, dtype, affine, spacing, slope=1.0, intercept=0.0):
+    """
+    Return the NIfTI-1 single file header (with the empty extension
+    flag) of a (slices, rows, columns) volume with the LPS affine.
+    """
+    ras = np.diag([-1.0, -1.0, 1.0, 1.0]) @ affine
+    b, c, d, qfac = _GetQuaternion(ras)
+    nslices, rows, columns = shape
+    dtype = np.dtype(dtype)
+    header = NIFTI_HEADER.pack(
+        348, b"", b"", 0, 0, b"r", 0,
+        3, columns, rows, nslices, 1, 1, 1, 1,  # dim
+        0.0, 0.0, 0.0, 0,  # intent
+        NIFTI_DATATYPES[dtype], dtype.itemsize * 8, 0,
+        qfac, spacing[0], spacing[1], spacing[2], 0.0, 0.0, 0.0, 0.0,  # pixdim
+        352.0, slope, intercept, 0, 0,
+        2,  # xyzt_units: mm
+        0.0, 0.0, 0.0, 0.0, 0, 0,
+        b"load_dicom export", b"",
+        1, 1,  # qform_code, sform_code: scanner
+        b, c, d, ras[0, 3], ras[1, 3], ras[2, 3],
+        *ras[:3].ravel(),
+        b"", b"n+1\0",
+    )
+    return header + b"\0\0\0\0"
+
+
+def GetNRRDHeader(shape, dtype, affine):
+    nslices, rows, columns = shape
+    directions = " ".join("(%.17g,%.17g,%.17g)" % tuple(affine[:3, i]) for i in range(3))
+    return (
+        "NRRD0004\n"
+        "type: %s\n"
+        "dimension: 3\n"
+        "space: left-posterior-superior\n"
+        "sizes: %d %d %d\n"
+        "space directions: %s\n"
+        "kinds: domain domain domain\n"
+        "endian: little\n"
+        "encoding: raw\n"
+        "space origin: (%.17g,%.17g,%.17g)\n"
+        "\n" % ((NRRD_TYPES[np.dtype(dtype)], columns, rows, nslices, directions) + tuple(affine[:3, 3]))
+    ).encode("ascii")
+
+
+def _WriteNpyHeader(f, shape, dtype):
+    np.lib.format.write_array_header_1_0(
+        f, {"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)), "fortran_order": False, "shape": shape}
+    )
+
+
+def ExportGroup(group, filename, slab_size=32):
+    """
+    Write a DicomGroup as a NIfTI-1 (.nii, .nii.gz), NRRD (.nrrd) or
+    numpy (.npz, arrays voxels and affine) file.
+
+    The volume is streamed in slabs of slab_size slices, so memory
+    doesn't depend on the series size. Stored values are written with
+    the rescale slope and intercept in the NIfTI header; the other
+    formats get modality values (eg. Hounsfield units). Slices are
+    sorted along the normal and the z spacing is their median gap.
+    """
+    fmt = GetFormat(filename)
+    frames, positions = group.GetSortedFrames()
+    dicom = frames[0][0]
+    if dicom.image.samples_per_pixel > 1:
+        raise ValueError("Only single sample (grayscale) images can be exported")
+
+    shape = (len(frames),) + dicom_volume.GetFrameShape(dicom)
+    spacing = dicom_volume.GetSpacing(dicom, positions)
+    affine = GetAffine(dicom, positions[0], spacing)
+
+    slopes = np.array([d.image.rescale_slope for d, frame in frames], dtype=float)
+    intercepts = np.array([d.image.rescale_intercept for d, frame in frames], dtype=float)
+    slope = slopes if np.ptp(slopes) else slopes[0]
+    intercept = intercepts if np.ptp(intercepts) else intercepts[0]
+    stored_dtype = dicom_volume.GetDtype(dicom)
+    if fmt in (FORMAT_NIFTI, FORMAT_NIFTI_GZ) and not np.ndim(slope) and not np.ndim(intercept):
+        # The NIfTI header holds the rescale.
+        dtype = stored_dtype
+        convert = False
+        header_rescale = (float(slope), float(intercept))
+    else:
+        dtype = display_pipeline.GetModalityDtype(stored_dtype, slope, intercept)
+        convert = np.ndim(slope) or np.ndim(intercept) or slope != 1.0 or intercept != 0.0
+        header_rescale = (1.0, 0.0)
+
+    tmp_filename = filename + ".tmp"
+    if fmt == FORMAT_NIFTI_GZ:
+        f = gzip.open(tmp_filename, "wb", compresslevel=4)
+    else:
+        f = open(tmp_filename, "wb")
+    try:
+        archive = out = None
+        try:
+            if fmt == FORMAT_NPZ:
+                archive = zipfile.ZipFile(f, "w", zipfile.ZIP_STORED, allowZip64=True)
+                with archive.open("affine.npy", "w") as member:
+                    np.lib.format.write_array(member, affine)
+                out = archive.open("voxels.npy", "w", force_zip64=True)
+                _WriteNpyHeader(out, shape, dtype)
+            else:
+                out = f
+                if fmt == FORMAT_NRRD:
+                    out.write(GetNRRDHeader(shape, dtype, affine))
+                else:
+                    out.write(GetNIfTIHeader(shape, dtype, affine, spacing, *header_rescale))
+
+            for slab in dicom_volume.IterFrameSlabs(frames, positions, slab_size, prefetch=1):
+                voxels = slab.voxels
+                if convert:
+                    rescale = slice(slab.start, slab.stop)
+                    voxels = display_pipeline.ApplyModalityLUT(
+                        voxels,
+                        slope[rescale] if np.ndim(slope) else slope,
+                        intercept[rescale] if np.ndim(intercept) else intercept,
+                        out=np.empty(voxels.shape, dtype),
+                    )
+                out.write(np.ascontiguousarray(voxels, dtype.newbyteorder("<")).data)
+                del voxels, slab
+
+            if archive is not None:
+                out.close()
+                archive.close()
+        except BaseException:
+            if archive is not None:
+                # Closed now, while f is still open, rather than when
+                # garbage collected.
+                for closing in (out, archive):
+                    try:
+                        if closing is not None:
+                            closing.close()
+                    except Exception:
+                        pass
+            raise
+        finally:
+            f.close()
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        # Don't leave a partial file behind, eg. on a decoding error.
+        try:
+            os.remove(tmp_filename)
+        except OSError:
+            pass
+        raise
+    return filename
+
+
+def _GetName(text):
+    return re.sub(r"[^\w.-]+", "_", str(text)).strip("_") or "unknown"
+
+
+def GetExportFilename(group, fmt=FORMAT_NIFTI_GZ):
+    """
+    Return the relative path a DicomGroup is exported to:
+    patient id/study id/series number_description_hash_index.fmt
+
+    hash is a short hash of the group key (its UIDs and orientation, or
+    the tags grouped by without a Series Instance UID) and index the
+    sub-group of the key, so a series gets the same name from one scan
+    to the next.
+    """
+    dicom = group.GetDicomSample()
+    key = "\\".join(str(value) for value in group.key[:-1])
+    series = "%s_%s_%s_%d" % (
+        _GetName(dicom.acquisition.serie_number),
+        _GetName(dicom.acquisition.series_description),
+        hashlib.sha1(key.encode("utf-8", "surrogateescape")).hexdigest()[:8],
+        group.key[-1],
+    )
+    return os.path.join(_GetName(dicom.patient.id), _GetName(dicom.acquisition.id_study), series + "." + fmt)
+
+
+def ExportGroups(groups, directory, fmt=FORMAT_NIFTI_GZ, workers=4, executor=None, slab_size=32):
+    """
+    Export every series of groups, an iterable of DicomGroup or
+    PatientGroup (as yielded by dicom_reader.yGetDicomGroups), into
+    directory (see GetExportFilename), workers series at a time.
+
+    Return a list of (group, filename, error): a failing series doesn't
+    stop the others, its error is the exception raised.
+    """
+    series = []
+    for group in groups:
+        if isinstance(group, dicom_grouper.PatientGroup):
+            series.extend(group.GetGroups())
+        else:
+            series.append(group)
+
+    def export(group):
+        filename = os.path.join(directory, GetExportFilename(group, fmt))
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        return ExportGroup(group, filename, slab_size)
+
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = [(group, executor.submit(export, group)) for group in series]
+        results = []
+        for group, future in futures:
+            try:
+                results.append((group, future.result(), None))
+            except Exception as err:
+                results.append((group, None, err))
+        return results
+    finally:
+        if own_executor:
+            executor.shutdown()
@@ -1,10 +1,55 @@
+import gzip, json, sys
+
 import gdcm
+import numpy as np
 
+import dicom as dicom
 import utils as utils
 import constants as const
 
+# Serialized grouper state (see DicomPatientGrouper.Save)
+STATE_FORMAT = "load_dicom grouper"
+STATE_VERSION = 1
+
 ORIENT_MAP = {"SAGITTAL": 0, "CORONAL": 1, "AXIAL": 2, "OBLIQUE": 2}
 
+# Secondary indexes of DicomPatientGrouper: name: value of a dicom
+INDEXES = {
+    "study_instance_uid": lambda dicom: dicom.acquisition.study_instance_uid,
+    "series_instance_uid": lambda dicom: dicom.acquisition.series_instance_uid,
+    "accession_number": lambda dicom: dicom.acquisition.accession_number,
+    "modality": lambda dicom: dicom.acquisition.modality,
+    "study_date": lambda dicom: dicom.acquisition.study_date,
+}
+
+# Grouping modes of DicomPatientGrouper
+GROUP_BY_TAGS = "tags"  # patient name, StudyID, series number
+GROUP_BY_UID = "uid"  # Study, Series and Frame of Reference UIDs
+
+def _Intern(value):
+    """
+    Return the interned form of a tag value: equal values share one
+    string object, whose hash is computed once and then cached.
+    """
+    if not value:
+        return ""
+    return sys.intern(str(value).strip(" \0"))
+
+def _EncodeValue(value):
+    if isinstance(value, np.ndarray):
+        return {"__ndarray__": value.tolist(), "dtype": str(value.dtype)}
+    raise TypeError("%r is not JSON serializable" % (value,))
+
+def _DecodeValue(obj):
+    if "__ndarray__" in obj:
+        return np.array(obj["__ndarray__"], dtype=obj["dtype"])
+    return obj
+
+def _GetIndexValue(value):
+    if not value:
+        return ""
+    return str(value).strip(" \0")
+
 class DicomGroup:
     general_index = -1
 
@@ -24,6 +69,17 @@ class DicomGroup:
         self.zspacing = 1
         self.dicom = None
 
+    @property
+    def zspacing(self):
+        # Computed when read, not every time a slice is added.
+        if self._zspacing is None:
+            self.UpdateZSpacing()
+        return self._zspacing
+
+    @zspacing.setter
+    def zspacing(self, value):
+        self._zspacing = value
+
     def AddSlice(self, dicom):
         if not self.dicom:
             self.dicom = dicom
@@ -87,43 +143,108 @@ class DicomGroup:
         list_ = sorted(list_, key=lambda dicom: dicom.image.number)
         return list_
 
-    def UpdateZSpacing(self):
-        list_ = self.GetHandSortedList()
+    def GetSortedFrames(self):
+        """
+        Return (frames, positions): frames is a list of (dicom, frame
+        number) with every frame of the group sorted along the slice
+        normal, and positions the (number of frames, 3) array of their
+        positions. Frames of enhanced multi-frame files are sorted
+        individually, using their per-frame positions.
+        """
+        dicoms = list(self.slices_dict.values())
+        file_index = []
+        frame_index = []
+        positions = []
+        for n, dicom in enumerate(dicoms):
+            image = dicom.image
+            if image.frame_positions is not None:
+                nframes = len(image.frame_positions)
+                positions.append(image.frame_positions)
+            else:
+                nframes = max(1, image.number_of_frames)
+                positions.append(np.tile(image.position, (nframes, 1)))
+            file_index.append(np.full(nframes, n))
+            frame_index.append(np.arange(nframes))
+
+        positions = np.concatenate(positions).astype(float)
+        file_index = np.concatenate(file_index)
+        frame_index = np.concatenate(frame_index)
+
+        image = dicoms[0].image
+        if image.frame_orientations is not None:
+            orientation = image.frame_orientations[0]
+        else:
+            orientation = dicoms[0].acquisition.patient_orientation
+        normal = np.cross(orientation[:3], orientation[3:6])
 
-        if len(list_) > 1:
-            dicom = list_[0]
-            axis = ORIENT_MAP[dicom.image.orientation_label]
-            p1 = dicom.image.position[axis]
+        # Stable, so frames at the same position keep the file order.
+        order = np.argsort(positions @ normal, kind="stable")
+        frames = [(dicoms[file_index[i]], int(frame_index[i])) for i in order]
+        return frames, positions[order]
 
-            dicom = list_[1]
-            p2 = dicom.image.position[axis]
+    def UpdateZSpacing(self):
+        list_ = self.GetHandSortedList()
+        axis = ORIENT_MAP[list_[0].image.orientation_label]
+        if any(dicom.image.frame_positions is not None for dicom in list_):
+            # Enhanced multi-frame files: gaps between their frames.
+            frames, positions = self.GetSortedFrames()
+            positions = positions[:, axis]
+        else:
+            positions = [dicom.image.position[axis] for dicom in list_]
 
-            self.zspacing = abs(p1 - p2)
+        if len(positions) > 1:
+            # Median gap between all the slices, the first two may be
+            # unevenly spaced.
+            self.zspacing = float(np.median(np.diff(np.sort(positions))))
         else:
             self.zspacing = 1
 
     def GetDicomSample(self):
-        size = len(self.slices_dict)
-        dicom = self.GetHandSortedList()[size // 2]
-        return dicom
+        # Middle slice by image number, selected in O(n) instead of
+        # sorting the whole list.
+        list_ = list(self.slices_dict.values())
+        numbers = np.array([dicom.image.number for dicom in list_])
+        middle = len(list_) // 2
+        return list_[np.argpartition(numbers, middle)[middle]]
 
 class PatientGroup:
-    def __init__(self):
+    def __init__(self, mode=GROUP_BY_TAGS):
         # key: (dicom.patient.name, dicom.patient.id)
         self.key = ()
+        self.mode = mode
         self.groups_dict = {}  # group_key: DicomGroup
         self.nslices = 0
         self.ngroups = 0
         self.dicom = None
 
-    def AddFile(self, dicom, index=0):
-        group_key = (
+    def GetGroupKey(self, dicom, index=0):
+        """
+        Return the key of the group (series) of dicom. With GROUP_BY_UID
+        it's (StudyInstanceUID, SeriesInstanceUID, FrameOfReferenceUID,
+        orientation label, index) of interned strings, falling back to
+        the GROUP_BY_TAGS key for files without a Series Instance UID.
+        """
+        if self.mode == GROUP_BY_UID:
+            acquisition = dicom.acquisition
+            series_uid = acquisition.series_instance_uid = _Intern(acquisition.series_instance_uid)
+            if series_uid:
+                study_uid = acquisition.study_instance_uid = _Intern(acquisition.study_instance_uid)
+                try:
+                    frame_of_reference_uid = acquisition.frame_of_reference_uid
+                except AttributeError:
+                    frame_of_reference_uid = _Intern(dicom.parser.GetFrameReferenceUID())
+                    acquisition.frame_of_reference_uid = frame_of_reference_uid
+                return (study_uid, series_uid, frame_of_reference_uid, dicom.image.orientation_label, index)
+        return (
             dicom.patient.name,
             dicom.acquisition.id_study,
             dicom.acquisition.serie_number,
             dicom.image.orientation_label,
             index,
         )
+
+    def AddFile(self, dicom, index=0):
+        group_key = self.GetGroupKey(dicom, index)
         if not self.dicom:
             self.dicom = dicom
         self.nslices += 1
@@ -142,9 +263,10 @@ class PatientGroup:
             if not slice_added:
                 # If we're here, then Problem 2 occured
                 # TODO: Optimize recursion
-                self.AddFile(dicom, index + 1)
-            # Getting the spacing in the Z axis
-            group.UpdateZSpacing()
+                return self.AddFile(dicom, index + 1)
+            # Getting the spacing in the Z axis (when it's read)
+            group.zspacing = None
+        return group
 
     def GetGroups(self):
         glist = self.groups_dict.values()
@@ -155,21 +277,102 @@ class PatientGroup:
         return self.dicom
     
 class DicomPatientGrouper:
-    def __init__(self):
+    """
+    Group dicom.Dicom objects by patient and series. The default
+    GROUP_BY_TAGS mode keys series by patient name, StudyID and series
+    number, as InVesalius does; GROUP_BY_UID keys them by Study, Series
+    and Frame of Reference UIDs, which don't collide across studies, with
+    interned strings so keys are cheap to hash and compare.
+    """
+    def __init__(self, mode=GROUP_BY_TAGS):
+        self.mode = mode
         self.patients_dict = {}
+        # index name: {value: {DicomGroup: None}}, see INDEXES
+        self.indexes = {name: {} for name in INDEXES}
 
     def AddFile(self, dicom):
+        """
+        Add the dicom to its patient and return the DicomGroup
+        (series) it was placed in.
+        """
+        if self.mode == GROUP_BY_UID:
+            dicom.patient.name = _Intern(dicom.patient.name)
+            dicom.patient.id = _Intern(dicom.patient.id)
         patient_key = (dicom.patient.name, dicom.patient.id)
         # Does this patient exist?
         if patient_key not in self.patients_dict.keys():
-            patient = PatientGroup()
+            patient = PatientGroup(self.mode)
             patient.key = patient_key
-            patient.AddFile(dicom)
+            group = patient.AddFile(dicom)
             self.patients_dict[patient_key] = patient
         # Patient exists... Lets add group to it
         else:
             patient = self.patients_dict[patient_key]
-            patient.AddFile(dicom)
+            group = patient.AddFile(dicom)
+        self._IndexGroup(group, dicom)
+        return group
+
+    def _IndexGroup(self, group, dicom):
+        for name, get_value in INDEXES.items():
+            value = _GetIndexValue(get_value(dicom))
+            if value:
+                groups = self.indexes[name].setdefault(value, {})
+                if group not in groups:
+                    groups[group] = None
+
+    def _Lookup(self, name, value):
+        """
+        Return the {DicomGroup: None} of the groups with value in the
+        index name. value may also be a list of values or, for
+        study_date, a (first, last) tuple of dates (both included).
+        """
+        index = self.indexes[name]
+        if name == "study_date" and isinstance(value, tuple):
+            first, last = value
+            values = [date for date in index if (not first or date >= first) and (not last or date <= last)]
+        elif isinstance(value, (list, set)):
+            values = value
+        else:
+            values = [value]
+
+        found = {}
+        for value in values:
+            found.update(index.get(_GetIndexValue(value), {}))
+        return found
+
+    def Query(self, study_instance_uid=None, series_instance_uid=None, accession_number=None,
+              modality=None, study_date=None):
+        """
+        Return the DicomGroups (series) matching every given criterion,
+        in the order they were found. Each one may be a value or a list
+        of values; study_date ("yyyymmdd") may also be a (first, last)
+        tuple, use None for an open range. Eg.:
+
+            grouper.Query(accession_number="A123", modality="CT")
+            grouper.Query(study_date=("20240101", None))
+        """
+        criteria = {
+            "study_instance_uid": study_instance_uid,
+            "series_instance_uid": series_instance_uid,
+            "accession_number": accession_number,
+            "modality": modality,
+            "study_date": study_date,
+        }
+        matches = [self._Lookup(name, value) for name, value in criteria.items() if value is not None]
+        if not matches:
+            return [group for patient in self.patients_dict.values() for group in patient.groups_dict.values()]
+        # Start from the smallest set.
+        matches.sort(key=len)
+        found = matches[0]
+        for other in matches[1:]:
+            found = {group: None for group in found if group in other}
+        return list(found)
+
+    def GetIndexValues(self, name):
+        """
+        Return the sorted values of the index name, eg. every modality.
+        """
+        return sorted(self.indexes[name])
 
     def Update(self):
         for patient in self.patients_dict.values():
@@ -179,3 +382,82 @@ class DicomPatientGrouper:
         plist = self.patients_dict.values()
         plist = sorted(plist, key=lambda patient: patient.key[0])
         return plist
+
+    def GetDicoms(self):
+        """
+        Return every dicom.Dicom added, sorted by file name.
+        """
+        dicoms = {}
+        for patient in self.patients_dict.values():
+            for group in patient.groups_dict.values():
+                for dcm in group.slices_dict.values():
+                    dicoms[dcm.image.file] = dcm
+        return [dicoms[filename] for filename in sorted(dicoms)]
+
+    def Save(self, filename):
+        """
+        Write the state of the grouper: the parsed header of every file,
+        as gzipped JSON lines. Groups aren't stored, they are made
+        again by Load, so a state can be loaded with another mode.
+        """
+        with gzip.open(filename, "wt", encoding="utf-8", compresslevel=6) as f:
+            header = {"format": STATE_FORMAT, "version": STATE_VERSION, "mode": self.mode}
+            f.write(json.dumps(header) + "\n")
+            for dcm in self.GetDicoms():
+                f.write(json.dumps([dcm.image.file, dcm.parser.data_image], default=_EncodeValue) + "\n")
+
+    @staticmethod
+    def ReadState(filename):
+        """
+        Return (header, dicoms) of a state written by Save.
+        """
+        dicoms = []
+        with gzip.open(filename, "rt", encoding="utf-8") as f:
+            header = json.loads(f.readline())
+            if header.get("format") != STATE_FORMAT or header.get("version", 0) > STATE_VERSION:
+                raise ValueError("%s is not a grouper state this version can read" % filename)
+            for line in f:
+                filepath, data_image = json.loads(line, object_hook=_DecodeValue)
+                parser = dicom.Parser()
+                parser.SetDataImage(data_image, filepath)
+                dcm = dicom.Dicom()
+                dcm.SetParser(parser)
+                dicoms.append(dcm)
+        return header, dicoms
+
+    @classmethod
+    def Load(cls, filename, mode=None):
+        header, dicoms = cls.ReadState(filename)
+        grouper = cls(mode or header["mode"])
+        for dcm in dicoms:
+            grouper.AddFile(dcm)
+        return grouper
+
+def MergeGroupers(sources, mode=None):
+    """
+    Combine the files of several groupers (or state files written by
+    DicomPatientGrouper.Save), eg. shards of a scan, into a new grouper.
+
+    Files are grouped again in file name order, whatever the order of
+    the sources, so the result is deterministic: series split across
+    shards are joined, sub groups of repeated positions are numbered
+    again and z spacings recomputed. A file found in several sources
+    is taken from the first one.
+    """
+    dicoms = {}
+    for source in sources:
+        if isinstance(source, DicomPatientGrouper):
+            source_mode = source.mode
+            source_dicoms = source.GetDicoms()
+        else:
+            header, source_dicoms = DicomPatientGrouper.ReadState(source)
+            source_mode = header["mode"]
+        if mode is None:
+            mode = source_mode
+        for dcm in source_dicoms:
+            dicoms.setdefault(dcm.image.file, dcm)
+
+    grouper = DicomPatientGrouper(mode or GROUP_BY_TAGS)
+    for filename in sorted(dicoms):
+        grouper.AddFile(dicoms[filename])
+    return grouper
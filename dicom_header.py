@@ -0,0 +1,245 @@
+"""
+Header parsing straight from the bytes of memory mapped files, without
+GDCM, for the plain cases: DICOM Part 10 files whose data set is
+encoded in implicit or explicit VR little endian (which includes every
+encapsulated, ie. compressed, transfer syntax).
+
+Only the elements read by dicom.Parser (PARSER_TAGS) are decoded, the
+others are skipped without being copied. Parsing stops at the Pixel
+Data element, whose offset and length are recorded so pixels can be
+read later without parsing the file again. Anything else (big endian,
+deflated, ACR-NEMA files, enhanced multi-frame functional groups,
+non-image objects, non-ASCII text in a character set other than UTF-8)
+raises UnsupportedFile, for GDCM to handle.
+"""
+import mmap, struct
+
+import gdcm
+
+import utils as utils
+
+IMPLICIT_VR_LE = "1.2.840.10008.1.2"
+EXPLICIT_VR_BE = "1.2.840.10008.1.2.2"
+DEFLATED_EXPLICIT_VR_LE = "1.2.840.10008.1.2.1.99"
+MEDIA_STORAGE_DIRECTORY = "1.2.840.10008.1.3.10"
+
+# Specific Character Set of UTF-8, whose text is decoded here.
+UTF8_CHARACTER_SET = "ISO_IR 192"
+
+PREAMBLE_SIZE = 128
+UNDEFINED_LENGTH = 0xFFFFFFFF
+
+TAG_SPECIFIC_CHARACTER_SET = (0x0008, 0x0005)
+TAG_PIXEL_DATA = (0x7FE0, 0x0010)
+TAG_PER_FRAME_FUNCTIONAL_GROUPS = (0x5200, 0x9230)
+TAG_ITEM = (0xFFFE, 0xE000)
+TAG_ITEM_DELIMITATION = (0xFFFE, 0xE00D)
+TAG_SEQUENCE_DELIMITATION = (0xFFFE, 0xE0DD)
+
+# VRs with a reserved field and a 4 bytes length in explicit VR.
+LONG_VRS = frozenset((b"OB", b"OD", b"OF", b"OL", b"OV", b"OW", b"SQ", b"SV", b"UC", b"UN", b"UR", b"UT", b"UV"))
+
+# Binary VRs: struct format of a value.
+BINARY_VRS = {b"US": "H", b"SS": "h", b"UL": "I", b"SL": "i"}
+
+# Elements read by dicom.Parser, with the VR of the binary ones (the
+# others are strings), needed for implicit VR.
+PARSER_TAGS = {
+    (0x0002, 0x0002): None, (0x0002, 0x0010): None,
+    (0x0008, 0x0005): None, (0x0008, 0x0008): None, (0x0008, 0x0016): None, (0x0008, 0x0018): None,
+    (0x0008, 0x0020): None, (0x0008, 0x0022): None, (0x0008, 0x0032): None, (0x0008, 0x0033): None,
+    (0x0008, 0x0050): None, (0x0008, 0x0060): None, (0x0008, 0x0070): None, (0x0008, 0x0080): None,
+    (0x0008, 0x0081): None, (0x0008, 0x0090): None, (0x0008, 0x0092): None, (0x0008, 0x0094): None,
+    (0x0008, 0x1010): None, (0x0008, 0x1030): None, (0x0008, 0x103E): None, (0x0008, 0x1090): None,
+    (0x0008, 0x2110): None,
+    (0x0010, 0x0010): None, (0x0010, 0x0020): None, (0x0010, 0x0030): None, (0x0010, 0x0040): None,
+    (0x0010, 0x1010): None, (0x0010, 0x1020): None, (0x0010, 0x1030): None, (0x0010, 0x1040): None,
+    (0x0010, 0x1080): None, (0x0010, 0x1081): None, (0x0010, 0x2000): None, (0x0010, 0x2150): None,
+    (0x0010, 0x2152): None, (0x0010, 0x2154): None, (0x0010, 0x2180): None, (0x0010, 0x2297): None,
+    (0x0010, 0x2298): None, (0x0010, 0x2299): None,
+    (0x0018, 0x0020): None, (0x0018, 0x0050): None, (0x0018, 0x0060): None, (0x0018, 0x1030): None,
+    (0x0018, 0x1120): None, (0x0018, 0x1151): None, (0x0018, 0x1152): None, (0x0018, 0x1210): None,
+    (0x0020, 0x000D): None, (0x0020, 0x000E): None, (0x0020, 0x0010): None, (0x0020, 0x0011): None,
+    (0x0020, 0x0012): None, (0x0020, 0x0013): None, (0x0020, 0x0032): None, (0x0020, 0x0037): None,
+    (0x0020, 0x0052): None, (0x0020, 0x1041): None,
+    (0x0028, 0x0002): b"US", (0x0028, 0x0008): None, (0x0028, 0x0010): b"US", (0x0028, 0x0011): b"US",
+    (0x0028, 0x0030): None, (0x0028, 0x0100): b"US", (0x0028, 0x0101): b"US", (0x0028, 0x0103): b"US",
+    (0x0028, 0x1050): None, (0x0028, 0x1051): None, (0x0028, 0x1052): None, (0x0028, 0x1053): None,
+    (0x0028, 0x1056): None,
+}
+
+# SOP classes whose pixel spacing GDCM's ImageHelper takes from Pixel
+# Spacing (0028,0030), as [column spacing, row spacing, 1.0].
+PIXEL_SPACING_SOP_CLASSES = frozenset((
+    "1.2.840.10008.5.1.4.1.1.2",  # CT Image Storage
+    "1.2.840.10008.5.1.4.1.1.4",  # MR Image Storage
+    "1.2.840.10008.5.1.4.1.1.128",  # Positron Emission Tomography Image Storage
+    "1.2.840.10008.5.1.4.1.1.20",  # Nuclear Medicine Image Storage
+))
+
+_TAG = struct.Struct("<HH")
+_EXPLICIT = struct.Struct("<HH2sH")
+_IMPLICIT = struct.Struct("<HHI")
+_LONG_LENGTH = struct.Struct("<I")
+
+_orientation = gdcm.Orientation()
+
+
+class UnsupportedFile(Exception):
+    """
+    The file isn't one of the cases handled here, GDCM has to read it.
+    """
+
+
+def _GetString(data, start, length, character_set):
+    value = bytes(data[start:start + length])
+    if not value.isascii() and character_set != UTF8_CHARACTER_SET:
+        # GDCM's values then depend on its own character set handling.
+        raise UnsupportedFile("text in character set %r" % character_set)
+    # As GDCM's string filter: trailing NUL padding (UI) removed.
+    return value.rstrip(b"\0").decode("utf-8", "surrogateescape")
+
+
+def _GetBinary(data, start, length, vr):
+    fmt = BINARY_VRS[vr]
+    count = length // struct.calcsize(fmt)
+    values = struct.unpack_from("<%d%s" % (count, fmt), data, start)
+    return "\\".join(str(value) for value in values)
+
+
+def _ReadElementHeader(data, offset, explicit):
+    """
+    Return (group, element, vr, value offset, length) of the element at
+    offset. vr is None in implicit VR.
+    """
+    if explicit:
+        group, element, vr, length = _EXPLICIT.unpack_from(data, offset)
+        if (group, element) in (TAG_ITEM, TAG_ITEM_DELIMITATION, TAG_SEQUENCE_DELIMITATION):
+            (length,) = _LONG_LENGTH.unpack_from(data, offset + 4)
+            return group, element, None, offset + 8, length
+        if vr in LONG_VRS:
+            (length,) = _LONG_LENGTH.unpack_from(data, offset + 8)
+            return group, element, vr, offset + 12, length
+        return group, element, vr, offset + 8, length
+    group, element, length = _IMPLICIT.unpack_from(data, offset)
+    return group, element, None, offset + 8, length
+
+
+def _SkipUndefined(data, offset, explicit):
+    """
+    Return the offset following the sequence (or item) of undefined
+    length whose value starts at offset.
+    """
+    while True:
+        group, element, vr, start, length = _ReadElementHeader(data, offset, explicit)
+        if (group, element) in (TAG_SEQUENCE_DELIMITATION, TAG_ITEM_DELIMITATION):
+            return start
+        if length == UNDEFINED_LENGTH:
+            offset = _SkipUndefined(data, start, explicit)
+        else:
+            offset = start + length
+        if offset > len(data):
+            raise UnsupportedFile("truncated element")
+
+
+def ParseBuffer(data, filepath=""):
+    """
+    Parse the header of a DICOM file from data, a buffer with the whole
+    file (eg. a mmap). Return the data_image dict of dicom.Parser, the
+    way dicom_reader.ReadDicomFile builds it, with the Pixel Data offset
+    and length (-1 when encapsulated) in data_image["invesalius"].
+    """
+    if len(data) < PREAMBLE_SIZE + 4 or bytes(data[PREAMBLE_SIZE:PREAMBLE_SIZE + 4]) != b"DICM":
+        raise UnsupportedFile("no DICOM Part 10 preamble")
+
+    data_dict = {}
+    offset = PREAMBLE_SIZE + 4
+    explicit = True
+    transfer_syntax = None
+    character_set = ""
+    pixel_data = None
+    try:
+        while offset < len(data):
+            if transfer_syntax is None and _TAG.unpack_from(data, offset)[0] != 0x0002:
+                # End of the meta information.
+                transfer_syntax = data_dict.get("2", {}).get("16", "").strip(" \0")
+                if transfer_syntax in (EXPLICIT_VR_BE, DEFLATED_EXPLICIT_VR_LE) or not transfer_syntax:
+                    raise UnsupportedFile("transfer syntax %r" % transfer_syntax)
+                explicit = transfer_syntax != IMPLICIT_VR_LE
+
+            group, element, vr, start, length = _ReadElementHeader(data, offset, explicit)
+            tag = (group, element)
+            if tag == TAG_PIXEL_DATA:
+                pixel_data = (start, -1 if length == UNDEFINED_LENGTH else length)
+                break
+            if tag == TAG_PER_FRAME_FUNCTIONAL_GROUPS:
+                raise UnsupportedFile("enhanced multi-frame")
+            if length == UNDEFINED_LENGTH:
+                # Sequences aren't parsed, as ReadDicomFile does.
+                offset = _SkipUndefined(data, start, explicit)
+                continue
+            if start + length > len(data):
+                raise UnsupportedFile("truncated element")
+
+            if tag in PARSER_TAGS:
+                if vr is None or vr == b"UN":
+                    # Implicit VR, or unknown to the writer: the VR of
+                    # the dictionary, as GDCM's string filter does.
+                    vr = PARSER_TAGS[tag]
+                if vr in BINARY_VRS:
+                    value = _GetBinary(data, start, length, vr)
+                else:
+                    value = _GetString(data, start, length, character_set)
+                if tag == TAG_SPECIFIC_CHARACTER_SET:
+                    character_set = value.strip()
+                if utils.VerifyInvalidPListCharacter(value):
+                    value = "Invalid Character"
+                data_dict.setdefault(str(group), {})[str(element)] = value
+            offset = start + length
+    except struct.error:
+        raise UnsupportedFile("truncated element")
+
+    if pixel_data is None:
+        raise UnsupportedFile("no pixel data")
+    if data_dict.get("2", {}).get("2", "").strip(" \0") == MEDIA_STORAGE_DIRECTORY:
+        raise UnsupportedFile("DICOMDIR")
+
+    # Geometry as ReadDicomFile gets it from GDCM.
+    try:
+        cosines = [float(value) for value in data_dict["32"]["55"].replace(",", ".").split("\\")]
+    except (KeyError, ValueError):
+        cosines = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+    if len(cosines) != 6:
+        raise UnsupportedFile("image orientation")
+    label = _orientation.GetLabel(_orientation.GetType(tuple(cosines)))
+    data_dict["invesalius"] = {
+        "orientation_label": label,
+        "pixel_data_offset": pixel_data[0],
+        "pixel_data_length": pixel_data[1],
+    }
+
+    sop_class_uid = data_dict.get("8", {}).get("22", "").strip(" \0")
+    if sop_class_uid not in PIXEL_SPACING_SOP_CLASSES:
+        raise UnsupportedFile("pixel spacing of SOP class %r" % sop_class_uid)
+    try:
+        row_spacing, column_spacing = [float(value) for value in data_dict["40"]["48"].split("\\")]
+        data_dict["spacing"] = [column_spacing, row_spacing, 1.0]
+    except KeyError:
+        data_dict["spacing"] = [1.0, 1.0, 1.0]
+    except ValueError:
+        # Comma decimal separators, dicom.Parser reads the tag itself.
+        data_dict["spacing"] = [1.0, 1.0, 1.0]
+    return data_dict
+
+
+def ParseFile(filepath):
+    """
+    Memory map filepath and parse its header (see ParseBuffer).
+    """
+    with open(filepath, "rb") as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise UnsupportedFile("empty file")
+    with data:
+        return ParseBuffer(data, filepath)
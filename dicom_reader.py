@@ -1,174 +1,447 @@
-import gdcm, os
+import asyncio, concurrent.futures, gdcm, os, time
+
+import numpy as np
 
 import constants as const
 import utils as utils
 import dicom as dicom
 import dicom_grouper as dicom_grouper
+import dicom_header as dicom_header
+import io_scheduler as io_scheduler
+import scan_profiler as scan_profiler
 
 tag_labels = {}
 main_dict = {}
 dict_file = {}
 
-class LoadDicom:
-    def __init__(self, grouper, filepath):
-        self.grouper = grouper
-        self.filepath = utils.decode(filepath, const.FS_ENCODE)
-        self.run()
+# Headers kept by the cache of lazy (DicomProxy) scans.
+HEADER_CACHE_SIZE = 64
 
-    def run(self):
-        grouper = self.grouper
-        reader = gdcm.ImageReader()
+# Enhanced multi-frame functional groups
+TAG_SHARED_FUNCTIONAL_GROUPS = gdcm.Tag(0x5200, 0x9229)
+TAG_PER_FRAME_FUNCTIONAL_GROUPS = gdcm.Tag(0x5200, 0x9230)
+TAG_PLANE_POSITION_SEQUENCE = gdcm.Tag(0x0020, 0x9113)
+TAG_PLANE_ORIENTATION_SEQUENCE = gdcm.Tag(0x0020, 0x9116)
+TAG_IMAGE_POSITION = gdcm.Tag(0x0020, 0x0032)
+TAG_IMAGE_ORIENTATION = gdcm.Tag(0x0020, 0x0037)
+
+def _GetSequenceItems(ds, tag):
+    """
+    Return the nested data sets of the sequence tag of ds (empty list
+    if not present).
+    """
+    if not ds.FindDataElement(tag):
+        return []
+    sq = ds.GetDataElement(tag).GetValueAsSQ()
+    if sq is None:
+        return []
+    return [sq.GetItem(i).GetNestedDataSet() for i in range(1, sq.GetNumberOfItems() + 1)]
+
+def _GetMacroValues(ds, sequence_tag, tag):
+    """
+    Return the float values of tag inside the first item of the
+    sequence sequence_tag (a functional group macro), or None.
+    """
+    items = _GetSequenceItems(ds, sequence_tag)
+    if not items or not items[0].FindDataElement(tag):
+        return None
+    data_element = items[0].GetDataElement(tag)
+    if data_element.IsEmpty():
+        return None
+    value = str(data_element.GetValue()).strip(" \0").replace(",", ".")
+    return [float(v) for v in value.split("\\")]
+
+def GetFrameGeometry(ds):
+    """
+    Return the positions, as a (number of frames, 3) array, and the
+    orientations, as a (number of frames, 6) array or a (1, 6) array
+    when all frames share it, of an enhanced multi-frame data set.
+    Return (None, None) if there is no Per-Frame Functional Groups
+    Sequence or a frame has no position.
+    """
+    per_frame = _GetSequenceItems(ds, TAG_PER_FRAME_FUNCTIONAL_GROUPS)
+    if not per_frame:
+        return None, None
+
+    shared_orientation = None
+    for item in _GetSequenceItems(ds, TAG_SHARED_FUNCTIONAL_GROUPS):
+        shared_orientation = _GetMacroValues(
+            item, TAG_PLANE_ORIENTATION_SEQUENCE, TAG_IMAGE_ORIENTATION
+        )
+
+    positions = np.empty((len(per_frame), 3))
+    orientations = []
+    for n, item in enumerate(per_frame):
+        position = _GetMacroValues(item, TAG_PLANE_POSITION_SEQUENCE, TAG_IMAGE_POSITION)
+        if position is None or len(position) != 3:
+            return None, None
+        positions[n] = position
+        orientation = _GetMacroValues(item, TAG_PLANE_ORIENTATION_SEQUENCE, TAG_IMAGE_ORIENTATION)
+        orientations.append(orientation or shared_orientation)
+
+    if None in orientations:
+        orientations = None
+    else:
+        orientations = np.array(orientations, dtype=float)
+        if (orientations == orientations[0]).all():
+            orientations = orientations[:1]
+    return positions, orientations
+
+def _ReadDicomFileFast(filepath, profiler=None, header=None):
+    """
+    Parse filepath with dicom_header, from header (its first bytes) if
+    they hold the whole header, else from the memory mapped file.
+    Return None if the file has to be read by GDCM.
+    """
+    t0 = time.perf_counter()
+    data_dict = None
+    if header is not None:
         try:
-            reader.SetFileName(utils.encode(self.filepath, const.FS_ENCODE))
-        except TypeError:
-            reader.SetFileName(self.filepath)
-            
-        if reader.Read():
-            file = reader.GetFile()
-            # Retrieve data set
-            dataSet = file.GetDataSet()
-            # Retrieve header
-            header = file.GetHeader()
-            stf = gdcm.StringFilter()
-            stf.SetFile(file)
-
-            data_dict = {}
-
-            tag = gdcm.Tag(0x0008, 0x0005)
-            ds = reader.GetFile().GetDataSet()
-            image_helper = gdcm.ImageHelper()
-            data_dict["spacing"] = image_helper.GetSpacingValue(reader.GetFile())
-            if ds.FindDataElement(tag):
-                data_element = ds.GetDataElement(tag)
-                if data_element.IsEmpty():
-                    encoding_value = "ISO_IR 100"
-                else:
-                    encoding_value = str(ds.GetDataElement(tag).GetValue()).split("\\")[0]
+            data_dict = dicom_header.ParseBuffer(header, filepath)
+        except dicom_header.UnsupportedFile:
+            pass
+    if data_dict is None:
+        try:
+            data_dict = dicom_header.ParseFile(filepath)
+        except (dicom_header.UnsupportedFile, OSError):
+            return None
+    t1 = time.perf_counter()
+    dict_file[filepath] = data_dict
 
-                if encoding_value.startswith("Loaded"):
-                    encoding = "ISO_IR 100"
-                else:
-                    try:
-                        encoding = const.DICOM_ENCODING_TO_PYTHON[encoding_value]
-                    except KeyError:
-                        encoding = "ISO_IR 100"
+    parser = dicom.Parser()
+    parser.SetDataImage(data_dict, filepath)
+    dcm = dicom.Dicom()
+    dcm.SetParser(parser)
+    if profiler is not None:
+        stages = {
+            scan_profiler.STAGE_READ: t1 - t0,
+            scan_profiler.STAGE_TAGS: 0.0,
+            scan_profiler.STAGE_PARSER: time.perf_counter() - t1,
+        }
+        profiler.AddFile(filepath, stages, parser.GetTransferSyntaxUID())
+    return dcm
+
+def ReadDicomFile(filepath, profiler=None, fast=False, header=None):
+    """
+    Parse the header of a single file and return a dicom.Dicom, or
+    None if the file is not a readable image (or is a DICOMDIR).
+    It doesn't touch any grouper, so it may run in a worker thread.
+    profiler is an optional scan_profiler.ScanProfiler.
+
+    With fast, plain little endian files are parsed from their bytes
+    by dicom_header, which only keeps the tags dicom.Parser reads, and
+    GDCM is used for the others. Only then is the Pixel Data offset
+    recorded (image.pixel_data_offset), otherwise it's None and
+    dicom_volume has to search the file for it. header may be the first
+    bytes of the file, already read (see io_scheduler.ReadAheadScheduler).
+    """
+    filepath = utils.decode(filepath, const.FS_ENCODE)
+    if fast:
+        dcm = _ReadDicomFileFast(filepath, profiler, header)
+        if dcm is not None:
+            return dcm
+    reader = gdcm.ImageReader()
+    try:
+        reader.SetFileName(utils.encode(filepath, const.FS_ENCODE))
+    except TypeError:
+        reader.SetFileName(filepath)
+
+    t0 = time.perf_counter()
+    if reader.Read():
+        t1 = time.perf_counter()
+        file = reader.GetFile()
+        # Retrieve data set
+        dataSet = file.GetDataSet()
+        # Retrieve header
+        header = file.GetHeader()
+        stf = gdcm.StringFilter()
+        stf.SetFile(file)
+
+        data_dict = {}
+
+        tag = gdcm.Tag(0x0008, 0x0005)
+        ds = reader.GetFile().GetDataSet()
+        image_helper = gdcm.ImageHelper()
+        data_dict["spacing"] = image_helper.GetSpacingValue(reader.GetFile())
+        if ds.FindDataElement(tag):
+            data_element = ds.GetDataElement(tag)
+            if data_element.IsEmpty():
+                encoding_value = "ISO_IR 100"
             else:
+                encoding_value = str(ds.GetDataElement(tag).GetValue()).split("\\")[0]
+
+            if encoding_value.startswith("Loaded"):
                 encoding = "ISO_IR 100"
+            else:
+                try:
+                    encoding = const.DICOM_ENCODING_TO_PYTHON[encoding_value]
+                except KeyError:
+                    encoding = "ISO_IR 100"
+        else:
+            encoding = "ISO_IR 100"
+
+        # Iterate through the Header
+        iterator = header.GetDES().begin()
+        while not iterator.equal(header.GetDES().end()):
+            dataElement = iterator.next()
+            if not dataElement.IsUndefinedLength():
+                tag = dataElement.GetTag()
+                data = stf.ToStringPair(tag)
+                stag = tag.PrintAsPipeSeparatedString()
+
+                group = str(tag.GetGroup())
+                field = str(tag.GetElement())
+
+                tag_labels[stag] = data[0]
+
+                if not group in data_dict.keys():
+                    data_dict[group] = {}
+
+                if not (utils.VerifyInvalidPListCharacter(data[1])):
+                    data_dict[group][field] = utils.decode(data[1], encoding)
+                else:
+                    data_dict[group][field] = "Invalid Character"
+
+        # Iterate through the Data set
+        iterator = dataSet.GetDES().begin()
+        while not iterator.equal(dataSet.GetDES().end()):
+            dataElement = iterator.next()
+            if not dataElement.IsUndefinedLength():
+                tag = dataElement.GetTag()
+                data = stf.ToStringPair(tag)
+                stag = tag.PrintAsPipeSeparatedString()
+
+                group = str(tag.GetGroup())
+                field = str(tag.GetElement())
+
+                tag_labels[stag] = data[0]
+
+                if not group in data_dict.keys():
+                    data_dict[group] = {}
+
+                if not (utils.VerifyInvalidPListCharacter(data[1])):
+                    data_dict[group][field] = utils.decode(data[1], encoding, "replace")
+                else:
+                    data_dict[group][field] = "Invalid Character"
+
+        img = reader.GetImage()
 
-            # Iterate through the Header
-            iterator = header.GetDES().begin()
-            while not iterator.equal(header.GetDES().end()):
-                dataElement = iterator.next()
-                if not dataElement.IsUndefinedLength():
-                    tag = dataElement.GetTag()
-                    data = stf.ToStringPair(tag)
-                    stag = tag.PrintAsPipeSeparatedString()
-
-                    group = str(tag.GetGroup())
-                    field = str(tag.GetElement())
-
-                    tag_labels[stag] = data[0]
-
-                    if not group in data_dict.keys():
-                        data_dict[group] = {}
-
-                    if not (utils.VerifyInvalidPListCharacter(data[1])):
-                        data_dict[group][field] = utils.decode(data[1], encoding)
-                    else:
-                        data_dict[group][field] = "Invalid Character"
-
-            # Iterate through the Data set
-            iterator = dataSet.GetDES().begin()
-            while not iterator.equal(dataSet.GetDES().end()):
-                dataElement = iterator.next()
-                if not dataElement.IsUndefinedLength():
-                    tag = dataElement.GetTag()
-                    data = stf.ToStringPair(tag)
-                    stag = tag.PrintAsPipeSeparatedString()
-
-                    group = str(tag.GetGroup())
-                    field = str(tag.GetElement())
-
-                    tag_labels[stag] = data[0]
-
-                    if not group in data_dict.keys():
-                        data_dict[group] = {}
-
-                    if not (utils.VerifyInvalidPListCharacter(data[1])):
-                        data_dict[group][field] = utils.decode(data[1], encoding, "replace")
-                    else:
-                        data_dict[group][field] = "Invalid Character"
-
-            img = reader.GetImage()
-
-            # ------ Verify the orientation --------------------------------
-
-            direc_cosines = img.GetDirectionCosines()
-            orientation = gdcm.Orientation()
-            try:
-                _type = orientation.GetType(tuple(direc_cosines))
-            except TypeError:
-                _type = orientation.GetType(direc_cosines)
-            label = orientation.GetLabel(_type)
-
-            # ---------- Refactory --------------------------------------
-            data_dict["invesalius"] = {"orientation_label": label}
-
-            # -------------------------------------------------------------
-            dict_file[self.filepath] = data_dict
-            # print(f"dict_file: {dict_file}")
-
-            # ---------- Verify is DICOMDir -------------------------------
-            is_dicom_dir = 1
-            try:
-                if data_dict[str(0x002)][str(0x002)] != "1.2.840.10008.1.3.10":
-                    is_dicom_dir = 0
-            except KeyError:
+        # ------ Verify the orientation --------------------------------
+
+        direc_cosines = img.GetDirectionCosines()
+        orientation = gdcm.Orientation()
+        try:
+            _type = orientation.GetType(tuple(direc_cosines))
+        except TypeError:
+            _type = orientation.GetType(direc_cosines)
+        label = orientation.GetLabel(_type)
+
+        # ---------- Refactory --------------------------------------
+        data_dict["invesalius"] = {"orientation_label": label}
+
+        # ------ Per-frame geometry of enhanced multi-frame images -----
+        positions, orientations = GetFrameGeometry(dataSet)
+        if positions is not None:
+            data_dict["invesalius"]["frame_positions"] = positions
+            data_dict["invesalius"]["frame_orientations"] = orientations
+        t2 = time.perf_counter()
+
+        # -------------------------------------------------------------
+        dict_file[filepath] = data_dict
+        # print(f"dict_file: {dict_file}")
+
+        # ---------- Verify is DICOMDir -------------------------------
+        is_dicom_dir = 1
+        try:
+            if data_dict[str(0x002)][str(0x002)] != "1.2.840.10008.1.3.10":
                 is_dicom_dir = 0
+        except KeyError:
+            is_dicom_dir = 0
+
+        if not (is_dicom_dir):
+            parser = dicom.Parser()
+            parser.SetDataImage(dict_file[filepath], filepath)
+
+            dcm = dicom.Dicom()
+            dcm.SetParser(parser)
 
-            if not (is_dicom_dir):
-                parser = dicom.Parser()
-                parser.SetDataImage(dict_file[self.filepath], self.filepath)
+            if profiler is not None:
+                stages = {
+                    scan_profiler.STAGE_READ: t1 - t0,
+                    scan_profiler.STAGE_TAGS: t2 - t1,
+                    scan_profiler.STAGE_PARSER: time.perf_counter() - t2,
+                }
+                profiler.AddFile(filepath, stages, parser.GetTransferSyntaxUID())
+            return dcm
+        elif profiler is not None:
+            profiler.AddDicomDir(filepath)
+    elif profiler is not None:
+        profiler.AddRejected(filepath, time.perf_counter() - t0)
+    return None
 
-                dcm = dicom.Dicom()
-                dcm.SetParser(parser)
-                grouper.AddFile(dcm)
+def _ReadHeader(filepath):
+    dcm = ReadDicomFile(filepath)
+    dict_file.pop(filepath, None)
+    return dcm
 
-def yGetDicomGroups(directory, recursive=True, gui=True):
+header_cache = dicom.HeaderCache(_ReadHeader, HEADER_CACHE_SIZE)
+
+def MakeLazy(dcm, table=None):
+    """
+    Return a dicom.DicomProxy of dcm, kept in table (a dicom.ProxyTable,
+    one per scan, a new one reading headers through header_cache by
+    default). Its full header is read again only when needed.
+    """
+    dict_file.pop(dcm.image.file, None)
+    if table is None:
+        table = dicom.ProxyTable(header_cache)
+    return table.Add(dcm)
+
+def AddToGrouper(grouper, dcm, profiler=None):
+    """
+    Add dcm to grouper, timing it when a profiler is given.
+    """
+    if profiler is None:
+        return grouper.AddFile(dcm)
+    t0 = time.perf_counter()
+    group = grouper.AddFile(dcm)
+    profiler.AddGrouping(dcm.image.file, group, time.perf_counter() - t0)
+    return group
+
+class LoadDicom:
+    def __init__(self, grouper, filepath, profiler=None, lazy=False, fast=False, header=None, table=None):
+        self.grouper = grouper
+        self.filepath = utils.decode(filepath, const.FS_ENCODE)
+        self.profiler = profiler
+        self.lazy = lazy
+        self.fast = fast
+        self.header = header
+        self.table = table
+        self.run()
+
+    def run(self):
+        dcm = ReadDicomFile(self.filepath, self.profiler, self.fast, self.header)
+        if dcm is not None:
+            if self.lazy:
+                dcm = MakeLazy(dcm, self.table)
+            AddToGrouper(self.grouper, dcm, self.profiler)
+
+def yGetDicomGroups(directory, recursive=True, gui=True, profiler=None, mode=dicom_grouper.GROUP_BY_TAGS,
+                    lazy=False, readahead=0, fast=False):
     """
     Return all full paths to DICOM files inside given directory.
     """
-    nfiles = 0
+    grouper = GetDicomGrouper(directory, recursive, gui, profiler, mode, lazy, readahead, fast)
+    # yield grouper.GetPatientsGroups()
+    return grouper.GetPatientsGroups()
+
+def GetDicomGrouper(directory, recursive=True, gui=True, profiler=None, mode=dicom_grouper.GROUP_BY_TAGS,
+                    lazy=False, readahead=0, fast=False):
+    """
+    Scan directory and return the DicomPatientGrouper, eg. to query it
+    with DicomPatientGrouper.Query. mode is the grouping mode
+    (dicom_grouper.GROUP_BY_TAGS or GROUP_BY_UID). With lazy, slices
+    are kept as dicom.DicomProxy objects, which don't hold the parsed
+    tags, for scans of large archives. readahead is the number of files
+    fetched ahead of the one being parsed (see io_scheduler), for
+    network file systems; files are then read in directory and inode
+    order. fast is as in ReadDicomFile; with readahead too, only the
+    headers are read ahead, and parsed from memory.
+    """
     # Find total number of files
-    if recursive:
-        for dirpath, dirnames, filenames in os.walk(directory):
-            nfiles += len(filenames)
-    else:
-        dirpath, dirnames, filenames = os.walk(directory)
-        nfiles = len(filenames)
+    t0 = time.perf_counter()
+    filepaths = GetFileList(directory, recursive)
+    nfiles = len(filepaths)
+    if profiler is not None:
+        profiler.AddWalk(directory, nfiles, time.perf_counter() - t0)
+
+    if readahead:
+        filepaths = io_scheduler.ReadAheadScheduler(filepaths, window=readahead, read_headers=fast)
 
     counter = 0
-    grouper = dicom_grouper.DicomPatientGrouper()
+    grouper = dicom_grouper.DicomPatientGrouper(mode)
+    table = dicom.ProxyTable(header_cache) if lazy else None
+    for item in filepaths:
+        filepath, header = item if readahead and fast else (item, None)
+        counter += 1
+        if gui:
+            # yield (counter, nfiles)
+            pass
+        LoadDicom(grouper, filepath, profiler, lazy, fast, header, table)
+    return grouper
+
+def GetFileList(directory, recursive=True):
+    """
+    Return the full paths of all files inside given directory.
+    """
     if recursive:
-        for dirpath, dirnames, filenames in os.walk(directory):
-            for name in filenames:
-                filepath = os.path.join(dirpath, name)
-                counter += 1
-                if gui:
-                    # yield (counter, nfiles)
-                    pass
-                LoadDicom(grouper, filepath)
-    else:
-        dirpath, dirnames, filenames = os.walk(directory)
-        for name in filenames:
-            filepath = str(os.path.join(dirpath, name))
-            counter += 1
-            if gui:
-                # yield (counter, nfiles)
-                pass
-    # yield grouper.GetPatientsGroups()
-    return grouper.GetPatientsGroups()
+        return [
+            os.path.join(dirpath, name)
+            for dirpath, dirnames, filenames in os.walk(directory)
+            for name in filenames
+        ]
+    try:
+        dirpath, dirnames, filenames = next(os.walk(directory))
+    except StopIteration:
+        return []
+    return [os.path.join(dirpath, name) for name in filenames]
+
+async def aGetDicomGroups(directory, recursive=True, max_workers=4, executor=None, profiler=None,
+                          mode=dicom_grouper.GROUP_BY_TAGS, lazy=False, fast=False):
+    """
+    Asynchronous counterpart of yGetDicomGroups, for use inside an
+    asyncio event loop. Directory enumeration and header parsing run in
+    an executor, at most max_workers files at a time, while grouping is
+    done on the loop thread (the grouper is not thread safe).
+
+    Yields (PatientGroup, DicomGroup) pairs once the scan is finished.
+    If the consuming task is cancelled, no new file is submitted; files
+    already being parsed finish in the executor and are discarded.
+    A ProcessPoolExecutor may be given instead of the default threads
+    (but then without a profiler). lazy and fast are as in
+    GetDicomGrouper.
+    """
+    loop = asyncio.get_running_loop()
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+
+    grouper = dicom_grouper.DicomPatientGrouper(mode)
+    table = dicom.ProxyTable(header_cache) if lazy else None
+    try:
+        t0 = time.perf_counter()
+        filepaths = await loop.run_in_executor(executor, GetFileList, directory, recursive)
+        if profiler is not None:
+            profiler.AddWalk(directory, len(filepaths), time.perf_counter() - t0)
+        # Shared by all workers: each one pulls the next pending file.
+        pending = iter(filepaths)
+
+        async def worker():
+            for filepath in pending:
+                dcm = await loop.run_in_executor(executor, ReadDicomFile, filepath, profiler, fast)
+                if dcm is not None:
+                    if lazy:
+                        dcm = MakeLazy(dcm, table)
+                    AddToGrouper(grouper, dcm, profiler)
+
+        workers = [asyncio.ensure_future(worker()) for i in range(max(1, max_workers))]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+    finally:
+        if own_executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    for patient in grouper.GetPatientsGroups():
+        for group in patient.GetGroups():
+            yield patient, group
 
 def GetDicomGroups(directory, recursive=True):
-    return next(yGetDicomGroups(directory, recursive, gui=False))
+    """
+    Return the PatientGroups of directory, scanned with GDCM: Pixel Data
+    offsets aren't recorded, use GetDicomGrouper with fast=True for them.
+    """
+    return yGetDicomGroups(directory, recursive, gui=False)
     
\ No newline at end of file
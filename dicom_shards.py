@@ -0,0 +1,148 @@
+"""
+Scan a DICOM archive in shards and merge them. Every file goes to one
+of n shards by a hash of its path, so shards can be scanned on several
+machines (or processes) at once, each writing its grouper state to a
+shared directory, and merged when they are all done.
+
+    python dicom_shards.py scan /archive -n 16 -s 3 -o shards/3.json.gz
+    python dicom_shards.py merge shards/*.json.gz -o archive.json.gz
+    python dicom_shards.py run /archive -n 8 -d shards -o archive.json.gz
+
+run scans the n shards in local processes and merges them.
+"""
+import argparse, concurrent.futures, os, sys, time, zlib
+
+import dicom_grouper as dicom_grouper
+import dicom_reader as dicom_reader
+import utils as utils
+import constants as const
+
+
+def GetShard(filepath, nshards):
+    """
+    Return the shard (0..nshards - 1) of filepath. It only depends on
+    the path, so every machine agrees on it.
+    """
+    return zlib.crc32(utils.encode(filepath, const.FS_ENCODE)) % nshards
+
+
+def GetShardFileList(roots, nshards, shard, recursive=True):
+    filepaths = []
+    for root in roots:
+        filepaths.extend(
+            filepath for filepath in dicom_reader.GetFileList(root, recursive)
+            if GetShard(filepath, nshards) == shard
+        )
+    return sorted(filepaths)
+
+
+def ScanShard(roots, nshards, shard, filename, mode=dicom_grouper.GROUP_BY_TAGS, recursive=True):
+    """
+    Parse the files of a shard and save the grouper state to filename.
+    Return the number of files and of DICOM files of the shard.
+    """
+    grouper = dicom_grouper.DicomPatientGrouper(mode)
+    filepaths = GetShardFileList(roots, nshards, shard, recursive)
+    ndicoms = 0
+    for filepath in filepaths:
+        dcm = dicom_reader.ReadDicomFile(filepath)
+        if dcm is not None:
+            grouper.AddFile(dcm)
+            ndicoms += 1
+
+    # Written aside and moved at once, so a merge never reads a shard
+    # still being written.
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_filename = filename + ".tmp"
+    grouper.Save(tmp_filename)
+    os.replace(tmp_filename, filename)
+    return len(filepaths), ndicoms
+
+
+def MergeShards(filenames, mode=None):
+    """
+    Return the grouper merging the shard files (see
+    dicom_grouper.MergeGroupers).
+    """
+    return dicom_grouper.MergeGroupers(sorted(filenames), mode)
+
+
+def GetShardFilename(directory, nshards, shard):
+    return os.path.join(directory, "shard-%05d-of-%05d.json.gz" % (shard, nshards))
+
+
+def RunLocal(roots, directory, nshards, workers=None, mode=dicom_grouper.GROUP_BY_TAGS, recursive=True):
+    """
+    Scan the nshards shards of roots in worker processes, writing them
+    to directory, and return the merged grouper.
+    """
+    filenames = [GetShardFilename(directory, nshards, shard) for shard in range(nshards)]
+    with concurrent.futures.ProcessPoolExecutor(workers or min(nshards, os.cpu_count() or 1)) as executor:
+        futures = [
+            executor.submit(ScanShard, roots, nshards, shard, filename, mode, recursive)
+            for shard, filename in enumerate(filenames)
+        ]
+        for future in futures:
+            future.result()
+    return MergeShards(filenames, mode)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--mode", choices=(dicom_grouper.GROUP_BY_TAGS, dicom_grouper.GROUP_BY_UID),
+        help="grouping mode (default: tags, merge: the one of the first shard)",
+    )
+    parser.add_argument("--no-recursive", dest="recursive", action="store_false")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    scan = commands.add_parser("scan", help="scan one shard")
+    scan.add_argument("roots", nargs="+", help="directories to scan")
+    scan.add_argument("-n", "--shards", type=int, required=True, help="number of shards")
+    scan.add_argument("-s", "--shard", type=int, required=True, help="shard to scan, 0..shards - 1")
+    scan.add_argument("-o", "--output", required=True, help="shard state file")
+
+    merge = commands.add_parser("merge", help="merge shard files")
+    merge.add_argument("shards", nargs="+", help="shard state files")
+    merge.add_argument("-o", "--output", required=True, help="merged state file")
+
+    run = commands.add_parser("run", help="scan every shard in local processes and merge them")
+    run.add_argument("roots", nargs="+", help="directories to scan")
+    run.add_argument("-n", "--shards", type=int, default=os.cpu_count() or 1, help="number of shards")
+    run.add_argument("-d", "--directory", required=True, help="directory of the shard files")
+    run.add_argument("-o", "--output", required=True, help="merged state file")
+    run.add_argument("--workers", type=int, help="scanning processes (default: one per shard, up to the cpus)")
+    args = parser.parse_args(argv)
+
+    t0 = time.perf_counter()
+    if args.command == "scan":
+        if not 0 <= args.shard < args.shards:
+            parser.error("--shard must be in 0..%d" % (args.shards - 1))
+        nfiles, ndicoms = ScanShard(
+            args.roots, args.shards, args.shard, args.output, args.mode or dicom_grouper.GROUP_BY_TAGS,
+            args.recursive,
+        )
+        print("shard %d/%d: %d files, %d DICOM files in %.1f s"
+              % (args.shard, args.shards, nfiles, ndicoms, time.perf_counter() - t0), file=sys.stderr)
+        return
+
+    if args.command == "merge":
+        grouper = MergeShards(args.shards, args.mode)
+    else:
+        grouper = RunLocal(
+            args.roots, args.directory, args.shards, args.workers, args.mode or dicom_grouper.GROUP_BY_TAGS,
+            args.recursive,
+        )
+    tmp_filename = args.output + ".tmp"
+    grouper.Save(tmp_filename)
+    os.replace(tmp_filename, args.output)
+    ngroups = sum(len(patient.GetGroups()) for patient in grouper.GetPatientsGroups())
+    print("%d patients, %d series, %d files in %.1f s"
+          % (len(grouper.patients_dict), ngroups, len(grouper.GetDicoms()), time.perf_counter() - t0),
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
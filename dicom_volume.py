@@ -0,0 +1,357 @@
+import collections, mmap, queue, struct, sys, threading
+
+import gdcm
+import numpy as np
+
+import constants as const
+import utils as utils
+
+# A part of a volume: voxels holds frames first to first + len(voxels)
+# of the sorted series, start and stop (excluded) are the frames the slab
+# is made for, the others are the overlap with its neighbours.
+Slab = collections.namedtuple("Slab", ["first", "start", "stop", "voxels", "positions"])
+
+# Location and encoding of the Pixel Data of a file: offset and length
+# (bytes, -1 if encapsulated) in the file, shape and dtype of its
+# frames once decoded.
+PixelData = collections.namedtuple("PixelData", ["file", "offset", "length", "transfer_syntax", "dtype", "shape"])
+
+# Transfer syntaxes whose pixel data can be read as is.
+UNCOMPRESSED_TRANSFER_SYNTAXES = ("1.2.840.10008.1.2", "1.2.840.10008.1.2.1")
+
+GDCM_TO_NUMPY = {
+    gdcm.PixelFormat.UINT8: np.uint8,
+    gdcm.PixelFormat.INT8: np.int8,
+    gdcm.PixelFormat.UINT16: np.uint16,
+    gdcm.PixelFormat.INT16: np.int16,
+    gdcm.PixelFormat.UINT32: np.uint32,
+    gdcm.PixelFormat.INT32: np.int32,
+    gdcm.PixelFormat.FLOAT32: np.float32,
+    gdcm.PixelFormat.FLOAT64: np.float64,
+}
+
+
+def GetDtype(dicom):
+    """
+    Return the numpy dtype of the stored pixels of dicom, based on bits
+    allocated and pixel representation.
+    """
+    bits = dicom.image.bits_allocad or 16
+    signed = dicom.image.pixel_representation == 1
+    if bits == 8:
+        return np.dtype(np.int8 if signed else np.uint8)
+    elif bits == 32:
+        return np.dtype(np.int32 if signed else np.uint32)
+    elif bits == 64:
+        return np.dtype(np.float64)
+    return np.dtype(np.int16 if signed else np.uint16)
+
+
+def GetFrameShape(dicom):
+    columns, rows = dicom.image.size
+    if dicom.image.samples_per_pixel > 1:
+        return (rows, columns, dicom.image.samples_per_pixel)
+    return (rows, columns)
+
+
+def GetOrientation(dicom):
+    """
+    Return the image orientation (row and column direction cosines) of
+    dicom as an array of 6 floats.
+    """
+    if dicom.image.frame_orientations is not None:
+        return np.asarray(dicom.image.frame_orientations[0], dtype=float)
+    return np.asarray(dicom.acquisition.patient_orientation, dtype=float)
+
+
+def GetSpacing(dicom, positions):
+    """
+    Return the (x, y, z) spacing of a volume made of frames at positions
+    (sorted, as returned by DicomGroup.GetSortedFrames) of the same size
+    as dicom. The z spacing is the median distance between frames along
+    the slice normal.
+    """
+    orientation = GetOrientation(dicom)
+    normal = np.cross(orientation[:3], orientation[3:6])
+    if len(positions) > 1:
+        zspacing = float(np.median(np.diff(positions @ normal))) or 1.0
+    elif len(dicom.image.spacing) > 2:
+        zspacing = dicom.image.spacing[2]
+    else:
+        zspacing = 1.0
+    return (dicom.image.spacing[0], dicom.image.spacing[1], zspacing)
+
+
+def GetPixelData(dicom):
+    """
+    Return the PixelData of dicom; its offset and length are None when
+    the scan didn't record them (files parsed by GDCM).
+    """
+    image = dicom.image
+    return PixelData(
+        image.file,
+        getattr(image, "pixel_data_offset", None),
+        getattr(image, "pixel_data_length", None),
+        image.transfer_syntax,
+        GetDtype(dicom),
+        (max(1, image.number_of_frames),) + GetFrameShape(dicom),
+    )
+
+
+def GetPixelIndex(frames):
+    """
+    Return the PixelData of every file of frames, the (dicom, frame
+    number) list of a series (DicomGroup.GetSortedFrames), in the order
+    of their first frame.
+    """
+    index = {}
+    for dicom, frame in frames:
+        if dicom.image.file not in index:
+            index[dicom.image.file] = GetPixelData(dicom)
+    return list(index.values())
+
+
+def GetDirectOffset(dicom):
+    """
+    Return the offset of the pixels of an uncompressed file recorded at
+    scan time, if they can be read as is, or None.
+    """
+    pixel_data = GetPixelData(dicom)
+    if pixel_data.offset is None or pixel_data.transfer_syntax not in UNCOMPRESSED_TRANSFER_SYNTAXES:
+        return None
+    if dicom.image.samples_per_pixel > 1:
+        return None
+    nbytes = int(np.prod(pixel_data.shape)) * pixel_data.dtype.itemsize
+    # The value is padded to an even length.
+    if pixel_data.length not in (nbytes, nbytes + 1):
+        return None
+    return pixel_data.offset
+
+
+def ReadInto(filename, offset, out):
+    """
+    Read the pixels at offset of filename straight into out, a C
+    contiguous array of the native (little endian) dtype.
+    """
+    view = memoryview(out).cast("B")
+    with open(filename, "rb", buffering=0) as f:
+        f.seek(offset)
+        nread = 0
+        while nread < len(view):
+            n = f.readinto(view[nread:])
+            if not n:
+                raise IOError("%s is truncated" % filename)
+            nread += n
+
+
+def ReadFrames(filename):
+    """
+    Decode every frame of filename with GDCM. Return an array with shape
+    (number of frames, rows, columns[, samples per pixel]).
+    """
+    reader = gdcm.ImageReader()
+    try:
+        reader.SetFileName(utils.encode(filename, const.FS_ENCODE))
+    except TypeError:
+        reader.SetFileName(filename)
+    if not reader.Read():
+        raise IOError("Could not read %s" % filename)
+
+    image = reader.GetImage()
+    dtype = GDCM_TO_NUMPY[image.GetPixelFormat().GetScalarType()]
+    buf = image.GetBuffer().encode("utf-8", "surrogateescape")
+    dims = image.GetDimensions()
+    nframes = dims[2] if len(dims) > 2 else 1
+    samples = image.GetPixelFormat().GetSamplesPerPixel()
+    shape = (nframes, dims[1], dims[0])
+    if samples > 1:
+        shape += (samples,)
+    return np.frombuffer(buf, dtype).reshape(shape)
+
+
+def FindPixelData(filename, nbytes):
+    """
+    Return the offset of the value of the uncompressed Pixel Data
+    element (0x7FE0, 0x0010) holding nbytes, or None if not found.
+    """
+    tag = struct.pack("<HH", 0x7FE0, 0x0010)
+    length = struct.pack("<I", nbytes + nbytes % 2)
+    headers = (tag + b"OW\0\0" + length, tag + b"OB\0\0" + length, tag + length)
+    with open(filename, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            for header in headers:
+                # Pixel data is (almost always) the last element.
+                offset = m.rfind(header)
+                if offset >= 0 and offset + len(header) + nbytes <= len(m):
+                    return offset + len(header)
+    return None
+
+
+def MapFrames(dicom):
+    """
+    Return a read only memory map of the frames of an uncompressed
+    file, so only the frames used are read from disk. Return None if the
+    file is compressed or the pixel data can't be located.
+    """
+    image = dicom.image
+    if image.transfer_syntax not in UNCOMPRESSED_TRANSFER_SYNTAXES:
+        return None
+    if image.samples_per_pixel > 1:
+        # The planar configuration would have to be handled.
+        return None
+
+    dtype = GetDtype(dicom)
+    shape = (max(1, image.number_of_frames),) + GetFrameShape(dicom)
+    offset = GetDirectOffset(dicom)
+    if offset is None:
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        offset = FindPixelData(image.file, nbytes)
+    if offset is None:
+        return None
+    return np.memmap(image.file, dtype=dtype.newbyteorder("<"), mode="r", offset=offset, shape=shape)
+
+
+def GroupFrames(frames):
+    """
+    Return {filename: (dicom, positions in the volume, frame numbers in
+    the file)} of the (dicom, frame number) list frames, in order.
+    """
+    by_file = {}
+    for n, (dicom, frame) in enumerate(frames):
+        if dicom.image.file not in by_file:
+            by_file[dicom.image.file] = (dicom, [], [])
+        by_file[dicom.image.file][1].append(n)
+        by_file[dicom.image.file][2].append(frame)
+    return by_file
+
+
+def CanReadInto(dicom, dest, out):
+    """
+    Return True if the single frame file of dicom can be read straight
+    into out at the positions dest (as given by GroupFrames).
+    """
+    return (out.dtype.isnative and sys.byteorder == "little" and len(dest) == 1
+            and max(1, dicom.image.number_of_frames) == 1 and out.dtype == GetDtype(dicom)
+            and out[dest[0]].flags.c_contiguous)
+
+
+def AssembleFrames(frames, out=None, cache=None):
+    """
+    Assemble the (dicom, frame number) list frames, as returned by
+    DicomGroup.GetSortedFrames, into a volume with shape (number of
+    frames, rows, columns[, samples per pixel]).
+
+    Every file is opened once, whatever the number of its frames used:
+    uncompressed single frame files whose pixel offset was recorded at
+    scan time are read straight into the volume, other uncompressed
+    files are memory mapped and only the needed frames are copied,
+    compressed files are decoded a single time, or read from cache (a
+    transcode_cache.TranscodeCache) when they are in it. out may be a
+    preallocated array to fill.
+    """
+    dicom = frames[0][0]
+    shape = (len(frames),) + GetFrameShape(dicom)
+    if out is None:
+        out = np.empty(shape, dtype=GetDtype(dicom))
+    elif out.shape != shape:
+        raise ValueError("out has shape %s, expected %s" % (out.shape, shape))
+
+    for filename, (dicom, dest, src) in GroupFrames(frames).items():
+        if CanReadInto(dicom, dest, out):
+            offset = GetDirectOffset(dicom)
+            if offset is not None:
+                ReadInto(filename, offset, out[dest[0]])
+                continue
+        data = MapFrames(dicom)
+        if data is None and cache is not None:
+            data = cache.GetFrames(dicom)
+        if data is None:
+            data = ReadFrames(filename)
+        out[dest] = data[src]
+        del data
+    return out
+
+
+def AssembleVolume(group, cache=None):
+    """
+    Return (volume, positions) for a DicomGroup: the frames sorted along
+    the slice normal and the position of each of them.
+    """
+    frames, positions = group.GetSortedFrames()
+    return AssembleFrames(frames, cache=cache), positions
+
+
+def _Put(items, item, stopping):
+    """
+    Put item in the queue items, waiting until there's room or stopping
+    is set. Return False in the latter case.
+    """
+    while not stopping.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def IterFrameSlabs(frames, positions, size=32, overlap=0, prefetch=2, cache=None):
+    """
+    Iterate Slab objects of at most size frames (plus overlap frames on
+    each side) of the sorted (dicom, frame number) list frames, decoding
+    up to prefetch slabs ahead in a background thread. Only the slabs
+    being used and queued are in memory, so the peak memory depends on
+    size, not on the number of frames; a compressed multi-frame file is
+    decoded whole though, each time it's needed.
+    """
+    nframes = len(frames)
+    ranges = [
+        (max(0, start - overlap), start, min(nframes, start + size), min(nframes, start + size + overlap))
+        for start in range(0, nframes, size)
+    ]
+
+    def load(first, start, stop, last):
+        return Slab(first, start, stop, AssembleFrames(frames[first:last], cache=cache), positions[first:last])
+
+    if not prefetch:
+        for bounds in ranges:
+            yield load(*bounds)
+        return
+
+    items = queue.Queue(prefetch)
+    stopping = threading.Event()
+
+    def produce():
+        try:
+            for bounds in ranges:
+                if not _Put(items, load(*bounds), stopping):
+                    return
+            _Put(items, None, stopping)
+        except BaseException as err:
+            _Put(items, err, stopping)
+
+    thread = threading.Thread(target=produce, name="slab prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is None:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+            # Don't hold the slab while waiting for the next one.
+            del item
+    finally:
+        stopping.set()
+        thread.join()
+
+
+def IterSlabs(group, size=32, overlap=0, prefetch=2, cache=None):
+    """
+    Iterate a DicomGroup, sorted along the slice normal, in slabs (see
+    IterFrameSlabs), eg. to compute statistics, projections or exports
+    of series too large to be assembled at once.
+    """
+    frames, positions = group.GetSortedFrames()
+    return IterFrameSlabs(frames, positions, size, overlap, prefetch, cache)
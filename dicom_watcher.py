@@ -0,0 +1,267 @@
+import ctypes, ctypes.util, os, select, struct, sys, threading, time
+
+import dicom_grouper as dicom_grouper
+import dicom_reader as dicom_reader
+
+SERIES_UPDATED = "series updated"
+SERIES_COMPLETE = "series complete"
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class InotifySource:
+    """
+    Report files that were completely written (closed after writing
+    or moved in) inside a directory tree, using Linux inotify.
+    """
+    def __init__(self, directory, recursive=True):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.recursive = recursive
+        self.directories = {}  # watch descriptor: directory
+        self.pending = []
+        self.AddDirectory(directory)
+
+    def AddDirectory(self, directory):
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        wd = self._add_watch(self.fd, os.fsencode(directory), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed", directory)
+        self.directories[wd] = directory
+
+        # Files (or subdirectories) created before the watch was set
+        # would otherwise be missed.
+        for entry in os.scandir(directory):
+            if entry.is_dir(follow_symlinks=False):
+                if self.recursive:
+                    self.AddDirectory(entry.path)
+            elif entry.is_file():
+                self.pending.append(entry.path)
+
+    def GetNewFiles(self, timeout=0):
+        filepaths, self.pending = self.pending, []
+        if filepaths:
+            timeout = 0
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return filepaths
+
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return filepaths
+
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(buf, offset)
+            offset += INOTIFY_EVENT.size
+            name = buf[offset : offset + length].rstrip(b"\0")
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped by the kernel, so rescan everything;
+                # files already known are filtered out by the watcher.
+                for directory in list(self.directories.values()):
+                    filepaths.extend(dicom_reader.GetFileList(directory, recursive=False))
+                continue
+
+            directory = self.directories.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if self.recursive and os.path.isdir(path):
+                    self.AddDirectory(path)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                filepaths.append(path)
+        filepaths.extend(self.pending)
+        self.pending = []
+        return filepaths
+
+    def Close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollingSource:
+    """
+    Report new files inside a directory tree by listing it periodically.
+    A file is only reported once its size and modification time didn't
+    change between two polls, so slices still being written are skipped.
+    """
+    def __init__(self, directory, recursive=True, poll_interval=1.0):
+        self.directory = directory
+        self.recursive = recursive
+        self.poll_interval = poll_interval
+        self.candidates = {}  # filepath: (size, mtime)
+        self.reported = {}  # filepath: (size, mtime)
+        self.last_poll = None
+
+    def GetNewFiles(self, timeout=0):
+        if self.last_poll is not None:
+            wait = self.last_poll + self.poll_interval - time.monotonic()
+            if wait > timeout:
+                time.sleep(timeout)
+                return []
+            if wait > 0:
+                time.sleep(wait)
+        self.last_poll = time.monotonic()
+
+        filepaths = []
+        candidates = {}
+        for filepath in dicom_reader.GetFileList(self.directory, self.recursive):
+            try:
+                st = os.stat(filepath)
+            except OSError:
+                continue
+            signature = (st.st_size, st.st_mtime_ns)
+            if self.reported.get(filepath) == signature:
+                continue
+            if self.candidates.get(filepath) == signature:
+                self.reported[filepath] = signature
+                filepaths.append(filepath)
+            else:
+                candidates[filepath] = signature
+        self.candidates = candidates
+        return filepaths
+
+    def Close(self):
+        pass
+
+
+class DicomFolderWatcher:
+    """
+    Keep a DicomPatientGrouper up to date with the files written into a
+    directory, feeding only the new files to it.
+
+    Observers are called as callback(event, group), where event is
+    SERIES_UPDATED after a group received new slices and SERIES_COMPLETE
+    once the group didn't change for quiet_time seconds. When started
+    with Start, the grouper is changed and observers are called from the
+    watcher thread.
+    """
+    def __init__(self, directory, grouper=None, quiet_time=10.0, poll_interval=1.0,
+                 recursive=True, use_inotify=True):
+        if grouper is None:
+            grouper = dicom_grouper.DicomPatientGrouper()
+        self.grouper = grouper
+        self.directory = directory
+        self.quiet_time = quiet_time
+        self.poll_interval = poll_interval
+        self.observers = []
+
+        # Files already in the grouper (e.g. from a previous
+        # yGetDicomGroups) must not be added again.
+        self.added = set()
+        for patient in grouper.patients_dict.values():
+            for group in patient.groups_dict.values():
+                for dcm in group.GetList():
+                    self.added.add(os.path.abspath(dcm.image.file))
+        self.rejected = {}  # filepath: (size, mtime)
+        self.last_update = {}  # group: time of the last added slice
+
+        self.source = None
+        if use_inotify:
+            try:
+                self.source = InotifySource(directory, recursive)
+            except (OSError, AttributeError):
+                self.source = None
+        if self.source is None:
+            self.source = PollingSource(directory, recursive, poll_interval)
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def AddObserver(self, callback):
+        self.observers.append(callback)
+
+    def RemoveObserver(self, callback):
+        self.observers.remove(callback)
+
+    def _Notify(self, event, group):
+        for callback in list(self.observers):
+            callback(event, group)
+
+    def _AddFile(self, filepath):
+        filepath = os.path.abspath(filepath)
+        if filepath in self.added:
+            return None
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            return None
+        # Unreadable files are only retried after they change.
+        signature = (st.st_size, st.st_mtime_ns)
+        if self.rejected.get(filepath) == signature:
+            return None
+
+        dcm = dicom_reader.ReadDicomFile(filepath)
+        if dcm is None:
+            self.rejected[filepath] = signature
+            return None
+        self.rejected.pop(filepath, None)
+        self.added.add(filepath)
+        return self.grouper.AddFile(dcm)
+
+    def Update(self, timeout=0):
+        """
+        Add the files written since the last call (waiting up to timeout
+        seconds for them) and notify observers. Return the number of
+        files added to the grouper.
+        """
+        nfiles = 0
+        updated = []
+        for filepath in self.source.GetNewFiles(timeout):
+            group = self._AddFile(filepath)
+            if group is not None:
+                nfiles += 1
+                if group not in updated:
+                    updated.append(group)
+                self.last_update[group] = time.monotonic()
+
+        for group in updated:
+            self._Notify(SERIES_UPDATED, group)
+
+        now = time.monotonic()
+        for group, last in list(self.last_update.items()):
+            if now - last >= self.quiet_time:
+                del self.last_update[group]
+                self._Notify(SERIES_COMPLETE, group)
+        return nfiles
+
+    def Run(self):
+        """
+        Watch the directory until Stop is called.
+        """
+        while not self._stop.is_set():
+            self.Update(min(self.poll_interval, self.quiet_time))
+
+    def Start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.Run, daemon=True)
+        self._thread.start()
+
+    def Stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def Close(self):
+        self.Stop()
+        self.source.Close()
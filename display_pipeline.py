@@ -0,0 +1,233 @@
+import numpy as np
+
+# Upper bound of the number of voxels processed at once, it limits the
+# size of the scratch buffers.
+CHUNK_SIZE = 1 << 20
+
+VOI_LINEAR = "LINEAR"
+VOI_LINEAR_EXACT = "LINEAR_EXACT"
+VOI_SIGMOID = "SIGMOID"
+
+# Stored dtypes small enough to be converted with a lookup table.
+LUT_DTYPES = {
+    np.dtype(np.uint8): np.uint8,
+    np.dtype(np.int8): np.uint8,
+    np.dtype(np.uint16): np.uint16,
+    np.dtype(np.int16): np.uint16,
+}
+
+
+def GetModalityDtype(dtype, slope=1.0, intercept=0.0):
+    """
+    Return the smallest dtype holding the stored values of dtype after
+    the modality LUT (rescale slope/intercept) was applied.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind not in "iu" or np.ndim(slope) or np.ndim(intercept):
+        return np.dtype(np.float32)
+    if slope != int(slope) or intercept != int(intercept):
+        return np.dtype(np.float32)
+    info = np.iinfo(dtype)
+    values = [info.min * slope + intercept, info.max * slope + intercept]
+    for candidate in (np.int16, np.int32):
+        if np.iinfo(candidate).min <= min(values) and max(values) <= np.iinfo(candidate).max:
+            return np.dtype(candidate)
+    return np.dtype(np.float64)
+
+
+def ApplyModalityLUT(pixels, slope=1.0, intercept=0.0, out=None):
+    """
+    Convert stored pixel values to modality values (eg. Hounsfield
+    units): out = pixels * slope + intercept. slope and intercept may
+    also be arrays with one value per slice (first axis). out may be
+    pixels itself if it has a suitable dtype.
+    """
+    if out is None:
+        out = np.empty(pixels.shape, GetModalityDtype(pixels.dtype, slope, intercept))
+    if np.ndim(slope):
+        slope = np.reshape(slope, (-1,) + (1,) * (pixels.ndim - 1))
+    if np.ndim(intercept):
+        intercept = np.reshape(intercept, (-1,) + (1,) * (pixels.ndim - 1))
+
+    if np.ndim(slope) or slope != 1.0:
+        np.multiply(pixels, slope, out=out, casting="unsafe")
+    elif out is not pixels:
+        np.copyto(out, pixels, casting="unsafe")
+    if np.ndim(intercept) or intercept:
+        np.add(out, intercept, out=out, casting="unsafe")
+    return out
+
+
+class DisplayPipeline:
+    """
+    Convert stored pixel values of a slice, slab or volume to display
+    values applying the modality LUT (rescale slope/intercept) and the
+    VOI LUT (window/level, DICOM PS3.3 C.11.2.1.2).
+
+    8 and 16 bits data goes through a lookup table built once per
+    window/level, other data through a linear transform computed in
+    place. Work is done in chunks of at most CHUNK_SIZE voxels using
+    scratch buffers kept between calls, so no temporary array of the
+    volume size is ever allocated.
+    """
+    def __init__(self, window, level, slope=1.0, intercept=0.0, function=VOI_LINEAR,
+                 out_dtype=np.uint8, out_range=None):
+        self.out_dtype = np.dtype(out_dtype)
+        if out_range is None:
+            if self.out_dtype.kind in "iu":
+                info = np.iinfo(self.out_dtype)
+                out_range = (info.min, info.max)
+            else:
+                out_range = (0.0, 1.0)
+        self.out_range = out_range
+        self.slope = slope
+        self.intercept = intercept
+        self.function = function
+        self.window = float(window)
+        self.level = float(level)
+
+        self._luts = {}  # stored dtype: lookup table
+        self._scratch = {}  # dtype: flat scratch buffer
+        self._out = None
+
+    @classmethod
+    def FromDicom(cls, dicom, window=None, level=None, **kwargs):
+        """
+        Create a pipeline with the rescale and window/level of a
+        dicom.Dicom (window and level can be overridden).
+        """
+        image = dicom.image
+        if window is None or level is None:
+            try:
+                file_window, file_level = float(image.window), float(image.level)
+            except (TypeError, ValueError):
+                file_window, file_level = 2000.0, 300.0
+            window = file_window if window is None else window
+            level = file_level if level is None else level
+        # Stored by the scan, no need to parse the header of lazy or
+        # scan_snapshot slices again.
+        function = image.voi_lut_function or VOI_LINEAR
+        return cls(window, level, image.rescale_slope, image.rescale_intercept, function, **kwargs)
+
+    def SetWindowLevel(self, window, level):
+        self.window = float(window)
+        self.level = float(level)
+        self._luts.clear()
+
+    def SetRescale(self, slope, intercept):
+        self.slope = slope
+        self.intercept = intercept
+        self._luts.clear()
+
+    def _GetScratch(self, dtype, shape):
+        size = int(np.prod(shape))
+        buf = self._scratch.get(dtype)
+        if buf is None or buf.size < size:
+            buf = self._scratch[dtype] = np.empty(size, dtype)
+        return buf[:size].reshape(shape)
+
+    def _VOI(self, values):
+        """
+        Apply the VOI LUT function, in place, to float modality values.
+        """
+        ymin, ymax = self.out_range
+        c, w = self.level, self.window
+        if self.function == VOI_SIGMOID:
+            values -= c
+            values *= -4.0 / max(w, 1e-6)
+            np.exp(values, out=values)
+            values += 1.0
+            np.divide(ymax - ymin, values, out=values)
+            values += ymin
+        else:
+            if self.function == VOI_LINEAR_EXACT:
+                values -= c
+                values *= (ymax - ymin) / max(w, 1e-6)
+                values += (ymax + ymin) / 2.0
+            else:
+                w = max(w, 1.0)
+                if w == 1.0:
+                    # Degenerate window, a threshold at c - 0.5.
+                    np.greater(values, c - 0.5, out=values, casting="unsafe")
+                    values *= ymax - ymin
+                    values += ymin
+                    return values
+                values -= c - 0.5
+                values *= 1.0 / (w - 1.0)
+                values += 0.5
+                values *= ymax - ymin
+                values += ymin
+            np.clip(values, ymin, ymax, out=values)
+        if self.out_dtype.kind in "iu":
+            # Round to nearest when converting to integers.
+            values += 0.5
+            np.floor(values, out=values)
+        return values
+
+    def _GetLUT(self, dtype):
+        try:
+            return self._luts[dtype]
+        except KeyError:
+            pass
+        info = np.iinfo(dtype)
+        stored = np.arange(info.min, info.max + 1, dtype=np.float64)
+        values = ApplyModalityLUT(stored, self.slope, self.intercept, out=stored)
+        values = self._VOI(values)
+        lut = np.empty(values.size, self.out_dtype)
+        # Indexed by the unsigned view of the stored values.
+        index = np.arange(info.min, info.max + 1).astype(dtype).view(LUT_DTYPES[dtype])
+        lut[index] = values
+        self._luts[dtype] = lut
+        return lut
+
+    def _GetChunks(self, shape):
+        """
+        Split the first axis so each chunk has at most CHUNK_SIZE voxels.
+        """
+        if len(shape) < 3:
+            return [slice(None)]
+        per_slice = int(np.prod(shape[1:]))
+        step = max(1, CHUNK_SIZE // max(per_slice, 1))
+        return [slice(i, i + step) for i in range(0, shape[0], step)]
+
+    def Apply(self, pixels, out=None):
+        """
+        Return the display values of pixels (stored values, any shape,
+        slices along the first axis). If out is not given, an output
+        buffer kept by the pipeline is reused when the shape is the same
+        as in the previous call, so copy the result if it must outlive
+        the next call.
+        """
+        if out is None:
+            if self._out is None or self._out.shape != pixels.shape:
+                self._out = np.empty(pixels.shape, self.out_dtype)
+            out = self._out
+        elif out.shape != pixels.shape:
+            raise ValueError("out has shape %s, expected %s" % (out.shape, pixels.shape))
+
+        per_slice_rescale = np.ndim(self.slope) or np.ndim(self.intercept)
+        use_lut = pixels.dtype in LUT_DTYPES and not per_slice_rescale
+        if use_lut and pixels.dtype not in self._luts:
+            # Building a table isn't worth it for a small image.
+            use_lut = pixels.size >= (np.iinfo(pixels.dtype).max - np.iinfo(pixels.dtype).min) // 4
+
+        if use_lut:
+            lut = self._GetLUT(pixels.dtype)
+            index_view = pixels.view(LUT_DTYPES[pixels.dtype])
+
+        for chunk in self._GetChunks(pixels.shape):
+            out_chunk = out[chunk]
+            if use_lut:
+                index = self._GetScratch(np.dtype(np.intp), out_chunk.shape)
+                np.copyto(index, index_view[chunk], casting="unsafe")
+                np.take(lut, index, out=out_chunk, mode="clip")
+            else:
+                values = self._GetScratch(np.dtype(np.float32), out_chunk.shape)
+                slope, intercept = self.slope, self.intercept
+                if np.ndim(slope):
+                    slope = np.asarray(slope)[chunk]
+                if np.ndim(intercept):
+                    intercept = np.asarray(intercept)[chunk]
+                ApplyModalityLUT(pixels[chunk], slope, intercept, out=values)
+                np.copyto(out_chunk, self._VOI(values), casting="unsafe")
+        return out
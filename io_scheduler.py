@@ -0,0 +1,192 @@
+"""
+Read-ahead of DICOM files for scans over network file systems (NFS,
+SMB), where parsing one file after the other waits on a round trip for
+every small read.
+
+Pending files are sorted by directory and inode (the order they are
+laid out on most file systems) and, while a file is parsed, the next
+ones are already being fetched: with posix_fadvise(WILLNEED) where the
+system has it, the kernel reads them asynchronously; otherwise, or when
+the headers are wanted in memory, background threads read them with a
+single bulk read into reusable buffers.
+
+    for filepath in io_scheduler.ReadAheadScheduler(filepaths):
+        dcm = dicom_reader.ReadDicomFile(filepath)
+"""
+import collections, concurrent.futures, os, threading
+
+# Bytes read ahead of every file when only the header is wanted, the
+# meta information and data set before pixel data fit in it for
+# nearly every image.
+HEADER_SIZE = 64 * 1024
+
+HAS_FADVISE = hasattr(os, "posix_fadvise") and hasattr(os, "POSIX_FADV_WILLNEED")
+
+
+def SortFiles(filepaths):
+    """
+    Return filepaths sorted by directory, then by inode within each
+    directory. Inodes come from one directory listing per directory, no
+    file is stat'ed.
+    """
+    by_directory = {}
+    for filepath in filepaths:
+        by_directory.setdefault(os.path.dirname(filepath), []).append(filepath)
+
+    ordered = []
+    for directory in sorted(by_directory):
+        inodes = {}
+        try:
+            with os.scandir(directory or ".") as entries:
+                for entry in entries:
+                    inodes[entry.name] = entry.inode()
+        except OSError:
+            pass
+        ordered.extend(sorted(
+            by_directory[directory],
+            key=lambda filepath: (inodes.get(os.path.basename(filepath), 0), filepath),
+        ))
+    return ordered
+
+
+def AdviseWillNeed(filepath, size=0):
+    """
+    Ask the kernel to read the first size bytes (0: the whole file) of
+    filepath in the background. Return False if it can't be done.
+    """
+    if not HAS_FADVISE:
+        return False
+    try:
+        fd = os.open(filepath, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        os.posix_fadvise(fd, 0, size, os.POSIX_FADV_WILLNEED)
+        return True
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+
+
+def ReadHeader(filepath, buffer):
+    """
+    Read the start of filepath into buffer (a bytearray) with a single
+    read. Return a memoryview of the bytes read, or None on error.
+    """
+    try:
+        with open(filepath, "rb", buffering=0) as f:
+            nbytes = f.readinto(buffer)
+    except OSError:
+        return None
+    return memoryview(buffer)[:nbytes]
+
+
+def ReadThrough(filepath, buffer, size=0):
+    """
+    Read the first size bytes (0: the whole file) of filepath, buffer
+    (a bytearray) at a time, only to bring them to the page cache.
+    Return the number of bytes read.
+    """
+    total = 0
+    view = memoryview(buffer)
+    try:
+        with open(filepath, "rb", buffering=0) as f:
+            while not size or total < size:
+                nbytes = f.readinto(view[:size - total] if size else view)
+                if not nbytes:
+                    break
+                total += nbytes
+    except OSError:
+        pass
+    return total
+
+
+class ReadAheadScheduler:
+    """
+    Iterate filepaths (sorted with SortFiles unless sort is False) while
+    up to window of the next files are fetched by workers threads.
+
+    With read_headers, items are (filepath, header) where header is a
+    memoryview of the first header_size bytes of the file (None if it
+    couldn't be read). The buffers are reused: a header is only valid
+    until the next item is taken, copy it to keep it.
+
+    Otherwise items are file paths, fetched with posix_fadvise when
+    available, by reading them in the background if not: header_size
+    bytes of each, or the whole file (header_size 0, the default) as
+    GDCM reads it whole.
+    """
+    def __init__(self, filepaths, window=32, workers=4, header_size=0, read_headers=False, sort=True):
+        self.filepaths = SortFiles(filepaths) if sort else list(filepaths)
+        self.window = max(1, window)
+        self.workers = max(1, workers)
+        self.read_headers = read_headers
+        self.header_size = header_size or (HEADER_SIZE if read_headers else 0)
+        self.use_fadvise = HAS_FADVISE and not read_headers
+        self._buffers = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.filepaths)
+
+    def _GetBuffer(self):
+        with self._lock:
+            if self._buffers:
+                return self._buffers.pop()
+        return bytearray(self.header_size or HEADER_SIZE)
+
+    def _ReleaseBuffer(self, buffer):
+        with self._lock:
+            self._buffers.append(buffer)
+
+    def _Fetch(self, filepath):
+        if self.use_fadvise:
+            AdviseWillNeed(filepath, self.header_size)
+            return None
+        buffer = self._GetBuffer()
+        if self.read_headers:
+            return buffer, ReadHeader(filepath, buffer)
+        ReadThrough(filepath, buffer, self.header_size)
+        self._ReleaseBuffer(buffer)
+        return None
+
+    def __iter__(self):
+        if self.use_fadvise:
+            # The kernel does the reads, advising is cheap.
+            for n, filepath in enumerate(self.filepaths):
+                if n == 0:
+                    for ahead in self.filepaths[:self.window + 1]:
+                        AdviseWillNeed(ahead, self.header_size)
+                elif n + self.window < len(self.filepaths):
+                    AdviseWillNeed(self.filepaths[n + self.window], self.header_size)
+                yield filepath
+            return
+
+        executor = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix="read-ahead")
+        pending = collections.deque()
+        upcoming = iter(self.filepaths)
+        try:
+            for filepath in upcoming:
+                pending.append((filepath, executor.submit(self._Fetch, filepath)))
+                if len(pending) > self.window:
+                    break
+            while pending:
+                filepath, future = pending.popleft()
+                for ahead in upcoming:
+                    pending.append((ahead, executor.submit(self._Fetch, ahead)))
+                    break
+                result = future.result()
+                if not self.read_headers:
+                    yield filepath
+                    continue
+                buffer, header = result
+                try:
+                    yield filepath, header
+                finally:
+                    del header
+                    self._ReleaseBuffer(buffer)
+        finally:
+            for filepath, future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
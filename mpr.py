@@ -0,0 +1,191 @@
+import collections, threading
+
+import numpy as np
+
+import dicom_volume as dicom_volume
+
+AXIAL = "AXIAL"
+CORONAL = "CORONAL"
+SAGITTAL = "SAGITTAL"
+
+# Array axis normal to each orthogonal plane of a (slices, rows,
+# columns) volume of an axial acquisition.
+PLANE_AXIS = {AXIAL: 0, CORONAL: 1, SAGITTAL: 2}
+
+PROJECTION_MIP = "MIP"
+PROJECTION_MINIP = "MinIP"
+PROJECTION_AVERAGE = "AVERAGE"
+
+
+def Trilinear(volume, coords, fill=0.0, out=None):
+    """
+    Sample volume with trilinear interpolation at coords, a (3, ...)
+    array of (slice, row, column) float indexes. Points outside the
+    volume are set to fill. Return a float32 array with shape
+    coords.shape[1:].
+    """
+    if out is None:
+        out = np.empty(coords.shape[1:], np.float32)
+    dims = np.array(volume.shape[:3]).reshape((3,) + (1,) * (coords.ndim - 1))
+
+    base = np.floor(coords)
+    weights = (coords - base).astype(np.float32)
+    inside = np.all((coords >= 0) & (coords <= dims - 1), axis=0)
+    i0 = np.clip(base.astype(np.intp), 0, dims - 1)
+    i1 = np.minimum(i0 + 1, dims - 1)
+    (z0, y0, x0), (z1, y1, x1) = i0, i1
+    wz, wy, wx = weights
+
+    def lerp(a, b, w):
+        return a + (b - a) * w
+
+    c00 = lerp(volume[z0, y0, x0].astype(np.float32), volume[z0, y0, x1], wx)
+    c01 = lerp(volume[z0, y1, x0].astype(np.float32), volume[z0, y1, x1], wx)
+    c10 = lerp(volume[z1, y0, x0].astype(np.float32), volume[z1, y0, x1], wx)
+    c11 = lerp(volume[z1, y1, x0].astype(np.float32), volume[z1, y1, x1], wx)
+    out[...] = lerp(lerp(c00, c01, wy), lerp(c10, c11, wy), wz)
+    out[~inside] = fill
+    return out
+
+
+def Project(slab, axis, projection):
+    """
+    Reduce a slab along axis with PROJECTION_MIP, PROJECTION_MINIP or
+    PROJECTION_AVERAGE.
+    """
+    if projection == PROJECTION_MIP:
+        return slab.max(axis)
+    elif projection == PROJECTION_MINIP:
+        return slab.min(axis)
+    elif projection == PROJECTION_AVERAGE:
+        return slab.mean(axis, dtype=np.float32)
+    raise ValueError("Unknown projection %r" % projection)
+
+
+class MPR:
+    """
+    Multiplanar reformats of a volume already in memory, with shape
+    (slices, rows, columns) as returned by dicom_volume.AssembleVolume.
+
+    Thin orthogonal slices are views of the volume (no copy). Thick
+    slabs and oblique slices are computed and kept in a LRU cache of
+    cache_size images; cached images are read only, since they are
+    shared. spacing is (x, y, z), in mm.
+    """
+    def __init__(self, volume, spacing=(1.0, 1.0, 1.0), cache_size=32):
+        self.volume = volume
+        self.spacing = tuple(float(value) for value in spacing)
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def FromGroup(cls, group, **kwargs):
+        """
+        Create a MPR of a DicomGroup, assembling its volume.
+        """
+        volume, positions = dicom_volume.AssembleVolume(group)
+        spacing = dicom_volume.GetSpacing(group.GetDicomSample(), positions)
+        return cls(volume, spacing, **kwargs)
+
+    def _Cached(self, key, function, *args):
+        with self._lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        image = function(*args)
+        image.flags.writeable = False
+        with self._lock:
+            self.cache[key] = image
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return image
+
+    def Clear(self):
+        with self._lock:
+            self.cache.clear()
+
+    def GetSlice(self, plane, index, thickness=1, projection=PROJECTION_MIP):
+        """
+        Return the slice index of an orthogonal plane (AXIAL, CORONAL or
+        SAGITTAL). If thickness (in slices) is more than 1, return the
+        projection of the slab of thickness slices centered on index.
+        """
+        axis = PLANE_AXIS[plane]
+        if thickness <= 1:
+            view = [slice(None)] * 3
+            view[axis] = index
+            return self.volume[tuple(view)]
+        return self._Cached(("slab", axis, index, thickness, projection),
+                            self._GetSlab, axis, index, thickness, projection)
+
+    def _GetSlab(self, axis, index, thickness, projection):
+        first = max(0, index - thickness // 2)
+        view = [slice(None)] * 3
+        view[axis] = slice(first, min(self.volume.shape[axis], first + thickness))
+        return Project(self.volume[tuple(view)], axis, projection)
+
+    def GetObliqueSlice(self, center, xaxis, yaxis, shape, pixel_spacing=None, thickness=0.0,
+                        projection=PROJECTION_MIP, fill=None):
+        """
+        Return an oblique slice with shape (rows, columns) centered on
+        center, a (x, y, z) point in mm from the first voxel. xaxis and
+        yaxis are the directions of the rows and columns of the slice
+        (yaxis is made orthogonal to xaxis). Pixels are pixel_spacing mm
+        apart, the smallest volume spacing by default.
+
+        If thickness (mm) is given, the slab around the slice is sampled
+        every pixel_spacing mm along the normal and projected. Points
+        outside the volume are set to fill, the volume minimum by
+        default.
+        """
+        if pixel_spacing is None:
+            pixel_spacing = min(self.spacing)
+        key = (
+            "oblique",
+            tuple(np.round(center, 4)), tuple(np.round(xaxis, 6)), tuple(np.round(yaxis, 6)),
+            tuple(shape), round(pixel_spacing, 6), round(thickness, 6), projection, fill,
+        )
+        return self._Cached(key, self._GetObliqueSlice, center, xaxis, yaxis, shape,
+                            pixel_spacing, thickness, projection, fill)
+
+    def _GetObliqueSlice(self, center, xaxis, yaxis, shape, pixel_spacing, thickness, projection, fill):
+        xaxis = np.asarray(xaxis, dtype=float)
+        xaxis /= np.linalg.norm(xaxis)
+        yaxis = np.asarray(yaxis, dtype=float)
+        yaxis = yaxis - xaxis * (yaxis @ xaxis)
+        yaxis /= np.linalg.norm(yaxis)
+        normal = np.cross(xaxis, yaxis)
+        if fill is None:
+            fill = float(self.volume.min())
+
+        # Plane points in (slice, row, column) index coordinates.
+        rows, columns = shape
+        scale = np.array(self.spacing[::-1]).reshape(3, 1, 1)
+        u = (np.arange(columns) - (columns - 1) / 2.0) * pixel_spacing
+        v = (np.arange(rows) - (rows - 1) / 2.0) * pixel_spacing
+        points = (
+            np.asarray(center, dtype=float)[::-1].reshape(3, 1, 1)
+            + xaxis[::-1].reshape(3, 1, 1) * u.reshape(1, 1, -1)
+            + yaxis[::-1].reshape(3, 1, 1) * v.reshape(1, -1, 1)
+        ) / scale
+        step = normal[::-1].reshape(3, 1, 1) * pixel_spacing / scale
+
+        nsamples = max(1, int(round(thickness / pixel_spacing)) + 1) if thickness else 1
+        offsets = np.arange(nsamples) - (nsamples - 1) / 2.0
+        image = Trilinear(self.volume, points + step * offsets[0], fill)
+        if nsamples > 1:
+            sample = np.empty_like(image)
+            for offset in offsets[1:]:
+                Trilinear(self.volume, points + step * offset, fill, out=sample)
+                if projection == PROJECTION_MIP:
+                    np.maximum(image, sample, out=image)
+                elif projection == PROJECTION_MINIP:
+                    np.minimum(image, sample, out=image)
+                elif projection == PROJECTION_AVERAGE:
+                    image += sample
+                else:
+                    raise ValueError("Unknown projection %r" % projection)
+            if projection == PROJECTION_AVERAGE:
+                image /= nsamples
+        return image
@@ -0,0 +1,225 @@
+import concurrent.futures, math, os
+
+import numpy as np
+
+import dicom_volume as dicom_volume
+
+# Below this in-plane shift (mm) between frames, slices are taken as not
+# sheared.
+SHIFT_TOLERANCE = 1e-3
+
+
+def GetSliceOffsets(dicom, positions, tilt=0.0):
+    """
+    Return the (number of frames, 3) offsets of the sorted frames at
+    positions relative to the first one, along the row direction, the
+    column direction and the slice normal of dicom (mm).
+
+    Gantry tilt shows as a shift along the column direction growing with
+    the slice offset. It's taken from positions when they carry it; if
+    they don't, the nominal tilt (degrees) is used instead.
+    """
+    orientation = dicom_volume.GetOrientation(dicom)
+    axes = np.array([orientation[:3], orientation[3:6], np.cross(orientation[:3], orientation[3:6])])
+    offsets = (np.asarray(positions, dtype=float) - positions[0]) @ axes.T
+    if tilt and np.abs(offsets[:, :2]).max() < SHIFT_TOLERANCE:
+        offsets[:, 1] = offsets[:, 2] * math.tan(math.radians(tilt))
+    return offsets
+
+
+def _GetAxisWeights(coords, size):
+    """
+    Return (i0, i1, weights, inside) to linearly interpolate the samples
+    0..size - 1 at the float indexes coords.
+    """
+    inside = (coords >= 0) & (coords <= size - 1)
+    i0 = np.clip(np.floor(coords).astype(np.intp), 0, size - 1)
+    i1 = np.minimum(i0 + 1, size - 1)
+    weights = (coords - i0).astype(np.float32)
+    return i0, i1, np.clip(weights, 0.0, 1.0), inside
+
+
+def _ShiftAxis(data, shift, size, fill, axis):
+    """
+    Return the 2D array data moved by shift (float) samples along axis,
+    into an array of size samples along it, linearly interpolated.
+    """
+    n = int(math.floor(shift))
+    f = shift - n
+    if f > 1.0 - 1e-6:
+        n, f = n + 1, 0.0
+    elif f < 1e-6:
+        f = 0.0
+    shape = list(data.shape)
+    shape[axis] = size
+    out = np.full(shape, fill, np.float32)
+    src = np.moveaxis(data, axis, 0)
+    dest = np.moveaxis(out, axis, 0)
+
+    # dest[i] = src[i - n] * (1 - f) + src[i - n - 1] * f
+    lo = max(n + (1 if f else 0), 0)
+    hi = min(n + len(src), size)
+    if lo >= hi:
+        return out
+    a = dest[lo:hi]
+    a[...] = src[lo - n:hi - n]
+    if f:
+        b = src[lo - n - 1:hi - n - 1] - a
+        b *= f
+        a += b
+    return out
+
+
+class Resampler:
+    """
+    Resample a volume of sorted frames (slices, rows, columns) with
+    in-plane spacing (x, y) and per frame offsets (see GetSliceOffsets)
+    to a regular grid with the given (x, y, z) spacing, isotropic at the
+    smallest spacing by default.
+
+    Irregular slice gaps are interpolated at the exact offset of every
+    frame and sheared (tilted) slices are moved back into place, so the
+    output grid holds every frame. Work is done with separable linear
+    interpolation over slabs of output slices, in parallel threads.
+    """
+    def __init__(self, volume, spacing, offsets, target_spacing=None, fill=None):
+        self.volume = volume
+        self.spacing = tuple(float(value) for value in spacing[:2])
+        self.offsets = np.asarray(offsets, dtype=float)
+        nframes, rows, columns = volume.shape[:3]
+        sx, sy = self.spacing
+
+        if target_spacing is None:
+            gaps = np.diff(self.offsets[:, 2])
+            gaps = gaps[gaps > 0]
+            step = min(sx, sy, float(np.median(gaps)) if len(gaps) else sx)
+            target_spacing = (step, step, step)
+        self.target_spacing = tuple(float(value) for value in target_spacing)
+        tx, ty, tz = self.target_spacing
+
+        # Output grid: the bounding box of every (shifted) frame.
+        x, y, z = self.offsets.T
+        self.origin = (x.min(), y.min(), z[0])
+        self.shape = (
+            int(math.floor((z[-1] - z[0]) / tz + 1e-6)) + 1,
+            int(math.floor((y.max() - y.min() + (rows - 1) * sy) / ty + 1e-6)) + 1,
+            int(math.floor((x.max() - x.min() + (columns - 1) * sx) / tx + 1e-6)) + 1,
+        )
+        self.fill = fill
+
+        self.sheared = np.ptp(x) > SHIFT_TOLERANCE or np.ptp(y) > SHIFT_TOLERANCE
+        # Same in-plane grid, frames only have to be moved.
+        self.translate = abs(tx - sx) < 1e-6 and abs(ty - sy) < 1e-6
+        self.same_plane = self.translate and not self.sheared and self.shape[1:] == (rows, columns)
+
+        # Frames bracketing every output slice.
+        zs = self.origin[2] + np.arange(self.shape[0]) * tz
+        k = np.clip(np.searchsorted(z, zs, side="right") - 1, 0, max(0, nframes - 2))
+        k1 = np.minimum(k + 1, nframes - 1)
+        gap = z[k1] - z[k]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            weights = np.where(gap > 0, (zs - z[k]) / gap, 0.0)
+        self.k0 = k
+        self.k1 = k1
+        self.weights = np.clip(weights, 0.0, 1.0).astype(np.float32)
+
+    def GetOrigin(self, dicom, first_position):
+        """
+        Return the patient coordinates of the first output voxel.
+        """
+        orientation = dicom_volume.GetOrientation(dicom)
+        axes = np.array([orientation[:3], orientation[3:6], np.cross(orientation[:3], orientation[3:6])])
+        return np.asarray(first_position, dtype=float) + np.asarray(self.origin) @ axes
+
+    def _ResamplePlanes(self, frames):
+        """
+        Resample the frames (indexes) to the output in-plane grid.
+        Return a float32 (len(frames), rows, columns) array.
+        """
+        data = self.volume[frames].astype(np.float32)
+        if self.same_plane:
+            return data
+        nframes, rows, columns = data.shape
+        sx, sy = self.spacing
+        tx, ty, tz = self.target_spacing
+        if self.translate:
+            out = np.empty((nframes,) + self.shape[1:], np.float32)
+            for n, frame in enumerate(frames):
+                plane = _ShiftAxis(data[n], (self.offsets[frame, 1] - self.origin[1]) / sy, self.shape[1], self.fill, 0)
+                out[n] = _ShiftAxis(plane, (self.offsets[frame, 0] - self.origin[0]) / sx, self.shape[2], self.fill, 1)
+            return out
+
+        ys = self.origin[1] + np.arange(self.shape[1]) * ty
+        xs = self.origin[0] + np.arange(self.shape[2]) * tx
+        # Input indexes, per frame since sheared frames are shifted.
+        v = (ys[None, :] - self.offsets[frames, 1][:, None]) / sy
+        u = (xs[None, :] - self.offsets[frames, 0][:, None]) / sx
+
+        v0, v1, wv, inside_v = _GetAxisWeights(v, rows)
+        a = np.take_along_axis(data, v0[:, :, None], axis=1)
+        b = np.take_along_axis(data, v1[:, :, None], axis=1)
+        b -= a
+        b *= wv[:, :, None]
+        a += b
+
+        u0, u1, wu, inside_u = _GetAxisWeights(u, columns)
+        out = np.take_along_axis(a, u0[:, None, :], axis=2)
+        b = np.take_along_axis(a, u1[:, None, :], axis=2)
+        b -= out
+        b *= wu[:, None, :]
+        out += b
+
+        outside = ~(inside_v[:, :, None] & inside_u[:, None, :])
+        out[outside] = self.fill
+        return out
+
+    def _ResampleSlab(self, start, stop, out):
+        k0 = self.k0[start:stop]
+        k1 = self.k1[start:stop]
+        frames = np.union1d(k0, k1)
+        planes = self._ResamplePlanes(frames)
+        a = planes[np.searchsorted(frames, k0)]
+        b = planes[np.searchsorted(frames, k1)]
+        b -= a
+        b *= self.weights[start:stop, None, None]
+        a += b
+        if out.dtype.kind in "iu":
+            np.rint(a, out=a)
+        np.copyto(out[start:stop], a, casting="unsafe")
+
+    def Execute(self, out=None, slab_size=16, workers=None):
+        """
+        Return the resampled volume, with the dtype of the input volume
+        unless out is given.
+        """
+        if out is None:
+            out = np.empty(self.shape, self.volume.dtype)
+        elif out.shape != self.shape:
+            raise ValueError("out has shape %s, expected %s" % (out.shape, self.shape))
+        if self.fill is None:
+            self.fill = float(np.min(self.volume))
+
+        slabs = [(start, min(start + slab_size, self.shape[0])) for start in range(0, self.shape[0], slab_size)]
+        workers = workers or min(len(slabs), os.cpu_count() or 1)
+        if workers <= 1:
+            for start, stop in slabs:
+                self._ResampleSlab(start, stop, out)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+                for future in [executor.submit(self._ResampleSlab, start, stop, out) for start, stop in slabs]:
+                    future.result()
+        return out
+
+
+def ResampleGroup(group, target_spacing=None, **kwargs):
+    """
+    Assemble and resample a DicomGroup. Return (volume, origin, spacing):
+    origin is the patient position of the first voxel, the orientation
+    is the one of the images (dicom_volume.GetOrientation).
+    """
+    frames, positions = group.GetSortedFrames()
+    volume = dicom_volume.AssembleFrames(frames)
+    dicom = frames[0][0]
+    offsets = GetSliceOffsets(dicom, positions, dicom.acquisition.tilt)
+    resampler = Resampler(volume, dicom.image.spacing, offsets, target_spacing)
+    return resampler.Execute(**kwargs), resampler.GetOrigin(dicom, positions[0]), resampler.target_spacing
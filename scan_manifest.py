@@ -0,0 +1,294 @@
+"""
+Scan DICOM trees with the grouping engine and write a manifest: one row
+per file with its patient, study, series and slice tags, its place in
+the sorted series and the series z spacing.
+
+    python scan_manifest.py /archive/a /archive/b -o manifest.jsonl --workers 8
+    python scan_manifest.py /archive -o manifest.parquet --previous manifest.parquet
+
+With --previous, series whose files are unchanged (same size and
+modification time) are copied from the previous manifest; only series
+with new, changed or removed files are parsed again.
+"""
+import argparse, concurrent.futures, functools, json, os, sys, time
+
+import numpy as np
+
+import dicom_grouper as dicom_grouper
+import dicom_reader as dicom_reader
+import dicom_volume as dicom_volume
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+FORMAT_JSONL = "jsonl"
+FORMAT_PARQUET = "parquet"
+
+STATUS_OK = "ok"
+STATUS_REJECTED = "rejected"  # not a DICOM file or not an image
+
+# Columns identifying a series, the grouping key without the index of
+# the sub group of repeated positions.
+SERIES_COLUMNS = ("patient_name", "patient_id", "study_id", "series_number", "orientation_label")
+
+COLUMNS = (
+    "file", "size", "mtime_ns", "status",
+    "patient_name", "patient_id", "study_id", "series_number", "orientation_label", "group_index",
+    "study_instance_uid", "series_instance_uid", "sop_instance_uid",
+    "modality", "study_description", "series_description", "acquisition_date",
+    "image_number", "frames", "slice_index", "nslices", "position",
+    "rows", "columns", "pixel_spacing", "zspacing", "transfer_syntax",
+    "pixel_data_offset", "pixel_data_length",
+)
+
+
+def GetFileStats(roots, recursive=True):
+    """
+    Return {path: (size, mtime_ns)} of every file under roots.
+    """
+    stats = {}
+    for root in roots:
+        for filepath in dicom_reader.GetFileList(root, recursive):
+            try:
+                st = os.stat(filepath)
+            except OSError:
+                continue
+            stats[filepath] = (st.st_size, st.st_mtime_ns)
+    return stats
+
+
+def ReadDicomFiles(filepaths, workers=4, processes=True, fast=False):
+    """
+    Parse filepaths in workers processes (or threads), yielding
+    (filepath, dicom.Dicom or None) in order. fast is as in
+    dicom_reader.ReadDicomFile.
+    """
+    read = functools.partial(dicom_reader.ReadDicomFile, fast=fast)
+    if workers <= 1:
+        for filepath in filepaths:
+            yield filepath, read(filepath)
+        return
+    if processes:
+        executor = concurrent.futures.ProcessPoolExecutor(workers)
+        chunksize = 16
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(workers)
+        chunksize = 1
+    with executor:
+        yield from zip(filepaths, executor.map(read, filepaths, chunksize=chunksize))
+
+
+def _Value(value):
+    """
+    Convert numpy scalars and arrays to JSON serializable values.
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (np.ndarray, tuple)):
+        return [_Value(v) for v in value]
+    return value
+
+
+def GetSeriesKey(row):
+    return tuple(row[column] for column in SERIES_COLUMNS)
+
+
+def GetDicomSeriesKey(dicom):
+    return tuple(_Value(value) for value in (
+        dicom.patient.name,
+        dicom.patient.id,
+        dicom.acquisition.id_study,
+        dicom.acquisition.serie_number,
+        dicom.image.orientation_label,
+    ))
+
+
+def GetGroupRows(group, stats):
+    """
+    Return the manifest rows of the files of a DicomGroup, in the order
+    of their first frame along the slice normal.
+    """
+    frames, positions = group.GetSortedFrames()
+    sample = frames[0][0]
+    zspacing = dicom_volume.GetSpacing(sample, positions)[2]
+
+    rows = []
+    seen = set()
+    for slice_index, (dicom, frame) in enumerate(frames):
+        if dicom.image.file in seen:
+            continue
+        seen.add(dicom.image.file)
+        size, mtime_ns = stats.get(dicom.image.file, (None, None))
+        rows.append({
+            "file": dicom.image.file,
+            "size": size,
+            "mtime_ns": mtime_ns,
+            "status": STATUS_OK,
+            "patient_name": dicom.patient.name,
+            "patient_id": dicom.patient.id,
+            "study_id": dicom.acquisition.id_study,
+            "series_number": dicom.acquisition.serie_number,
+            "orientation_label": dicom.image.orientation_label,
+            "group_index": group.key[-1],
+            "study_instance_uid": dicom.parser.GetStudyInstanceUID(),
+            "series_instance_uid": dicom.parser.GetSeriesInstanceUID(),
+            "sop_instance_uid": dicom.parser.GetSOPInstanceUID(),
+            "modality": dicom.acquisition.modality,
+            "study_description": dicom.acquisition.study_description,
+            "series_description": dicom.acquisition.series_description,
+            "acquisition_date": dicom.acquisition.acquisition_date,
+            "image_number": dicom.image.number,
+            "frames": max(1, dicom.image.number_of_frames),
+            "slice_index": slice_index,
+            "nslices": len(frames),
+            "position": _Value(positions[slice_index]),
+            "rows": dicom.image.size[1],
+            "columns": dicom.image.size[0],
+            "pixel_spacing": _Value(dicom.image.spacing[:2]),
+            "zspacing": zspacing,
+            "transfer_syntax": dicom.image.transfer_syntax,
+            "pixel_data_offset": dicom.image.pixel_data_offset,
+            "pixel_data_length": dicom.image.pixel_data_length,
+        })
+    return [{column: _Value(row[column]) for column in COLUMNS} for row in rows]
+
+
+def GetRejectedRow(filepath, stats):
+    row = dict.fromkeys(COLUMNS)
+    row.update(file=filepath, size=stats[filepath][0], mtime_ns=stats[filepath][1], status=STATUS_REJECTED)
+    return row
+
+
+def ScanRoots(roots, workers=4, processes=True, previous=None, recursive=True, fast=False):
+    """
+    Scan roots and return (rows, summary). previous is a list of rows
+    of an earlier manifest to reuse for unchanged series.
+    """
+    t0 = time.perf_counter()
+    stats = GetFileStats(roots, recursive)
+
+    reused = []
+    to_parse = set()
+    if previous:
+        by_series = {}
+        for row in previous:
+            if row["status"] == STATUS_OK:
+                by_series.setdefault(GetSeriesKey(row), []).append(row)
+            elif stats.get(row["file"]) == (row["size"], row["mtime_ns"]):
+                reused.append(row)
+            elif row["file"] in stats:
+                to_parse.add(row["file"])
+        known = {row["file"] for row in previous}
+        to_parse.update(filepath for filepath in stats if filepath not in known)
+        for rows in by_series.values():
+            if all(stats.get(row["file"]) == (row["size"], row["mtime_ns"]) for row in rows):
+                reused.extend(rows)
+            else:
+                # Changed or removed files: the whole series is grouped
+                # and sorted again.
+                to_parse.update(row["file"] for row in rows if row["file"] in stats)
+    else:
+        to_parse.update(stats)
+
+    grouper = dicom_grouper.DicomPatientGrouper()
+    rejected = []
+    nparsed = 0
+    while to_parse:
+        series = set()
+        for filepath, dcm in ReadDicomFiles(sorted(to_parse), workers, processes, fast):
+            if dcm is None:
+                rejected.append(GetRejectedRow(filepath, stats))
+            else:
+                grouper.AddFile(dcm)
+                series.add(GetDicomSeriesKey(dcm))
+        nparsed += len(to_parse)
+        # A new file may belong to a series kept from the previous
+        # manifest, its files have to be grouped again too.
+        to_parse = {row["file"] for row in reused if row["status"] == STATUS_OK and GetSeriesKey(row) in series}
+        reused = [row for row in reused if row["file"] not in to_parse]
+
+    rows = []
+    for patient in grouper.GetPatientsGroups():
+        for group in patient.GetGroups():
+            rows.extend(GetGroupRows(group, stats))
+
+    rows = reused + rows + rejected
+    rows.sort(key=lambda row: (row["status"] != STATUS_OK, row["file"]))
+    summary = {
+        "files": len(stats),
+        "parsed": nparsed,
+        "reused": len(reused),
+        "rejected": sum(row["status"] == STATUS_REJECTED for row in rows),
+        "seconds": time.perf_counter() - t0,
+    }
+    return rows, summary
+
+
+def GetFormat(filename, fmt=None):
+    if fmt:
+        return fmt
+    return FORMAT_PARQUET if filename.endswith(".parquet") else FORMAT_JSONL
+
+
+def ReadManifest(filename, fmt=None):
+    if GetFormat(filename, fmt) == FORMAT_PARQUET:
+        if not HAS_PYARROW:
+            raise RuntimeError("pyarrow is needed to read Parquet manifests")
+        rows = pyarrow.parquet.read_table(filename).to_pylist()
+    else:
+        with open(filename, encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+    # Manifests written before a column was added.
+    return [{column: row.get(column) for column in COLUMNS} for row in rows]
+
+
+
+def WriteManifest(rows, filename, fmt=None):
+    """
+    Write rows as JSON Lines or, with pyarrow, as a Parquet (columnar)
+    file. The file is replaced at once, so readers never see half of it.
+    """
+    tmp_filename = filename + ".tmp"
+    if GetFormat(filename, fmt) == FORMAT_PARQUET:
+        if not HAS_PYARROW:
+            raise RuntimeError("pyarrow is needed to write Parquet manifests")
+        table = pyarrow.Table.from_pydict({column: [row[column] for row in rows] for column in COLUMNS})
+        pyarrow.parquet.write_table(table, tmp_filename)
+    else:
+        with open(tmp_filename, "w", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False))
+                f.write("\n")
+    os.replace(tmp_filename, filename)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("roots", nargs="+", help="directories to scan")
+    parser.add_argument("-o", "--output", required=True, help="manifest file (.jsonl or .parquet)")
+    parser.add_argument("--format", choices=(FORMAT_JSONL, FORMAT_PARQUET), help="default: from the file extension")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="parsing processes")
+    parser.add_argument("--threads", action="store_true", help="parse in threads instead of processes")
+    parser.add_argument("--previous", help="earlier manifest whose unchanged series are reused")
+    parser.add_argument("--no-recursive", dest="recursive", action="store_false")
+    parser.add_argument("--fast", action="store_true", help="parse plain files without GDCM (see dicom_header)")
+    args = parser.parse_args(argv)
+
+    previous = None
+    if args.previous and os.path.exists(args.previous):
+        previous = ReadManifest(args.previous)
+    rows, summary = ScanRoots(args.roots, args.workers, not args.threads, previous, args.recursive, args.fast)
+    WriteManifest(rows, args.output, args.format)
+    print(
+        "%(files)d files, %(parsed)d parsed, %(reused)d reused, %(rejected)d rejected in %(seconds).1f s" % summary,
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+import heapq, math, os, threading
+
+# Stages recorded by dicom_reader while scanning.
+STAGE_WALK = "walk"  # directory enumeration
+STAGE_READ = "read"  # gdcm.ImageReader.Read
+STAGE_TAGS = "tags"  # gdcm.StringFilter loop over header and data set
+STAGE_PARSER = "parser"  # dicom.Dicom.SetParser
+STAGE_GROUPING = "grouping"  # DicomPatientGrouper.AddFile
+
+# Events sent to the hooks, called as hook(event, info).
+EVENT_FILE = "file"
+EVENT_REJECTED = "rejected"
+EVENT_DICOMDIR = "dicomdir"
+EVENT_DUPLICATE = "duplicate"
+EVENT_WALK = "walk"
+
+
+class Histogram:
+    """
+    Timing histogram with power of two buckets, starting at 1 microsecond.
+    """
+    def __init__(self):
+        self.buckets = {}  # exponent: count
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def Add(self, seconds):
+        exponent = max(0, math.frexp(seconds * 1e6)[1])
+        self.buckets[exponent] = self.buckets.get(exponent, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def GetPercentile(self, percent):
+        """
+        Return the upper bound (in seconds) of the bucket holding the
+        given percentile.
+        """
+        if not self.count:
+            return None
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for exponent in sorted(self.buckets):
+            seen += self.buckets[exponent]
+            if seen >= rank:
+                return min(2 ** exponent / 1e6, self.max)
+        return self.max
+
+    def GetReport(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else None,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.GetPercentile(50),
+            "p90": self.GetPercentile(90),
+            "p99": self.GetPercentile(99),
+            # (upper bound in seconds, count)
+            "histogram": [(2 ** e / 1e6, self.buckets[e]) for e in sorted(self.buckets)],
+        }
+
+
+class ScanProfiler:
+    """
+    Optional instrumentation for the scan pipeline. Pass an instance as
+    the profiler argument of yGetDicomGroups, aGetDicomGroups, LoadDicom
+    or ReadDicomFile to get per stage timing histograms, counters and the
+    slowest files of the scan through GetReport.
+
+    Hooks are called as hook(event, info) from the thread that parsed
+    the file, so they should be cheap. It can be shared by threads, but
+    not by processes.
+    """
+    def __init__(self, nslowest=20):
+        self.nslowest = nslowest
+        self.stages = {}  # stage: Histogram
+        self.counters = {}
+        self.slowest = []  # min-heap of (seconds, n, file info)
+        self.hooks = []
+        self._nfiles = 0
+        self._lock = threading.Lock()
+
+    def AddHook(self, hook):
+        self.hooks.append(hook)
+
+    def RemoveHook(self, hook):
+        self.hooks.remove(hook)
+
+    def _Notify(self, event, info):
+        for hook in self.hooks:
+            hook(event, info)
+
+    def AddStageTime(self, stage, seconds):
+        with self._lock:
+            try:
+                histogram = self.stages[stage]
+            except KeyError:
+                histogram = self.stages[stage] = Histogram()
+            histogram.Add(seconds)
+
+    def Count(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def AddWalk(self, directory, nfiles, seconds):
+        self.AddStageTime(STAGE_WALK, seconds)
+        self.Count("files found", nfiles)
+        self._Notify(EVENT_WALK, {"directory": directory, "nfiles": nfiles, "seconds": seconds})
+
+    def AddFile(self, filepath, stages, transfer_syntax=""):
+        """
+        Record a parsed file. stages is a dict stage: seconds.
+        """
+        for stage, seconds in stages.items():
+            self.AddStageTime(stage, seconds)
+        try:
+            size = os.path.getsize(filepath)
+        except OSError:
+            size = None
+        info = {
+            "filepath": filepath,
+            "seconds": sum(stages.values()),
+            "stages": stages,
+            "transfer_syntax": transfer_syntax,
+            "size": size,
+        }
+        with self._lock:
+            self.counters["files parsed"] = self.counters.get("files parsed", 0) + 1
+            if transfer_syntax:
+                key = "transfer syntax %s" % transfer_syntax
+                self.counters[key] = self.counters.get(key, 0) + 1
+            self._nfiles += 1
+            entry = (info["seconds"], self._nfiles, info)
+            if len(self.slowest) < self.nslowest:
+                heapq.heappush(self.slowest, entry)
+            elif self.nslowest:
+                heapq.heappushpop(self.slowest, entry)
+        self._Notify(EVENT_FILE, info)
+
+    def AddRejected(self, filepath, seconds):
+        self.AddStageTime(STAGE_READ, seconds)
+        self.Count("files rejected")
+        self._Notify(EVENT_REJECTED, {"filepath": filepath, "seconds": seconds})
+
+    def AddDicomDir(self, filepath):
+        self.Count("dicomdirs")
+        self._Notify(EVENT_DICOMDIR, {"filepath": filepath})
+
+    def AddGrouping(self, filepath, group, seconds):
+        self.AddStageTime(STAGE_GROUPING, seconds)
+        # The last item of the group key is the index of the sub group
+        # created for slices repeating a position.
+        if group is not None and group.key and group.key[-1]:
+            self.Count("duplicates")
+            self._Notify(EVENT_DUPLICATE, {"filepath": filepath, "group": group})
+
+    def GetReport(self):
+        """
+        Return the collected data as a dict (JSON serializable).
+        """
+        with self._lock:
+            return {
+                "stages": {stage: h.GetReport() for stage, h in self.stages.items()},
+                "counters": dict(self.counters),
+                "slowest_files": [info for seconds, n, info in sorted(self.slowest, reverse=True)],
+            }
@@ -0,0 +1,392 @@
+"""
+Binary snapshot of grouped scan results, reloaded without parsing any
+DICOM file.
+
+A snapshot is a single file: a magic string, the length of a JSON
+directory, the directory, then every column as a raw little endian
+array aligned to ALIGNMENT bytes, so it can be memory mapped and each
+column viewed in place. String columns are stored as the concatenated
+UTF-8 bytes plus the offsets of every string.
+
+There are three tables, in the order of DicomPatientGrouper's
+GetPatientsGroups and GetGroups:
+
+    series  one row per DicomGroup: key, title, shared patient and
+            acquisition attributes, orientation, spacing, first frame
+    files   one row per file: path, transfer syntax, image size and
+            encoding, rescale, window/level and VOI LUT function, pixel
+            data offset and length
+    frames  one row per frame, sorted along the slice normal: file
+            index, frame number and position
+
+    grouper = dicom_reader.GetDicomGrouper(directory)
+    scan_snapshot.WriteSnapshot(grouper, "scan.snap")
+    for group in scan_snapshot.Snapshot("scan.snap").GetGroups():
+        volume, positions = dicom_volume.AssembleVolume(group)
+"""
+import json, os, struct
+
+import numpy as np
+
+import dicom as dicom
+import dicom_volume as dicom_volume
+
+MAGIC = b"LDSNAP\0\1"
+# 2: Pixel Data offset and length columns, 3: VOI LUT function.
+VERSION = 3
+ALIGNMENT = 64
+
+# Unset integer values (eg. an image without Instance Number) are
+# stored as -1.
+INT_UNSET = -1
+
+FILE_INT_COLUMNS = (
+    "number", "rows", "columns", "number_of_frames", "samples_per_pixel",
+    "bits_allocad", "bits_stored", "pixel_representation",
+)
+FILE_FLOAT_COLUMNS = ("rescale_slope", "rescale_intercept", "window", "level")
+# Pixel Data location (see dicom_volume.GetPixelData), both unset when
+# the offset is -1.
+FILE_OFFSET_COLUMNS = ("pixel_data_offset", "pixel_data_length")
+
+
+class StringColumn:
+    """
+    Read only sequence of the strings of a column, decoded when read.
+    """
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        start, stop = self.offsets[index], self.offsets[index + 1]
+        return self.data[start:stop].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+def _EncodeStrings(values):
+    encoded = [value.encode("utf-8", "surrogateescape") for value in values]
+    offsets = np.zeros(len(encoded) + 1, np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    return offsets, np.frombuffer(b"".join(encoded), np.uint8)
+
+
+def _Default(value):
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    raise TypeError("%r is not JSON serializable" % (value,))
+
+
+def _Int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return INT_UNSET
+
+
+def _Float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _GetSeriesAttributes(dcm):
+    """
+    Return the patient and acquisition attributes shared by the files of
+    a series, as stored in the series.attributes column.
+    """
+    if isinstance(dcm, dicom.DicomProxy):
+        dcm = dcm.GetDicom()
+    acquisition = dict(vars(dcm.acquisition))
+    acquisition.pop("patient_orientation", None)
+    return {"patient": vars(dcm.patient), "acquisition": acquisition}
+
+
+def GetColumns(grouper):
+    """
+    Return {name: array or list of strings} with the columns of the
+    snapshot of a DicomPatientGrouper.
+    """
+    series = {name: [] for name in (
+        "key", "title", "attributes", "index", "first_file", "nfiles", "first_frame", "nframes",
+        "sample", "orientation", "spacing", "zspacing",
+    )}
+    files = {name: [] for name in (
+        "file", "transfer_syntax", "sop_instance_uid", "voi_lut_function", "position", "spacing",
+    )}
+    files.update((name, []) for name in FILE_INT_COLUMNS + FILE_FLOAT_COLUMNS + FILE_OFFSET_COLUMNS)
+    frames = {"file_index": [], "frame": [], "position": []}
+
+    for patient in grouper.GetPatientsGroups():
+        for group in patient.GetGroups():
+            sorted_frames, positions = group.GetSortedFrames()
+            sample = group.GetDicomSample()
+            first = sorted_frames[0][0]
+
+            file_indexes = {}
+            for dcm, frame in sorted_frames:
+                if dcm.image.file not in file_indexes:
+                    file_indexes[dcm.image.file] = len(files["file"])
+                    image = dcm.image
+                    files["file"].append(image.file)
+                    files["transfer_syntax"].append(image.transfer_syntax or "")
+                    files["sop_instance_uid"].append(image.sop_instance_uid or "")
+                    files["position"].append(image.position)
+                    files["spacing"].append(image.spacing[:3])
+                    files["number"].append(_Int(image.number))
+                    files["rows"].append(_Int(image.size[1]))
+                    files["columns"].append(_Int(image.size[0]))
+                    for name in FILE_INT_COLUMNS[3:]:
+                        files[name].append(_Int(getattr(image, name)))
+                    for name in FILE_FLOAT_COLUMNS:
+                        files[name].append(_Float(getattr(image, name)))
+                    files["voi_lut_function"].append(image.voi_lut_function or "")
+                    if getattr(image, "pixel_data_offset", None) is None:
+                        files["pixel_data_offset"].append(INT_UNSET)
+                        files["pixel_data_length"].append(INT_UNSET)
+                    else:
+                        files["pixel_data_offset"].append(image.pixel_data_offset)
+                        files["pixel_data_length"].append(image.pixel_data_length)
+                frames["file_index"].append(file_indexes[dcm.image.file])
+                frames["frame"].append(frame)
+            frames["position"].extend(positions)
+
+            series["key"].append(json.dumps(list(group.key), default=_Default))
+            series["title"].append(str(group.title or ""))
+            series["attributes"].append(json.dumps(_GetSeriesAttributes(first), default=_Default))
+            series["index"].append(group.index)
+            series["first_file"].append(min(file_indexes.values()))
+            series["nfiles"].append(len(file_indexes))
+            series["first_frame"].append(len(frames["file_index"]) - len(sorted_frames))
+            series["nframes"].append(len(sorted_frames))
+            series["sample"].append(file_indexes[sample.image.file])
+            series["orientation"].append(dicom_volume.GetOrientation(first))
+            series["spacing"].append(dicom_volume.GetSpacing(first, positions))
+            series["zspacing"].append(group.zspacing)
+
+    dtypes = {
+        "index": np.int64, "first_file": np.int64, "nfiles": np.int64, "first_frame": np.int64,
+        "nframes": np.int64, "sample": np.int64, "file_index": np.int64, "frame": np.int32,
+        "orientation": np.float64, "spacing": np.float64, "zspacing": np.float64, "position": np.float64,
+    }
+    dtypes.update((name, np.int32) for name in FILE_INT_COLUMNS)
+    dtypes.update((name, np.float64) for name in FILE_FLOAT_COLUMNS)
+    dtypes.update((name, np.int64) for name in FILE_OFFSET_COLUMNS)
+
+    columns = {}
+    for table, values in (("series", series), ("files", files), ("frames", frames)):
+        for name, column in values.items():
+            if name in dtypes:
+                width = {"orientation": 6, "spacing": 3, "position": 3}.get(name)
+                array = np.asarray(column, dtype=dtypes[name])
+                if width:
+                    array = array.reshape(-1, width)
+                columns[table + "." + name] = array
+            else:
+                columns[table + "." + name] = column
+    return columns
+
+
+def WriteSnapshot(grouper, filename):
+    """
+    Write the snapshot of a DicomPatientGrouper to filename. The file is
+    replaced at once, so readers never see half of it.
+    """
+    arrays = {}
+    for name, column in GetColumns(grouper).items():
+        if isinstance(column, np.ndarray):
+            arrays[name] = column
+        else:
+            arrays[name + ".offsets"], arrays[name + ".data"] = _EncodeStrings(column)
+
+    # Offsets are relative to the end of the directory, which is
+    # padded so every column is aligned in the file.
+    directory = {}
+    offset = 0
+    for name, array in arrays.items():
+        array = arrays[name] = np.ascontiguousarray(array, array.dtype.newbyteorder("<"))
+        directory[name] = [array.dtype.str, list(array.shape), offset]
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps({"version": VERSION, "mode": grouper.mode, "columns": directory}).encode("utf-8")
+    header_size = len(MAGIC) + 8 + len(header)
+    padding = -header_size % ALIGNMENT
+
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header) + padding))
+        f.write(header + b" " * padding)
+        for name, array in arrays.items():
+            f.write(array.data)
+            f.write(b"\0" * (-array.nbytes % ALIGNMENT))
+    os.replace(tmp_filename, filename)
+    return filename
+
+
+class SnapshotGroup:
+    """
+    A series of a Snapshot, usable where a DicomGroup is read (sorted
+    frames, sample, key, z spacing): dicom_volume, dicom_export,
+    resample, mpr and thumbnail work with it.
+
+    Its dicom.Dicom objects are made from the snapshot columns when
+    first needed. They have image, patient and acquisition attributes
+    but no parser (None), since no header was read.
+    """
+    def __init__(self, snapshot, row):
+        self.snapshot = snapshot
+        self.row = row
+        column = snapshot.columns
+        self.key = tuple(json.loads(column["series.key"][row]))
+        self.title = column["series.title"][row]
+        self.index = int(column["series.index"][row])
+        self.nslices = int(column["series.nframes"][row])
+        self.zspacing = float(column["series.zspacing"][row])
+        self.orientation = column["series.orientation"][row]
+        self.spacing = tuple(column["series.spacing"][row])
+        self.first_file = int(column["series.first_file"][row])
+        self.nfiles = int(column["series.nfiles"][row])
+        self.first_frame = int(column["series.first_frame"][row])
+        self._dicoms = None
+
+    def GetDicoms(self):
+        """
+        Return the dicom.Dicom of every file of the series, in the order
+        of their first frame along the slice normal.
+        """
+        if self._dicoms is None:
+            self._dicoms = self.snapshot._MakeDicoms(self.row)
+        return self._dicoms
+
+    def GetList(self):
+        return self.GetDicoms()
+
+    def GetFilenameList(self):
+        files = self.snapshot.columns["files.file"]
+        return files[self.first_file:self.first_file + self.nfiles]
+
+    def GetHandSortedList(self):
+        return sorted(self.GetDicoms(), key=lambda dicom: dicom.image.number)
+
+    def GetSortedFrames(self):
+        column = self.snapshot.columns
+        rows = slice(self.first_frame, self.first_frame + self.nslices)
+        dicoms = self.GetDicoms()
+        frames = [
+            (dicoms[file_index - self.first_file], int(frame))
+            for file_index, frame in zip(column["frames.file_index"][rows], column["frames.frame"][rows])
+        ]
+        return frames, np.array(column["frames.position"][rows])
+
+    def GetDicomSample(self):
+        return self.GetDicoms()[int(self.snapshot.columns["series.sample"][self.row]) - self.first_file]
+
+
+class Snapshot:
+    """
+    A snapshot written by WriteSnapshot. With mmap (the default) the
+    columns are views of the memory mapped file, pages are read when
+    used; otherwise the file is read at once.
+    """
+    def __init__(self, filename, mmap=True):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("%s is not a scan snapshot" % filename)
+            (header_size,) = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(header_size))
+        if header["version"] > VERSION:
+            raise ValueError("%s was written by a newer version" % filename)
+        self.mode = header["mode"]
+
+        start = len(MAGIC) + 8 + header_size
+        if mmap:
+            raw = np.memmap(filename, np.uint8, mode="r")
+        else:
+            raw = np.fromfile(filename, np.uint8)
+        arrays = {}
+        for name, (dtype, shape, offset) in header["columns"].items():
+            dtype = np.dtype(dtype)
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            arrays[name] = raw[start + offset:start + offset + nbytes].view(dtype).reshape(shape)
+
+        self.columns = {}
+        for name, array in arrays.items():
+            if name.endswith(".offsets"):
+                self.columns[name[:-8]] = StringColumn(array, arrays[name[:-8] + ".data"])
+            elif not name.endswith(".data"):
+                self.columns[name] = array
+        # Snapshots written before a column was added.
+        nfiles = len(self.columns["files.file"])
+        for name in FILE_OFFSET_COLUMNS:
+            self.columns.setdefault("files." + name, np.full(nfiles, INT_UNSET, np.int64))
+        self.columns.setdefault("files.voi_lut_function", [""] * nfiles)
+        self._groups = None
+
+    def __len__(self):
+        return len(self.columns["series.key"])
+
+    def GetGroups(self):
+        """
+        Return the SnapshotGroup of every series, in the order they were
+        written (patients, then series as listed by the grouper).
+        """
+        if self._groups is None:
+            self._groups = [SnapshotGroup(self, row) for row in range(len(self))]
+        return self._groups
+
+    def _MakeDicoms(self, row):
+        column = self.columns
+        attributes = json.loads(column["series.attributes"][row])
+        orientation = [float(value) for value in column["series.orientation"][row]]
+        patient = dicom.Patient()
+        vars(patient).update(attributes["patient"])
+        acquisition = dicom.Acquisition()
+        vars(acquisition).update(attributes["acquisition"])
+        acquisition.patient_orientation = orientation
+        # Last but one item of the key in both grouping modes.
+        orientation_label = json.loads(column["series.key"][row])[-2]
+
+        first = int(column["series.first_file"][row])
+        dicoms = []
+        for n in range(first, first + int(column["series.nfiles"][row])):
+            image = dicom.Image()
+            image.file = column["files.file"][n]
+            image.transfer_syntax = column["files.transfer_syntax"][n]
+            image.sop_instance_uid = column["files.sop_instance_uid"][n]
+            image.position = [float(value) for value in column["files.position"][n]]
+            image.spacing = [float(value) for value in column["files.spacing"][n]]
+            for name in FILE_INT_COLUMNS:
+                value = int(column["files." + name][n])
+                if name not in ("rows", "columns"):
+                    setattr(image, name, "" if value == INT_UNSET else value)
+            for name in FILE_FLOAT_COLUMNS:
+                value = float(column["files." + name][n])
+                setattr(image, name, "" if np.isnan(value) else value)
+            image.voi_lut_function = column["files.voi_lut_function"][n]
+            image.pixel_data_offset = int(column["files.pixel_data_offset"][n])
+            image.pixel_data_length = int(column["files.pixel_data_length"][n])
+            if image.pixel_data_offset == INT_UNSET:
+                image.pixel_data_offset = image.pixel_data_length = None
+            image.size = (int(column["files.columns"][n]), int(column["files.rows"][n]))
+            image.number_of_frames = image.number_of_frames or 1
+            image.frame_positions = None
+            image.frame_orientations = None
+            image.orientation_label = orientation_label
+            image.type = ""
+
+            dcm = dicom.Dicom()
+            dcm.parser = None
+            dcm.image = image
+            dcm.patient = patient
+            dcm.acquisition = acquisition
+            dicoms.append(dcm)
+        return dicoms
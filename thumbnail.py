@@ -0,0 +1,210 @@
+import collections, hashlib, io, os, struct, threading, zlib
+
+import gdcm
+import numpy as np
+
+import constants as const
+import dicom_volume as dicom_volume
+import display_pipeline as display_pipeline
+import utils as utils
+
+try:
+    from PIL import Image as PILImage, features as pil_features
+
+    HAS_PIL_JPEG2000 = pil_features.check("jpg_2000")
+except ImportError:
+    HAS_PIL_JPEG2000 = False
+
+JPEG2000_TRANSFER_SYNTAXES = ("1.2.840.10008.1.2.4.90", "1.2.840.10008.1.2.4.91")
+
+
+def GetRepresentativeFrame(group):
+    """
+    Return (dicom, frame number) of the middle slice of a DicomGroup.
+    """
+    dicom = group.GetDicomSample()
+    return dicom, max(1, dicom.image.number_of_frames) // 2
+
+
+def _ReadJPEG2000Frame(dicom, frame, size):
+    """
+    Decode a single JPEG 2000 frame at the lowest resolution level that
+    is still at least size pixels wide, using Pillow/OpenJPEG. Return
+    None if it's not possible.
+    """
+    reader = gdcm.Reader()
+    try:
+        reader.SetFileName(utils.encode(dicom.image.file, const.FS_ENCODE))
+    except TypeError:
+        reader.SetFileName(dicom.image.file)
+    if not reader.Read():
+        return None
+    ds = reader.GetFile().GetDataSet()
+    fragments = ds.GetDataElement(gdcm.Tag(0x7FE0, 0x0010)).GetSequenceOfFragments()
+    if fragments is None:
+        return None
+
+    nfragments = fragments.GetNumberOfFragments()
+    # Without a basic offset table only the one fragment per frame case
+    # can be mapped to frames.
+    if max(1, dicom.image.number_of_frames) == 1:
+        indexes = range(nfragments)
+    elif nfragments == dicom.image.number_of_frames:
+        indexes = [frame]
+    else:
+        return None
+    codestream = b"".join(
+        fragments.GetFragment(i).GetByteValue().GetBuffer().encode("utf-8", "surrogateescape")
+        for i in indexes
+    )
+
+    image = PILImage.open(io.BytesIO(codestream))
+    reduce = 0
+    while min(image.size) >> (reduce + 1) >= size:
+        reduce += 1
+    image.reduce = reduce
+    image.load()
+    if image.mode not in ("L", "I;16", "I"):
+        return None
+
+    pixels = np.array(image).astype(np.int32)
+    bits_stored = dicom.image.bits_stored or dicom.image.bits_allocad or 16
+    if dicom.image.pixel_representation == 1:
+        # OpenJPEG (through Pillow) shifts signed samples to unsigned.
+        pixels -= 1 << (bits_stored - 1)
+        low, high = -(1 << (bits_stored - 1)), (1 << (bits_stored - 1)) - 1
+    else:
+        low, high = 0, (1 << bits_stored) - 1
+    # The wavelet ringing of reduced resolutions overshoots the stored
+    # range, which would skew the automatic window.
+    return np.clip(pixels, low, high, out=pixels)
+
+
+def ReadFrame(dicom, frame, size=None):
+    """
+    Return a single frame of dicom as a 2D array, decoding as little as
+    possible: uncompressed files are memory mapped and JPEG 2000 frames
+    are decoded at a reduced resolution when size is given.
+    """
+    if (
+        size
+        and HAS_PIL_JPEG2000
+        and dicom.image.transfer_syntax in JPEG2000_TRANSFER_SYNTAXES
+        and dicom.image.samples_per_pixel == 1
+    ):
+        try:
+            pixels = _ReadJPEG2000Frame(dicom, frame, size)
+        except (IOError, ValueError):
+            pixels = None
+        if pixels is not None:
+            return pixels
+
+    data = dicom_volume.MapFrames(dicom)
+    if data is None:
+        data = dicom_volume.ReadFrames(dicom.image.file)
+    return np.array(data[min(frame, len(data) - 1)])
+
+
+def Downsample(pixels, size):
+    """
+    Reduce pixels by an integer step so its largest side is about size.
+    """
+    step = max(1, max(pixels.shape[:2]) // size)
+    return pixels[::step, ::step]
+
+
+def EncodePNG(pixels):
+    """
+    Encode a 2D uint8 array (grayscale) or a (rows, columns, 3) one (RGB)
+    as PNG.
+    """
+    pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+    height, width = pixels.shape[:2]
+    color_type = 2 if pixels.ndim == 3 else 0
+    # Each scanline starts with the filter type (0, none).
+    raw = np.zeros((height, pixels[0].size + 1), dtype=np.uint8)
+    raw[:, 1:] = pixels.reshape(height, -1)
+
+    def chunk(kind, data):
+        crc = zlib.crc32(kind + data) & 0xFFFFFFFF
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", crc)
+
+    return b"".join([
+        b"\x89PNG\r\n\x1a\n",
+        chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)),
+        chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)),
+        chunk(b"IEND", b""),
+    ])
+
+
+class ThumbnailService:
+    """
+    Render and cache PNG previews of series (DicomGroup) without
+    loading their volumes: only the middle frame is decoded.
+
+    PNGs are kept in a memory LRU of max_entries items and, if cache_dir
+    is given, also on disk so they survive restarts. Cache keys include
+    the sample file modification time, so changed series are rendered
+    again. It may be used from several threads.
+    """
+    def __init__(self, size=128, cache_dir=None, max_entries=1024):
+        self.size = size
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _GetKey(self, dicom, frame):
+        try:
+            st = os.stat(dicom.image.file)
+            signature = "%d:%d" % (st.st_size, st.st_mtime_ns)
+        except OSError:
+            signature = ""
+        key = "%s|%d|%s|%d" % (dicom.image.file, frame, signature, self.size)
+        return hashlib.sha1(key.encode(const.FS_ENCODE, "surrogateescape")).hexdigest()
+
+    def GetThumbnail(self, group):
+        """
+        Return the PNG (bytes) preview of a DicomGroup.
+        """
+        dicom, frame = GetRepresentativeFrame(group)
+        key = self._GetKey(dicom, frame)
+
+        with self._lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+
+        png = None
+        if self.cache_dir:
+            try:
+                with open(os.path.join(self.cache_dir, key + ".png"), "rb") as f:
+                    png = f.read()
+            except OSError:
+                png = None
+
+        if png is None:
+            png = self.Render(dicom, frame)
+            if self.cache_dir:
+                filename = os.path.join(self.cache_dir, key + ".png")
+                with open(filename + ".tmp", "wb") as f:
+                    f.write(png)
+                os.replace(filename + ".tmp", filename)
+
+        with self._lock:
+            self.cache[key] = png
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+        return png
+
+    def Render(self, dicom, frame):
+        pixels = Downsample(ReadFrame(dicom, frame, self.size), self.size)
+        if dicom.image.samples_per_pixel == 1:
+            pixels = display_pipeline.DisplayPipeline.FromDicom(dicom).Apply(pixels)
+        return EncodePNG(pixels)
+
+    def Clear(self):
+        with self._lock:
+            self.cache.clear()
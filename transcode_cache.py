@@ -0,0 +1,370 @@
+"""
+Local cache of decoded compressed images. Once a series has been
+scanned, a background Transcoder decodes its compressed files (JPEG
+2000, JPEG, RLE...) and stores the frames, keyed by SOP Instance UID
+and the size and modification time of the source file, as .npy files
+(memory mapped when read) or, with zstandard installed and compress
+set, zstd compressed .npy.zst files. Loads then read the frames from
+the cache (see dicom_volume.AssembleFrames) instead of decoding them
+again. Frames of a source file changed since (or whose
+shape or type no longer match its header) are dropped and decoded
+again. The cache is bounded in size, the least recently used images
+being removed first.
+
+    cache = transcode_cache.TranscodeCache("/var/cache/load_dicom", 20 * 2**30)
+    transcoder = transcode_cache.Transcoder(cache)
+    transcoder.SubmitGroups(groups)
+    ...
+    volume = dicom_volume.AssembleFrames(frames, cache=cache)
+
+    python transcode_cache.py /archive -c /var/cache/load_dicom --max-size 20G
+"""
+import argparse, collections, hashlib, io, os, queue, re, sys, threading, time
+
+import numpy as np
+
+try:
+    import zstandard
+
+    HAS_ZSTD = True
+except ImportError:
+    HAS_ZSTD = False
+
+import dicom_reader as dicom_reader
+import dicom_volume as dicom_volume
+
+RAW_EXTENSION = ".npy"
+ZSTD_EXTENSION = ".npy.zst"
+ZSTD_LEVEL = 3
+
+DEFAULT_MAX_SIZE = 10 * 2**30
+
+_UID = re.compile(r"[0-9.]{1,64}")
+
+
+def IsCompressed(dicom):
+    return dicom.image.transfer_syntax not in dicom_volume.UNCOMPRESSED_TRANSFER_SYNTAXES
+
+
+def GetSignature(filename):
+    """
+    Return "size-modification time" of filename, "" if it can't be
+    stat'ed.
+    """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return ""
+    return "%d-%d" % (st.st_size, st.st_mtime_ns)
+
+
+def ParseSize(text):
+    """
+    Return the number of bytes of a size such as 500M or 20G.
+    """
+    units = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+    match = re.fullmatch(r"\s*([0-9.]+)\s*([KMGT]?)B?\s*", text.upper())
+    if not match:
+        raise ValueError("invalid size %r" % text)
+    return int(float(match.group(1)) * units[match.group(2)])
+
+
+class TranscodeCache:
+    """
+    Decoded frames of SOP instances in directory, at most max_size
+    bytes. Thread safe. Cached files of earlier sessions are kept, in
+    the order of their last use (their modification time). They are
+    named uid_signature.npy[.zst], signature being GetSignature of the
+    source file when they were stored.
+    """
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE, compress=False):
+        self.directory = directory
+        self.max_size = max_size
+        self.compress = compress and HAS_ZSTD
+        self.size = 0
+        # uid: (filename, size, signature), least recently used first
+        self.entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._LoadEntries()
+
+    def _LoadEntries(self):
+        found = []
+        for subdirectory in os.scandir(self.directory):
+            if not subdirectory.is_dir():
+                continue
+            for entry in os.scandir(subdirectory.path):
+                if entry.name.endswith(".tmp"):
+                    # Left by an interrupted write.
+                    os.remove(entry.path)
+                    continue
+                for extension in (RAW_EXTENSION, ZSTD_EXTENSION):
+                    if entry.name.endswith(extension):
+                        stat = entry.stat()
+                        uid, _, signature = entry.name[: -len(extension)].partition("_")
+                        found.append((stat.st_mtime, uid, entry.path, stat.st_size, signature))
+                        break
+        for mtime, uid, filename, size, signature in sorted(found):
+            if uid in self.entries:
+                # Stored again with another signature, only the last is kept.
+                previous, previous_size, previous_signature = self.entries.pop(uid)
+                self._RemoveFile(previous)
+                self.size -= previous_size
+            self.entries[uid] = (filename, size, signature)
+            self.size += size
+        self.Evict()
+
+    def GetFilename(self, uid, signature, extension):
+        subdirectory = hashlib.sha1(uid.encode("ascii")).hexdigest()[:2]
+        return os.path.join(self.directory, subdirectory, "%s_%s%s" % (uid, signature, extension))
+
+    def __contains__(self, uid):
+        with self._lock:
+            return uid in self.entries
+
+    def Contains(self, uid, source):
+        """
+        Return True if the frames of uid are cached for the current
+        version of the file source.
+        """
+        with self._lock:
+            entry = self.entries.get(uid)
+        return entry is not None and bool(entry[2]) and entry[2] == GetSignature(source)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def Get(self, uid, source=None, shape=None, dtype=None):
+        """
+        Return the frames of the SOP instance uid, with shape (number of
+        frames, rows, columns[, samples per pixel]), or None if they
+        aren't cached. With source, the file they were decoded from, and
+        shape and dtype, the frames expected, stale entries are removed
+        and None returned.
+        """
+        with self._lock:
+            if uid not in self.entries:
+                return None
+            self.entries.move_to_end(uid)
+            filename, size, signature = self.entries[uid]
+        if source is not None and (not signature or signature != GetSignature(source)):
+            self.Remove(uid)
+            return None
+        try:
+            os.utime(filename)
+            if filename.endswith(ZSTD_EXTENSION):
+                if not HAS_ZSTD:
+                    return None
+                with open(filename, "rb") as f:
+                    data = zstandard.ZstdDecompressor().decompress(f.read())
+                frames = np.load(io.BytesIO(data))
+            else:
+                frames = np.load(filename, mmap_mode="r")
+        except (OSError, ValueError):
+            # Removed or damaged, forget it.
+            self.Remove(uid)
+            return None
+        if (shape is not None and frames.shape != tuple(shape)) or (dtype is not None and frames.dtype != dtype):
+            self.Remove(uid)
+            return None
+        return frames
+
+    def GetFrames(self, dicom):
+        """
+        Return the cached frames of the file of dicom, if they were
+        decoded from its current version and match its header, or None.
+        """
+        image = dicom.image
+        shape = (max(1, image.number_of_frames),) + dicom_volume.GetFrameShape(dicom)
+        return self.Get(image.sop_instance_uid, image.file, shape, dicom_volume.GetDtype(dicom))
+
+    def Put(self, uid, frames, source):
+        """
+        Store frames as the decoded frames of the SOP instance uid, read
+        from the file source. Return False if they can't be cached.
+        """
+        if not uid or not _UID.fullmatch(uid):
+            return False
+        signature = GetSignature(source)
+        if not signature:
+            return False
+        frames = np.ascontiguousarray(frames)
+        extension = ZSTD_EXTENSION if self.compress else RAW_EXTENSION
+        filename = self.GetFilename(uid, signature, extension)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmp_filename = "%s.%d.tmp" % (filename, threading.get_ident())
+        with open(tmp_filename, "wb") as f:
+            if self.compress:
+                data = io.BytesIO()
+                np.save(data, frames)
+                f.write(zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data.getbuffer()))
+            else:
+                np.save(f, frames)
+        size = os.path.getsize(tmp_filename)
+        if size > self.max_size:
+            os.remove(tmp_filename)
+            return False
+        os.replace(tmp_filename, filename)
+
+        with self._lock:
+            if uid in self.entries:
+                previous, previous_size, previous_signature = self.entries.pop(uid)
+                self.size -= previous_size
+                if previous != filename:
+                    self._RemoveFile(previous)
+            self.entries[uid] = (filename, size, signature)
+            self.size += size
+        self.Evict()
+        return True
+
+    def _RemoveFile(self, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+    def Remove(self, uid):
+        with self._lock:
+            if uid not in self.entries:
+                return
+            filename, size, signature = self.entries.pop(uid)
+            self.size -= size
+        self._RemoveFile(filename)
+
+    def Evict(self):
+        """
+        Remove the least recently used images until the cache holds at
+        most max_size bytes.
+        """
+        removed = []
+        with self._lock:
+            while self.size > self.max_size and self.entries:
+                uid, (filename, size, signature) = self.entries.popitem(last=False)
+                self.size -= size
+                removed.append(filename)
+        for filename in removed:
+            self._RemoveFile(filename)
+
+    def Clear(self):
+        with self._lock:
+            removed = [filename for filename, size, signature in self.entries.values()]
+            self.entries.clear()
+            self.size = 0
+        for filename in removed:
+            self._RemoveFile(filename)
+
+
+class Transcoder:
+    """
+    Background threads decoding compressed files into a TranscodeCache.
+    Files are transcoded in the order they are submitted, the ones
+    already cached or queued being skipped. Decoding errors are kept in
+    errors as (file, exception), they don't stop the transcoder.
+    """
+    def __init__(self, cache, workers=1):
+        self.cache = cache
+        self.errors = []
+        self._items = queue.Queue()
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = [
+            threading.Thread(target=self.Run, name="transcoder", daemon=True) for n in range(max(1, workers))
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def Submit(self, dicoms):
+        """
+        Queue the compressed files of dicoms. Return the number queued.
+        """
+        count = 0
+        for dicom in dicoms:
+            uid = dicom.image.sop_instance_uid
+            if not IsCompressed(dicom) or not uid or self.cache.Contains(uid, dicom.image.file):
+                continue
+            with self._lock:
+                if uid in self._queued:
+                    continue
+                self._queued.add(uid)
+            self._items.put((uid, dicom.image.file))
+            count += 1
+        return count
+
+    def SubmitGroups(self, groups):
+        """
+        Queue the compressed files of the DicomGroups groups, group by
+        group in sorted order.
+        """
+        count = 0
+        for group in groups:
+            frames, positions = group.GetSortedFrames()
+            count += self.Submit(dicom for dicom, frame in frames)
+        return count
+
+    def Run(self):
+        while not self._stop.is_set():
+            try:
+                uid, filename = self._items.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            try:
+                if not self.cache.Contains(uid, filename):
+                    self.cache.Put(uid, dicom_volume.ReadFrames(filename), filename)
+            except Exception as err:
+                self.errors.append((filename, err))
+            finally:
+                with self._lock:
+                    self._queued.discard(uid)
+                self._items.task_done()
+
+    def GetPending(self):
+        return self._items.qsize()
+
+    def Wait(self):
+        """
+        Wait until every queued file was transcoded.
+        """
+        self._items.join()
+
+    def Stop(self):
+        """
+        Stop the threads once the files being transcoded are done, the
+        pending ones are dropped.
+        """
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("roots", nargs="+", help="directories to scan")
+    parser.add_argument("-c", "--cache", required=True, help="cache directory")
+    parser.add_argument("--max-size", type=ParseSize, default=DEFAULT_MAX_SIZE, help="cache size, eg. 500M, 20G")
+    parser.add_argument("--zstd", action="store_true", help="zstd compress the cached frames")
+    parser.add_argument("--workers", type=int, default=1, help="transcoding threads")
+    parser.add_argument("--no-recursive", dest="recursive", action="store_false")
+    args = parser.parse_args(argv)
+    if args.zstd and not HAS_ZSTD:
+        parser.error("--zstd needs the zstandard package")
+
+    t0 = time.perf_counter()
+    cache = TranscodeCache(args.cache, args.max_size, args.zstd)
+    transcoder = Transcoder(cache, args.workers)
+    count = 0
+    for root in args.roots:
+        grouper = dicom_reader.GetDicomGrouper(root, args.recursive)
+        for patient in grouper.GetPatientsGroups():
+            count += transcoder.SubmitGroups(patient.GetGroups())
+    transcoder.Wait()
+    transcoder.Stop()
+    for filename, err in transcoder.errors:
+        print("%s: %s" % (filename, err), file=sys.stderr)
+    print("%d files transcoded, cache: %d images, %.1f MB in %.1f s"
+          % (count - len(transcoder.errors), len(cache), cache.size / 2**20, time.perf_counter() - t0),
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
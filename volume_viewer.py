@@ -1,6 +1,12 @@
-import vtk, os
+import vtk, os, plistlib
+import numpy as np
+from vtk.util import numpy_support
 
+import dicom_grouper
 import dicom_reader
+import dicom_volume
+import display_pipeline
+import inv_paths
 
 STANDARD = [
     {
@@ -42,29 +48,221 @@ def to_rgb_points(colormap):
                 rgb_points.append([r] + color[0])
     return rgb_points
 
+STANDARD_PRESET = "Standard"
+
+MAPPER_AUTO = "auto"
+MAPPER_GPU = "gpu"
+MAPPER_SMART = "smart"
+MAPPER_CPU = "cpu"
+
+# OpenGL renderer strings of software implementations. The GPU ray cast
+# mapper runs on them, but much slower than the CPU ray cast mapper.
+SOFTWARE_RENDERERS = ("llvmpipe", "softpipe", "swrast", "swiftshader", "software rasterizer",
+                      "gdi generic", "microsoft basic render")
+
+# Frames per second asked while the camera is moving and when it's idle.
+# Mappers trade image and sample distances for speed to meet them.
+INTERACTIVE_UPDATE_RATE = 15.0
+STILL_UPDATE_RATE = 0.0001
+MAXIMUM_IMAGE_SAMPLE_DISTANCE = 4.0
+
+class RaycastingPresets:
+    """
+    Registry of raycasting presets. Presets are the InVesalius plist
+    files found in inv_paths.RAYCASTING_PRESETS_DIRECTORY and
+    inv_paths.USER_RAYCASTING_PRESETS_DIRECTORY (user presets override
+    the ones with the same name), plus the built-in STANDARD one.
+
+    Each preset is read and compiled into a vtkColorTransferFunction and
+    a vtkPiecewiseFunction only the first time it's used; the compiled
+    functions are shared, so they must not be modified.
+    """
+    def __init__(self, directories: list = None) -> None:
+        if directories is None:
+            directories = [inv_paths.RAYCASTING_PRESETS_DIRECTORY, inv_paths.USER_RAYCASTING_PRESETS_DIRECTORY]
+        self.directories = [str(directory) for directory in directories]
+        self.files = None  # name: plist path
+        self.compiled = {}  # name: (vtkColorTransferFunction, vtkPiecewiseFunction, config)
+
+    def scan(self) -> None:
+        self.files = {}
+        for directory in self.directories:
+            if not os.path.isdir(directory):
+                continue
+            for filename in sorted(os.listdir(directory)):
+                name, ext = os.path.splitext(filename)
+                if ext == ".plist":
+                    self.files[name] = os.path.join(directory, filename)
+
+    def getNames(self) -> list:
+        if self.files is None:
+            self.scan()
+        return [STANDARD_PRESET] + sorted(name for name in self.files if name != STANDARD_PRESET)
+
+    def get(self, name: str) -> tuple:
+        """
+        Return (colorTransferFunction, scalarOpacity, config) of a preset.
+        """
+        try:
+            return self.compiled[name]
+        except KeyError:
+            pass
+        if name == STANDARD_PRESET:
+            compiled = self.compileStandard()
+        else:
+            if self.files is None:
+                self.scan()
+            try:
+                filename = self.files[name]
+            except KeyError:
+                raise KeyError("Unknown raycasting preset %r" % name)
+            with open(filename, "rb") as f:
+                config = plistlib.load(f)
+            compiled = self.compile(config)
+        self.compiled[name] = compiled
+        return compiled
+
+    def compileStandard(self) -> tuple:
+        colorTransferFunction = vtk.vtkColorTransferFunction()
+        for rgb_point in to_rgb_points(STANDARD):
+            colorTransferFunction.AddRGBPoint(rgb_point[0], rgb_point[1], rgb_point[2], rgb_point[3])
+        scalarOpacity = vtk.vtkPiecewiseFunction()
+        scalarOpacity.AddPoint(184.129411764706, 0)
+        scalarOpacity.AddPoint(2271.070588235294, 1)
+        return colorTransferFunction, scalarOpacity, {"Name": STANDARD_PRESET}
+
+    def compile(self, config: dict) -> tuple:
+        colorTransferFunction = vtk.vtkColorTransferFunction()
+        scalarOpacity = vtk.vtkPiecewiseFunction()
+
+        if config.get("advancedCLUT"):
+            # 16 bits presets: opacity curves with a color per point
+            curves = config["16bitClutCurves"]
+            colors = config["16bitClutColors"]
+            for i, curve in enumerate(curves):
+                for j, point in enumerate(curve):
+                    color = colors[i][j]
+                    colorTransferFunction.AddRGBPoint(point["x"], color["red"], color["green"], color["blue"])
+                    scalarOpacity.AddPoint(point["x"], point["y"])
+        else:
+            # 8 bits presets: a color list spread over the window
+            clut = config.get("CLUT", "No CLUT")
+            if clut != "No CLUT":
+                path = os.path.join(str(inv_paths.RAYCASTING_PRESETS_COLOR_DIRECTORY), clut + ".plist")
+                with open(path, "rb") as f:
+                    color_list = plistlib.load(f)
+                colors = list(zip(color_list["Red"], color_list["Green"], color_list["Blue"]))
+            else:
+                colors = [(i, i, i) for i in range(256)]
+
+            ww = config["ww"]
+            wl = config["wl"]
+            init = wl - ww / 2.0
+            inc = ww / (len(colors) - 1.0)
+            for n, rgb in enumerate(colors):
+                colorTransferFunction.AddRGBPoint(init + n * inc, *[i / 255.0 for i in rgb])
+            scalarOpacity.AddPoint(wl - ww / 2.0, 0)
+            scalarOpacity.AddPoint(wl + ww / 2.0, 1)
+
+        return colorTransferFunction, scalarOpacity, config
+
+PRESETS = RaycastingPresets()
+
+_openGLRenderer = None
+
+def getOpenGLRenderer() -> str:
+    """
+    Return the OpenGL renderer string, "" if there is no OpenGL. It's
+    read once per process, from a hidden window rendered for it.
+    """
+    global _openGLRenderer
+    if _openGLRenderer is None:
+        _openGLRenderer = ""
+        renderWindow = vtk.vtkRenderWindow()
+        renderWindow.SetOffScreenRendering(1)
+        if renderWindow.SupportsOpenGL():
+            renderWindow.AddRenderer(vtk.vtkRenderer())
+            renderWindow.Render()
+            for line in renderWindow.ReportCapabilities().splitlines():
+                if line.startswith("OpenGL renderer string:"):
+                    _openGLRenderer = line.split(":", 1)[1].strip()
+        renderWindow.Finalize()
+    return _openGLRenderer
+
+def hasGPU() -> bool:
+    renderer = getOpenGLRenderer().lower()
+    return bool(renderer) and not any(name in renderer for name in SOFTWARE_RENDERERS)
+
+def createMapper(mapperType: str) -> tuple:
+    """
+    Return (mapper, mapperType) for MAPPER_GPU, MAPPER_SMART, MAPPER_CPU
+    or MAPPER_AUTO, which picks the GPU ray cast mapper on hardware
+    OpenGL and the multi-threaded CPU ray cast mapper otherwise.
+
+    Every mapper adjusts its sample distances to the desired update rate
+    of the render window: coarse while interacting, full quality on idle.
+    """
+    if mapperType == MAPPER_AUTO:
+        mapperType = MAPPER_GPU if hasGPU() else MAPPER_CPU
+
+    if mapperType == MAPPER_GPU:
+        mapper = vtk.vtkOpenGLGPUVolumeRayCastMapper()
+        mapper.UseJitteringOn()
+        mapper.AutoAdjustSampleDistancesOn()
+        mapper.SetMinimumImageSampleDistance(1.0)
+        mapper.SetMaximumImageSampleDistance(MAXIMUM_IMAGE_SAMPLE_DISTANCE)
+    elif mapperType == MAPPER_SMART:
+        mapper = vtk.vtkSmartVolumeMapper()
+        mapper.SetRequestedRenderModeToDefault()
+        mapper.AutoAdjustSampleDistancesOn()
+        mapper.InteractiveAdjustSampleDistancesOn()
+        mapper.SetInteractiveUpdateRate(INTERACTIVE_UPDATE_RATE)
+    elif mapperType == MAPPER_CPU:
+        mapper = vtk.vtkFixedPointVolumeRayCastMapper()
+        mapper.AutoAdjustSampleDistancesOn()
+        mapper.LockSampleDistanceToInputSpacingOn()
+        mapper.SetImageSampleDistance(1.0)
+        mapper.SetMinimumImageSampleDistance(1.0)
+        mapper.SetMaximumImageSampleDistance(MAXIMUM_IMAGE_SAMPLE_DISTANCE)
+        mapper.SetNumberOfThreads(os.cpu_count() or 1)
+    else:
+        raise ValueError("Unknown volume mapper %r" % mapperType)
+
+    mapper.SetBlendModeToComposite()
+    return mapper, mapperType
+
 class Volume:
-    def __init__(self) -> None:
+    def __init__(self, presets: RaycastingPresets = None, mapperType: str = MAPPER_AUTO) -> None:
         self.colors = vtk.vtkNamedColors()
+        self.presets = presets or PRESETS
+        self.mapperType = mapperType
+        self.presetName = STANDARD_PRESET
         self.initialize()
 
     def initialize(self) -> None:
         self.reader = vtk.vtkDICOMImageReader()
-        self.mapper = vtk.vtkOpenGLGPUVolumeRayCastMapper()
+        # Created by setupPipeline, so it's only picked when needed.
+        self.mapper = None
         self.volumeProperty = vtk.vtkVolumeProperty()
-        self.scalarOpacity = vtk.vtkPiecewiseFunction()
-        self.colorTransferFunction = vtk.vtkColorTransferFunction()
+        self.scalarOpacity = None
+        self.colorTransferFunction = None
         self.volume = vtk.vtkVolume()
         self.renderer = vtk.vtkRenderer()
         self.renderWindow = vtk.vtkRenderWindow()
         self.renderWindowInteractor = vtk.vtkRenderWindowInteractor()
         self.interactorStyle = vtk.vtkInteractorStyleTrackballCamera()
         self.renderWindowInteractor.SetInteractorStyle(self.interactorStyle)
+        self.imageData = None
+        self.scalars = None
+        self.pipelineReady = False
         self.setupRenderWindow()
 
     def setupRenderWindow(self) -> None:
         self.renderWindow.SetSize(1000, 500)
         self.renderWindow.AddRenderer(self.renderer)
         self.renderWindow.SetInteractor(self.renderWindowInteractor)
+        self.renderWindowInteractor.SetDesiredUpdateRate(INTERACTIVE_UPDATE_RATE)
+        self.renderWindowInteractor.SetStillUpdateRate(STILL_UPDATE_RATE)
 
     def setLighting(self, ambientValue: float = 0.1, diffuseValue: float = 0.9, specularValue: float = 0.2, specularPower: float = 10) -> None:
         self.volumeProperty.SetAmbient(ambientValue)
@@ -73,40 +271,154 @@ class Volume:
         self.volumeProperty.SetSpecularPower(specularPower)
 
     def colorMapping(self) -> None:
-        rgb_points = to_rgb_points(STANDARD)
-        for rgb_point in rgb_points:
-            self.colorTransferFunction.AddRGBPoint(rgb_point[0], rgb_point[1], rgb_point[2], rgb_point[3])
+        self.colorTransferFunction = self.presets.get(self.presetName)[0]
         self.volumeProperty.SetColor(self.colorTransferFunction)
 
     def scalarOpacityMapping(self) -> None:
-        self.scalarOpacity.AddPoint(184.129411764706, 0)
-        self.scalarOpacity.AddPoint(2271.070588235294, 1)
+        self.scalarOpacity = self.presets.get(self.presetName)[1]
         self.volumeProperty.SetScalarOpacity(self.scalarOpacity)
-    
-    def show(self, directory: str) -> None:
-        self.reader.SetDirectoryName(directory)
-        self.reader.Update()
-        imageData = self.reader.GetOutput()
 
-        self.mapper.UseJitteringOn()
-        self.mapper.SetBlendModeToComposite()
-        self.mapper.SetInputData(imageData)
+    def setPreset(self, name: str) -> None:
+        """
+        Switch the raycasting preset. The image data isn't read again;
+        if a volume is being shown it's just rendered again.
+        """
+        colorTransferFunction, scalarOpacity, config = self.presets.get(name)
+        self.presetName = name
+        self.colorTransferFunction = colorTransferFunction
+        self.scalarOpacity = scalarOpacity
+        self.volumeProperty.SetColor(colorTransferFunction)
+        self.volumeProperty.SetScalarOpacity(scalarOpacity)
+        if "useShading" in config:
+            self.volumeProperty.SetShade(int(bool(config["useShading"])))
+        if self.renderer.HasViewProp(self.volume):
+            self.renderWindow.Render()
+    
+    def setupPipeline(self) -> None:
+        """
+        Configure the mapper, the volume property and the renderer. Done
+        once, the same pipeline is used for every volume loaded.
+        """
+        if self.pipelineReady:
+            return
+        self.mapper, self.mapperType = createMapper(self.mapperType)
 
         self.volumeProperty.SetInterpolationTypeToLinear()
-        self.colorMapping()
-        self.scalarOpacityMapping()
-
         self.volumeProperty.ShadeOn()
+        self.setPreset(self.presetName)
         self.setLighting(0.1, 0.9, 0.2, 10)
 
         self.volume.SetMapper(self.mapper)
         self.volume.SetProperty(self.volumeProperty)
 
         self.renderer.AddVolume(self.volume)
+        self.pipelineReady = True
+
+    def releaseImageData(self) -> None:
+        """
+        Disconnect the current volume from the mapper and free its memory,
+        the textures uploaded by the mapper included.
+        """
+        if self.imageData is None:
+            return
+        self.mapper.RemoveAllInputs()
+        self.mapper.ReleaseGraphicsResources(self.renderWindow)
+        self.imageData.ReleaseData()
+        self.imageData = None
+        self.scalars = None
+
+    def loadImageData(self, imageData: vtk.vtkImageData, resetCamera: bool = True) -> None:
+        """
+        Show imageData instead of the current volume, reusing the mapper,
+        the volume property and the render window.
+        """
+        self.releaseImageData()
+        self.setupPipeline()
+        self.imageData = imageData
+        self.mapper.SetInputData(imageData)
+        if resetCamera:
+            self.renderer.ResetCamera()
+
+    def loadDirectory(self, directory: str, resetCamera: bool = True) -> None:
+        """
+        Read a directory with a single series with vtkDICOMImageReader and
+        show it.
+        """
+        self.releaseImageData()
+        self.reader.SetDirectoryName(directory)
+        self.reader.Update()
+        # Keep only our reference to the voxels, so the previous volume
+        # is freed on the next load and not held by the reader too.
+        imageData = vtk.vtkImageData()
+        imageData.ShallowCopy(self.reader.GetOutput())
+        self.reader.GetOutput().ReleaseData()
+        self.loadImageData(imageData, resetCamera)
+
+    def loadGroup(self, group: dicom_grouper.DicomGroup, resetCamera: bool = True) -> None:
+        """
+        Show a series already scanned by dicom_reader (a DicomGroup),
+        without reading its headers again.
+        """
+        self.releaseImageData()
+        imageData, scalars = groupToImageData(group)
+        self.loadImageData(imageData, resetCamera)
+        # The vtk array points to it.
+        self.scalars = scalars
+
+    def render(self) -> None:
         self.renderWindow.Render()
-    
+
+    def setInteracting(self, interacting: bool) -> None:
+        """
+        Switch between the fast and the full quality rendering, for when
+        the camera isn't moved by the render window interactor (eg. by
+        a remote client). Full quality is rendered at once.
+        """
+        if interacting:
+            self.renderWindow.SetDesiredUpdateRate(INTERACTIVE_UPDATE_RATE)
+        else:
+            self.renderWindow.SetDesiredUpdateRate(STILL_UPDATE_RATE)
+            self.render()
+
+    def show(self, directory: str) -> None:
+        self.loadDirectory(directory)
+        self.render()
         self.renderWindowInteractor.Start()
 
+def groupToImageData(group: dicom_grouper.DicomGroup) -> tuple:
+    """
+    Assemble a DicomGroup into a vtkImageData with modality values (eg.
+    Hounsfield units), placed in patient coordinates. Return (imageData,
+    voxels): the image data shares the memory of the voxels array.
+    """
+    frames, positions = group.GetSortedFrames()
+    voxels = dicom_volume.AssembleFrames(frames)
+    if voxels.ndim != 3:
+        raise ValueError("Only single sample (grayscale) images can be shown as a volume")
+
+    slopes = np.array([dicom.image.rescale_slope for dicom, frame in frames], dtype=float)
+    intercepts = np.array([dicom.image.rescale_intercept for dicom, frame in frames], dtype=float)
+    slope = slopes if np.ptp(slopes) else slopes[0]
+    intercept = intercepts if np.ptp(intercepts) else intercepts[0]
+    out = None
+    if display_pipeline.GetModalityDtype(voxels.dtype, slope, intercept) == voxels.dtype:
+        out = voxels
+    voxels = np.ascontiguousarray(display_pipeline.ApplyModalityLUT(voxels, slope, intercept, out=out))
+
+    dicom = frames[0][0]
+    orientation = dicom_volume.GetOrientation(dicom)
+    normal = np.cross(orientation[:3], orientation[3:6])
+
+    imageData = vtk.vtkImageData()
+    nslices, rows, columns = voxels.shape
+    imageData.SetDimensions(columns, rows, nslices)
+    imageData.SetSpacing(*dicom_volume.GetSpacing(dicom, positions))
+    imageData.SetOrigin(*positions[0])
+    imageData.SetDirectionMatrix(list(np.column_stack([orientation[:3], orientation[3:6], normal]).ravel()))
+    scalars = numpy_support.numpy_to_vtk(voxels.reshape(-1), deep=False)
+    imageData.GetPointData().SetScalars(scalars)
+    return imageData, voxels
+
 if __name__ == "__main__":
     test = "/home/itadmin/truong/viewer server/viewer-core/server3d/data/1.2.840.113619.2.415.3.2831155460.426.1717906512.373/1.2.840.113619.2.415.3.2831155460.426.1717906512.378/data"
     directory = "/home/itadmin/truong/dicom/79f8a530-24ddc3f3-c163e5d0-96faead7-25bd5f3a/2408059658 LE VAN CAT 1974M/604662 CHUP CONG HUONG TU NAO MACH NAO XOANG/MR Ax DWI B1000"